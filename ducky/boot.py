@@ -7,6 +7,7 @@ into VM's memory for writing.
 
 import importlib
 import mmap
+import struct
 
 from functools import partial
 from ctypes import sizeof
@@ -28,6 +29,9 @@ DEFAULT_HDT_ADDRESS        = 0x00000100
 #: By default, CPU starts executing instructions at this address after boot.
 DEFAULT_BOOTLOADER_ADDRESS = 0x00020000
 
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+
 class MMapMemoryPage(ExternalMemoryPage):
   """
   Memory page backed by an external file that is accessible via ``mmap()``
@@ -37,6 +41,10 @@ class MMapMemoryPage(ExternalMemoryPage):
   every change of external file will be reflected in content of this page
   (if this page lies in affected area).
 
+  Page is just a view of its part of area's mapping - words are read and
+  written directly from and to the mapping, without going through
+  :py:meth:`get` and :py:meth:`put`.
+
   :param MMapArea area: area this page belongs to.
   """
 
@@ -50,6 +58,7 @@ class MMapMemoryPage(ExternalMemoryPage):
 
     else:
       self.get, self.put = self._get_py3, self._put_py3
+      self.read_block, self.write_block = self._read_block_py3, self._write_block_py3
 
   def get(self, offset):
     """
@@ -117,14 +126,56 @@ class MMapMemoryPage(ExternalMemoryPage):
 
     self.data[self.offset + offset] = b
 
+  def read_u16(self, offset):
+    self.DEBUG('%s.read_u16: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return _U16.unpack_from(self.data, self.offset + offset)[0]
+
+  def read_u32(self, offset):
+    self.DEBUG('%s.read_u32: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return _U32.unpack_from(self.data, self.offset + offset)[0]
+
+  def write_u16(self, offset, value):
+    self.DEBUG('%s.write_u16: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
+
+    _U16.pack_into(self.data, self.offset + offset, value & 0xFFFF)
+
+  def write_u32(self, offset, value):
+    self.DEBUG('%s.write_u32: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
+
+    _U32.pack_into(self.data, self.offset + offset, value & 0xFFFFFFFF)
+
+  def _read_block_py3(self, offset, length):
+    """
+    Read block of bytes from page.
+
+    :param int offset: offset of the first byte.
+    :param int length: number of bytes to read.
+    :rtype: bytearray
+    """
+
+    return bytearray(self.data[self.offset + offset:self.offset + offset + length])
+
+  def _write_block_py3(self, offset, buff):
+    """
+    Write block of bytes to page.
+
+    :param int offset: offset of the first byte.
+    :param buff: bytes to write.
+    """
+
+    self.data[self.offset + offset:self.offset + offset + len(buff)] = buff
+
 class MMapAreaState(SnapshotNode):
   def __init__(self):
     super(MMapAreaState, self).__init__('address', 'size', 'path', 'offset')
 
 class MMapArea(object):
   """
-  Objects of this class represent one mmaped memory area each, to track this
-  information for later use.
+  Objects of this class represent one mmaped memory area each. Area is
+  attached to memory controller as a whole, and its pages are created only
+  when accessed for the first time.
 
   :param ptr: ``mmap object``, as returned by :py:meth:`mmap.mmap` function.
   :param u32_t address: address of the first byte of an area in the memory.
@@ -134,9 +185,13 @@ class MMapArea(object):
   :param int pages_start: first page of the area.
   :param int pages_cnt: number of pages in the area.
   :param mm.binary.SectionFlags flags: flags applied to this area.
+  :param bool shared: if ``True``, area is mapped as shared.
+  :param int ptr_offset: offset of the first byte of the area in ``ptr`` -
+    ``mmap()`` accepts only offsets aligned to :py:data:`mmap.ALLOCATIONGRANULARITY`,
+    therefore mapping may start before the area.
   """
 
-  def __init__(self, ptr, address, size, file_path, offset, pages_start, pages_cnt, flags):
+  def __init__(self, ptr, address, size, file_path, offset, pages_start, pages_cnt, flags, shared = False, ptr_offset = 0):
     super(MMapArea, self).__init__()
 
     self.ptr = ptr
@@ -148,10 +203,23 @@ class MMapArea(object):
     self.pages_start = pages_start
     self.pages_cnt = pages_cnt
     self.flags = flags
+    self.shared = shared
+    self.ptr_offset = ptr_offset
 
   def __repr__(self):
     return '<MMapArea: address=%s, size=%s, filepath=%s, pages-start=%s, pages-cnt=%i, flags=%s>' % (UINT32_FMT(self.address), self.size, self.file_path, self.pages_start, self.pages_cnt, self.flags.to_string())
 
+  def create_page(self, controller, index):
+    """
+    Create page object for one of area's pages.
+
+    :param ducky.mm.MemoryController controller: controller that will own the page.
+    :param int index: page index.
+    :rtype: :py:class:`ducky.boot.MMapMemoryPage`
+    """
+
+    return MMapMemoryPage(self, controller, index, self.ptr, offset = self.ptr_offset + (index - self.pages_start) * PAGE_SIZE)
+
   def save_state(self, parent):
     pass
 
@@ -174,24 +242,28 @@ class ROMLoader(IMachineWorker):
     self.logger = self.machine.LOGGER
     self.DEBUG = self.machine.DEBUG
 
-  def _get_mmap_fileno(self, file_path):
-    if file_path not in self.opened_mmap_files:
-      self.opened_mmap_files[file_path] = [0, open(file_path, 'r+b')]
+  def _get_mmap_fileno(self, file_path, shared):
+    # Private mappings never write back, their files need not be writable
+    key = (file_path, shared)
 
-    desc = self.opened_mmap_files[file_path]
+    if key not in self.opened_mmap_files:
+      self.opened_mmap_files[key] = [0, open(file_path, 'r+b' if shared else 'rb')]
+
+    desc = self.opened_mmap_files[key]
 
     desc[0] += 1
     return desc[1].fileno()
 
-  def _put_mmap_fileno(self, file_path):
-    desc = self.opened_mmap_files[file_path]
+  def _put_mmap_fileno(self, file_path, shared):
+    key = (file_path, shared)
+    desc = self.opened_mmap_files[key]
 
     desc[0] -= 1
     if desc[0] > 0:
       return
 
     desc[1].close()
-    del self.opened_mmap_files[file_path]
+    del self.opened_mmap_files[key]
 
   def mmap_area(self, file_path, address, size, offset = 0, flags = None, shared = False):
     """
@@ -226,10 +298,6 @@ class ROMLoader(IMachineWorker):
     mc = self.machine.memory
     pages_start, pages_cnt = area_to_pages(address, size)
 
-    for i in range(pages_start, pages_start + pages_cnt):
-      if i in mc.pages:
-        raise InvalidResourceError('MMap request overlaps with existing pages: page=%s, area=%s' % (mc.pages[i], mc.pages[i].area))
-
     mmap_flags = mmap.MAP_SHARED if shared else mmap.MAP_PRIVATE
 
     # Always mmap as writable - VM will force read-only access using
@@ -240,33 +308,37 @@ class ROMLoader(IMachineWorker):
     # limitation is not possible to overcome.
     mmap_prot = mmap.PROT_READ | mmap.PROT_WRITE
 
+    ptr_offset = offset % mmap.ALLOCATIONGRANULARITY
+
     ptr = mmap.mmap(
-      self._get_mmap_fileno(file_path),
-      size,
+      self._get_mmap_fileno(file_path, shared),
+      ptr_offset + size,
       flags = mmap_flags,
       prot = mmap_prot,
-      offset = offset)
+      offset = offset - ptr_offset)
 
-    area = MMapArea(ptr, address, size, file_path, ptr, pages_start, pages_cnt, flags)
+    area = MMapArea(ptr, address, size, file_path, offset, pages_start, pages_cnt, flags, shared = shared, ptr_offset = ptr_offset)
 
-    for i in range(pages_start, pages_start + pages_cnt):
-      mc.register_page(MMapMemoryPage(area, mc, i, ptr, offset = (i - pages_start) * PAGE_SIZE))
+    try:
+      mc.map_area(area)
+
+    except InvalidResourceError:
+      ptr.close()
+      self._put_mmap_fileno(file_path, shared)
+      raise
 
     self.mmap_areas[area.address] = area
 
     return area
 
   def unmmap_area(self, mmap_area):
-    mc = self.machine.memory
-
-    for pg in mc.get_pages(pages_start = mmap_area.pages_start, pages_cnt = mmap_area.pages_cnt):
-      mc.unregister_page(pg)
+    self.machine.memory.unmap_area(mmap_area)
 
     del self.mmap_areas[mmap_area.address]
 
     mmap_area.ptr.close()
 
-    self._put_mmap_fileno(mmap_area.file_path)
+    self._put_mmap_fileno(mmap_area.file_path, mmap_area.shared)
 
   def setup_hdt(self):
     """
@@ -307,8 +379,7 @@ class ROMLoader(IMachineWorker):
         return address + size
 
       def __write_array(max_length, address, field_value):
-        for i in range(0, max_length):
-          self.machine.memory.write_u8(address + i, field_value[i])
+        self.machine.memory.write_block(address, bytearray(field_value)[0:max_length])
 
         return address + max_length
 
@@ -342,8 +413,7 @@ class ROMLoader(IMachineWorker):
 
       __alloc_pages(len(img))
 
-      for address, b in zip(range(hdt_address, hdt_address + len(img)), img):
-        self.machine.memory.write_u8(address, b)
+      self.machine.memory.write_block(hdt_address, img)
 
   def setup_mmaps(self):
     self.DEBUG('%s.setup_mmaps', self.__class__.__name__)
@@ -381,7 +451,7 @@ class ROMLoader(IMachineWorker):
         a = klass.create_from_config(core.debug, self.config, action_section)
         p.actions.append(a)
 
-  def setup_bootloader(self, filepath, base = None):
+  def setup_bootloader(self, filepath, base = None, mmap_sections = False):
     """
     Load :term:`bootloader` into main memory.
 
@@ -393,6 +463,10 @@ class ROMLoader(IMachineWorker):
     :param str filepath: path to bootloader binary.
     :param u32_t base: address of the first byte of bootloader in memory.
       By default, :py:const:`ducky.boot.DEFAULT_BOOTLOADER_ADDRESS` is used.
+    :param bool mmap_sections: if ``True``, loadable sections that are not
+      writable are not copied into memory but mapped from the binary as private
+      mmap areas. Only whole pages can be mapped - section must start at page
+      boundary, and its last, incomplete page is still copied.
     """
 
     self.DEBUG('%s.setup_bootloader: filepath=%s, base=%s', self.__class__.__name__, filepath, UINT32_FMT(base) if base is not None else '<none>')
@@ -413,16 +487,30 @@ class ROMLoader(IMachineWorker):
 
         pages_start, pages_cnt = area_to_pages(section_base, section.header.data_size)
 
-        for i in range(pages_start, pages_start + pages_cnt):
+        if mmap_sections is True and section.header.flags.writable != 1 and section.header.flags.bss != 1 and section_base & ~PAGE_MASK == 0:
+          mapped_size = section.header.file_size & PAGE_MASK
+
+        else:
+          mapped_size = 0
+
+        if mapped_size:
+          self.DEBUG('%s.setup_bootloader: mapping %s bytes', self.__class__.__name__, mapped_size)
+
+          self.mmap_area(filepath, section_base, mapped_size, offset = section.header.offset, flags = SectionFlags.from_encoding(section.header.flags))
+
+        for i in range(pages_start + mapped_size // PAGE_SIZE, pages_start + pages_cnt):
           mc.alloc_specific_page(i)
 
         if section.header.flags.bss == 1:
           self.DEBUG('%s.setup_bootloader: BSS section, allocating pages is good enough', self.__class__.__name__)
           continue
 
-        for b in section.payload:
-          self.machine.memory.write_u8(section_base, b)
-          section_base += 1
+        if mapped_size:
+          f.seek(section.header.offset + mapped_size)
+          mc.write_block(section_base + mapped_size, f.read(section.header.file_size - mapped_size))
+
+        else:
+          mc.write_block(section_base, section.payload)
 
   def poke(self, address, value, length):
     self.DEBUG('%s.poke: addr=%s, value=%s, length=%s', self.__class__.__name__, UINT32_FMT(address), UINT32_FMT(value), length)
@@ -436,15 +524,27 @@ class ROMLoader(IMachineWorker):
     else:
       self.machine.memory.write_u32(address, u32_t(value).value)
 
-  def boot(self):
+  def boot(self, resume = False):
+    """
+    Load HDT and bootloader into memory, and map configured files.
+
+    :param bool resume: if set, machine is being resumed, and its RAM already
+      contains HDT and bootloader, therefore these are not loaded again.
+    """
+
     self.DEBUG('%s.boot', self.__class__.__name__)
 
-    self.setup_hdt()
+    if resume is not True:
+      self.setup_hdt()
+
     self.setup_mmaps()
     self.setup_debugging()
 
+    if resume is True:
+      return
+
     if self.config.has_section('bootloader'):
-      self.setup_bootloader(self.config.get('bootloader', 'file'), base = self.config.getint('bootloader', 'base', DEFAULT_BOOTLOADER_ADDRESS))
+      self.setup_bootloader(self.config.get('bootloader', 'file'), base = self.config.getint('bootloader', 'base', DEFAULT_BOOTLOADER_ADDRESS), mmap_sections = self.config.getbool('bootloader', 'mmap-sections', False))
 
   def halt(self):
     self.DEBUG('%s.halt', self.__class__.__name__)
@@ -11,6 +11,8 @@ from .. import profiler
 
 from ..interfaces import IMachineWorker, ISnapshotable
 from ..mm import UINT8_FMT, UINT16_FMT, UINT32_FMT, PAGE_SIZE, PAGE_MASK, PAGE_SHIFT, PageTableEntry, UINT64_FMT, WORD_SIZE
+from ..mm.directory import PageDirectory
+from ..heatmap import READ as HEATMAP_READ, WRITE as HEATMAP_WRITE, FETCH as HEATMAP_FETCH
 from .registers import Registers, REGISTER_NAMES
 from .instructions import DuckyInstructionSet, EncodingContext
 from ..errors import ExceptionList, AccessViolationError, InvalidResourceError, ExecutionException, InvalidOpcodeError, MemoryAccessError, InvalidExceptionError, PrivilegedInstructionError, InvalidFrameError, UnalignedAccessError
@@ -26,6 +28,17 @@ DEFAULT_PT_ADDRESS = 0x00010000
 #: Default size of core instruction cache, in instructions.
 DEFAULT_CORE_INST_CACHE_SIZE = 256
 
+#: Default number of TLB slots, for each kind of access.
+DEFAULT_CORE_TLB_SIZE = 64
+
+# Sets of TLB slots, see :py:class:`ducky.cpu.TLB`
+TLB_READ       = 0
+TLB_WRITE      = 1
+TLB_EXECUTE    = 2
+TLB_PRIVILEGED = 3
+
+TLB_ACCESS_NAMES = ('read', 'write', 'execute')
+
 class CPUState(SnapshotNode):
   def get_core_states(self):
     return [__state for __name, __state in iteritems(self.get_children()) if __name.startswith('core')]
@@ -163,15 +176,26 @@ class InstructionCache_Base(LoggingCapable, dict):
 
     return i
 
-class InstructionCache_Full(LoggingCapable, list):
+  def invalidate(self, index):
+    """
+    Drop cached instruction.
+
+    :param int index: index of instruction, i.e. its address divided by 4.
+    """
+
+    dict.pop(self, index, None)
+
+class InstructionCache_Full(LoggingCapable, PageDirectory):
   """
-  Simple instruction cache class, based on a list, with unlimited size.
+  Simple instruction cache class, based on a page directory, with unlimited
+  size. Directory tables are allocated only for parts of memory instructions
+  are fetched from.
 
   :param ducky.cpu.CPUCore core: CPU core that owns this cache.
   """
 
   def __init__(self, mmu, *args, **kwargs):
-    super(InstructionCache_Full, self).__init__(mmu.core.cpu.machine.LOGGER, [None for _ in range(0, mmu.memory.size >> 2)])
+    super(InstructionCache_Full, self).__init__(mmu.core.cpu.machine.LOGGER, mmu.memory.size >> 2)
 
     self._mmu = mmu
     self._core = mmu.core
@@ -180,9 +204,14 @@ class InstructionCache_Full(LoggingCapable, list):
     self.hits    = 0
     self.misses  = 0
 
-  def clear(self):
-    for i in range(0, self._mmu.memory.size >> 2):
-      self[i] = None
+  def invalidate(self, index):
+    """
+    Drop cached instruction.
+
+    :param int index: index of instruction, i.e. its address divided by 4.
+    """
+
+    self.pop(index, None)
 
   def __getitem__(self, addr):
     """
@@ -193,19 +222,70 @@ class InstructionCache_Full(LoggingCapable, list):
 
     index = addr >> 2
 
-    i = list.__getitem__(self, index)
+    i = self.get(index)
 
     if i is None:
         self.misses += 1
 
         i = self.fetch_instr(addr)
-        list.__setitem__(self, index, i)
+        PageDirectory.__setitem__(self, index, i)
 
     else:
       self.hits += 1
 
     return i
 
+class TLB(object):
+  """
+  Translation lookaside buffer - direct-mapped cache of page accessors, used
+  by MMU when page table is enabled. Each slot holds index of a page, and a
+  tuple of page's read and write methods, with access already checked against
+  corresponding ``PTE``.
+
+  There are separate sets of slots for unprivileged read, write and execute
+  accesses, and one set shared by all privileged accesses. Privileged access
+  is not checked against page table, therefore change of privilege level
+  selects a different set and does not need a flush.
+
+  :param int size: number of slots in each set, must be a power of two.
+  :raises ducky.errors.InvalidResourceError: when size is not a power of two.
+  """
+
+  def __init__(self, size = DEFAULT_CORE_TLB_SIZE):
+    if size <= 0 or size & (size - 1):
+      raise InvalidResourceError('TLB size must be a power of two: size=%d' % size)
+
+    self.size = size
+    self.mask = size - 1
+
+    self.sets = [[None] * size for _ in range(0, TLB_PRIVILEGED + 1)]
+
+    self.misses  = 0
+    self.flushes = 0
+
+  def flush(self):
+    """
+    Drop all entries.
+    """
+
+    self.flushes += 1
+    self.sets = [[None] * self.size for _ in range(0, TLB_PRIVILEGED + 1)]
+
+  def invalidate(self, pg_index):
+    """
+    Drop all entries of a single page.
+
+    :param int pg_index: index of page.
+    """
+
+    slot = pg_index & self.mask
+
+    for entries in self.sets:
+      entry = entries[slot]
+
+      if entry is not None and entry[0] == pg_index:
+        entries[slot] = None
+
 class MMU(ISnapshotable):
   """
   Memory management unit (aka MMU) provides a single point handling all core's memory operations.
@@ -221,6 +301,8 @@ class MMU(ISnapshotable):
     :py:const:`ducky.cpu.DEFAULT_PT_ADDRESS` by default.
   :param bool cpu.pt-enabled: if set, CPU core will start with page table
     enabled. ``False`` by default.
+  :param int cpu.tlb-size: number of TLB slots for each kind of access.
+    :py:const:`ducky.cpu.DEFAULT_CORE_TLB_SIZE` by default.
   """
 
   def __init__(self, core, memory_controller):
@@ -232,10 +314,16 @@ class MMU(ISnapshotable):
     self.memory = memory_controller
 
     self.force_aligned_access = config.memory_force_aligned_access()
-    self.pt_address = config.cpu_pt_address()
+    self._pt_address = config.cpu_pt_address()
     self._pt_enabled = config.cpu_pt_enabled()
 
     self._pte_cache = {}
+    self._tlb = TLB(size = config.cpu_tlb_size())
+
+    self._coherence = core.cpu.machine.coherence
+
+    #: Memory access heatmap, see :py:mod:`ducky.heatmap`.
+    self._heatmap = None
 
     self.DEBUG = core.DEBUG
 
@@ -246,23 +334,51 @@ class MMU(ISnapshotable):
       self._instruction_cache = InstructionCache_Base(self)
 
     if config.cpu_page_cache() == 'full':
-      self._page_cache = [None for _ in range(0, self.memory.pages_cnt)]
+      self._page_cache = PageDirectory(self.memory.pages_cnt)
 
     else:
       self._page_cache = dict()
 
     self._set_access_methods()
 
+    self._coherence.register_mmu(self)
+
+    if self._pt_enabled is True:
+      self._coherence.update_pt_pages(source = self)
+
   def _get_pt_enabled(self):
     return self._pt_enabled
 
   def _set_pt_enabled(self, value):
+    if value != self._pt_enabled:
+      self.release_ptes()
+
+      # JIT-ed instructions captured memory-access methods of the old mode
+      if self.core.jit is True:
+        self._instruction_cache.clear()
+
     self._pt_enabled = value
 
     self._set_access_methods()
 
+    if value is True:
+      self._coherence.update_pt_pages(source = self)
+
   pt_enabled = property(_get_pt_enabled, _set_pt_enabled)
 
+  def _get_pt_address(self):
+    return self._pt_address
+
+  def _set_pt_address(self, address):
+    self._pt_address = address
+
+    self.release_ptes()
+
+    if self._pt_enabled is True:
+      self._coherence.update_pt_pages(source = self)
+
+  pt_address = property(_get_pt_address, _set_pt_address)
+
   def _debug_wrapper_read(self, reader, *args, **kwargs):
     self.core.debug.pre_memory(args[0], read = True)
 
@@ -285,6 +401,43 @@ class MMU(ISnapshotable):
 
     self.core.debug.post_memory(args[0], read = False)
 
+  def _heatmap_wrapper_read(self, reader, addr):
+    self._heatmap.sample(HEATMAP_READ, addr)
+
+    return reader(addr)
+
+  def _heatmap_wrapper_read_u32(self, reader, addr, not_execute = True):
+    if not_execute is True:
+      self._heatmap.sample(HEATMAP_READ, addr)
+
+    return reader(addr, not_execute = not_execute)
+
+  def _heatmap_wrapper_write(self, writer, addr, value):
+    self._heatmap.sample(HEATMAP_WRITE, addr)
+
+    return writer(addr, value)
+
+  def _heatmap_wrapper_fetch(self, fetch, addr):
+    self._heatmap.sample(HEATMAP_FETCH, addr)
+
+    return fetch(addr)
+
+  def set_heatmap(self, heatmap):
+    """
+    Start or stop counting memory accesses.
+
+    :param ducky.heatmap.MemoryHeatmap heatmap: heatmap to update, or ``None``
+      to stop counting.
+    """
+
+    self._heatmap = heatmap
+
+    # JIT-ed instructions captured memory-access methods
+    if self.core.jit is True:
+      self._instruction_cache.clear()
+
+    self._set_access_methods()
+
   def _set_access_methods(self):
     """
     Set parent core's memory-access methods to proper shortcuts. Methods named
@@ -315,6 +468,15 @@ class MMU(ISnapshotable):
     else:
       __set_methods('nopt')
 
+    def __wrap_heatmap():
+      self.core.MEM_IN8   = partial(self._heatmap_wrapper_read,     self.core.MEM_IN8)
+      self.core.MEM_IN16  = partial(self._heatmap_wrapper_read,     self.core.MEM_IN16)
+      self.core.MEM_IN32  = partial(self._heatmap_wrapper_read_u32, self.core.MEM_IN32)
+      self.core.MEM_OUT8  = partial(self._heatmap_wrapper_write,    self.core.MEM_OUT8)
+      self.core.MEM_OUT16 = partial(self._heatmap_wrapper_write,    self.core.MEM_OUT16)
+      self.core.MEM_OUT32 = partial(self._heatmap_wrapper_write,    self.core.MEM_OUT32)
+      self.core.fetch_instr = partial(self._heatmap_wrapper_fetch,  self.core.fetch_instr)
+
     if self.core.debug is not None:
       __wrap_debug()
 
@@ -322,33 +484,145 @@ class MMU(ISnapshotable):
     self._get_pg_ops = self._get_pg_ops_list if self.core.cpu.machine.config.get('cpu', 'page-cache', 'simple') == 'full' else self._get_pg_ops_dict
     self.core.fetch_instr = self._instruction_cache.__getitem__
 
+    if self._heatmap is not None:
+      __wrap_heatmap()
+
   def reset(self):
     """
     Reset MMU. PT will be disabled, and all internal caches will be flushed.
     """
 
-    self._instruction_cache.clear()
+    self.pt_enabled = False
+    self.flush_caches()
 
-    if isinstance(self._page_cache, list):
-      for i in range(0, self.memory.pages_cnt):
-        self._page_cache[i] = None
-    else:
-      self._page_cache.clear()
+  def flush_caches(self):
+    """
+    Flush all internal caches - PTE cache, TLB, page cache and instruction
+    cache.
+    """
 
-    self.pt_enabled = False
-    self._pte_cache = {}
+    self.DEBUG('%s.flush_caches', self.__class__.__name__)
+
+    self._instruction_cache.clear()
+    self._page_cache.clear()
+
+    self.release_ptes()
 
   def halt(self):
     pass
 
   def release_ptes(self):
     """
-    Clear internal PTE cache.
+    Clear internal PTE cache, and flush TLB.
     """
 
     self.DEBUG('%s.release_ptes', self.__class__.__name__)
 
     self._pte_cache = {}
+    self._tlb.flush()
+
+  def invalidate_ptes(self, pg_index, count = 1):
+    """
+    Drop cached PTEs and TLB entries of a range of pages, e.g. when their PTEs
+    were modified.
+
+    :param int pg_index: index of the first page.
+    :param int count: number of pages.
+    """
+
+    self.DEBUG('%s.invalidate_ptes: pg=%s, count=%s', self.__class__.__name__, pg_index, count)
+
+    pte_cache, tlb = self._pte_cache, self._tlb
+
+    for i in range(max(0, pg_index), min(pg_index + count, self.memory.pages_cnt)):
+      pte_cache.pop(i, None)
+      tlb.invalidate(i)
+
+  def invalidate_page_ops(self, pg_index):
+    """
+    Drop cached accessors of a page, from both page cache and TLB.
+
+    :param int pg_index: index of page.
+    """
+
+    self._page_cache.pop(pg_index, None)
+
+    self._tlb.invalidate(pg_index)
+
+  def invalidate_instructions(self, index, count = 1):
+    """
+    Drop cached instructions.
+
+    :param int index: index of the first instruction, i.e. its address divided
+      by 4.
+    :param int count: number of instructions.
+    """
+
+    icache = self._instruction_cache
+
+    for i in range(index, index + count):
+      icache.invalidate(i)
+
+  def invalidate_page(self, pg_index):
+    """
+    Drop all cached information about a page - its PTE, accessors and
+    instructions.
+
+    :param int pg_index: index of page.
+    """
+
+    self.invalidate_ptes(pg_index)
+    self.invalidate_page_ops(pg_index)
+    self.invalidate_instructions((pg_index * PAGE_SIZE) >> 2, PAGE_SIZE >> 2)
+
+  def _watched_writer(self, writer, base_address, width):
+    """
+    Wrap write method of a watched page, to report every write to coherence
+    bus.
+    """
+
+    coherence = self._coherence
+
+    def __write(offset, value):
+      writer(offset, value)
+      coherence.memory_written(base_address + offset, width, source = self)
+
+    return __write
+
+  def _dirty_writer(self, writer, pg_index):
+    """
+    Wrap write method of a page, to record the page as dirty when memory
+    controller tracks dirty pages.
+    """
+
+    memory = self.memory
+
+    def __write(offset, value):
+      writer(offset, value)
+      memory.dirty_pages.add(pg_index)
+
+    return __write
+
+  def _page_ops(self, pg):
+    """
+    Create tuple of page's read and write methods. If the page is watched by
+    coherence bus, write methods are wrapped to report writes. If memory
+    controller tracks dirty pages, write methods are wrapped to record them.
+
+    :param ducky.mm.MemoryPage pg: page.
+    """
+
+    writers = (pg.write_u8, pg.write_u16, pg.write_u32)
+
+    if pg.index in self._coherence.watched_pages:
+      writers = (self._watched_writer(writers[0], pg.base_address, 1),
+                 self._watched_writer(writers[1], pg.base_address, 2),
+                 self._watched_writer(writers[2], pg.base_address, 4))
+
+    if self.memory.dirty_pages is not None:
+      writers = tuple([self._dirty_writer(writer, pg.index) for writer in writers])
+
+    return (pg.read_u8, pg.read_u16, pg.read_u32) + writers
 
   def _get_pte(self, addr):
     """
@@ -369,55 +643,80 @@ class MMU(ISnapshotable):
     else:
       pte = self._pte_cache[pg_index]
 
-    self.DEBUG('%s._get_pte: pte=%s,%s', pte.to_string(), pte.to_int())
+    self.DEBUG('%s._get_pte: pte=%s,%s', self.__class__.__name__, pte.to_string(), pte.to_int())
 
     return pte
 
-  def _check_access(self, access, addr, align = None):
+  def _tlb_fill(self, entries, access, addr, pg_index):
     """
-    Check attempted access against several criteria:
+    Handle TLB miss. Unless the access is privileged, it is checked against
+    corresponding PTE, and when granted, accessors of the page are stored in
+    the TLB.
 
-     - PT is enabled - disabled PT implies different set of read/write methods
-       that don't use this method to check access
-     - access alignment if correct alignment is required
-     - privileged access implies granted access
-     - corresponding PTE settings
+    Instruction fetch requires both read and execute access.
 
-    :param access: ``read``, ``write`` or ``execute``.
+    :param list entries: TLB set the access missed.
+    :param int access: ``TLB_READ``, ``TLB_WRITE`` or ``TLB_EXECUTE``.
     :param int addr: memory address.
-    :param int align: if set, operation is expected to be aligned to this boundary.
-    :raises ducky.errors.UnalignedAccessError: when unaligned access is not
-      allowed, but requested.
+    :param int pg_index: index of page ``addr`` belongs to.
+    :returns: read and write methods of the page.
     :raises ducky.errors.MemoryAccessError: when access is denied.
     """
 
-    self.DEBUG('%s._check_access: access=%s, addr=%s, align=%s', self.__class__.__name__, access, UINT32_FMT(addr), align)
+    self.DEBUG('%s._tlb_fill: access=%s, addr=%s', self.__class__.__name__, access, UINT32_FMT(addr))
 
-    if self.force_aligned_access is True and align is not None and addr % align:
-      raise UnalignedAccessError(core = self.core)
+    tlb = self._tlb
+    tlb.misses += 1
 
-    pg_index = (addr & PAGE_MASK) >> PAGE_SHIFT
+    if entries is not tlb.sets[TLB_PRIVILEGED]:
+      pte = self._get_pte(addr)
+
+      if access == TLB_EXECUTE and pte.read is not True:
+        raise MemoryAccessError('read', addr, pte)
 
-    if self.core.privileged is True:
-      return self.memory.get_page(pg_index)
+      if getattr(pte, TLB_ACCESS_NAMES[access]) is not True:
+        raise MemoryAccessError(TLB_ACCESS_NAMES[access], addr, pte)
 
-    pte = self._get_pte(addr)
+    ops = self._page_ops(self.memory.get_page(pg_index))
 
-    if getattr(pte, access) is True:
-      return self.memory.get_page(pg_index)
+    entries[pg_index & tlb.mask] = (pg_index, ops)
 
-    raise MemoryAccessError(access, addr, pte)
+    return ops
+
+  def _get_pg_ops_tlb(self, access, addr):
+    """
+    Find read and write methods of the page, with access already checked.
+
+    :param int access: ``TLB_READ``, ``TLB_WRITE`` or ``TLB_EXECUTE``.
+    :param int addr: memory address.
+    :raises ducky.errors.MemoryAccessError: when access is denied.
+    """
+
+    pg_index = addr >> PAGE_SHIFT
+    tlb = self._tlb
+
+    entries = tlb.sets[TLB_PRIVILEGED if self.core.privileged is True else access]
+    entry = entries[pg_index & tlb.mask]
+
+    if entry is not None and entry[0] == pg_index:
+      return entry[1]
+
+    return self._tlb_fill(entries, access, addr, pg_index)
 
   def _get_pg_ops_list(self, address):
     pg_index = address >> PAGE_SHIFT
     pg_cache = self._page_cache
 
-    ops = pg_cache[pg_index]
-    if ops is not None:
-      return ops
+    # Inlined PageDirectory.get
+    table = pg_cache.tables[pg_index >> pg_cache.shift] if pg_index < pg_cache.size else None
+
+    if table is not None:
+      ops = table[pg_index & pg_cache.mask]
 
-    pg = self.memory.get_page(pg_index)
-    pg_cache[pg_index] = ops = (pg.read_u8, pg.read_u16, pg.read_u32, pg.write_u8, pg.write_u16, pg.write_u32)
+      if ops is not None:
+        return ops
+
+    pg_cache[pg_index] = ops = self._page_ops(self.memory.get_page(pg_index))
 
     return ops
 
@@ -428,8 +727,7 @@ class MMU(ISnapshotable):
     if pg_index in pg_cache:
       return pg_cache[pg_index]
 
-    pg = self.memory.get_page(pg_index)
-    pg_cache[pg_index] = ops = (pg.read_u8, pg.read_u16, pg.read_u32, pg.write_u8, pg.write_u16, pg.write_u32)
+    pg_cache[pg_index] = ops = self._page_ops(self.memory.get_page(pg_index))
 
     return ops
 
@@ -445,6 +743,9 @@ class MMU(ISnapshotable):
 
     core = self.core
 
+    if addr >> PAGE_SHIFT not in self._coherence.code_pages:
+      self._coherence.add_code_page(addr >> PAGE_SHIFT, source = self)
+
     inst, desc, opcode = core.decode_instr(core.MEM_IN32(addr, not_execute = False))
     return inst, opcode, partial(desc.execute, core, inst)
 
@@ -460,6 +761,9 @@ class MMU(ISnapshotable):
 
     core = self.core
 
+    if addr >> PAGE_SHIFT not in self._coherence.code_pages:
+      self._coherence.add_code_page(addr >> PAGE_SHIFT, source = self)
+
     inst, desc, opcode = core.decode_instr(core.MEM_IN32(addr, not_execute = False))
 
     fn = desc.jit(core, inst)
@@ -504,37 +808,38 @@ class MMU(ISnapshotable):
   def _pt_read_u8(self, addr):
     self.DEBUG('MMU._pt_read_u8: addr=%s', UINT32_FMT(addr))
 
-    return self._check_access('read', addr).read_u8(addr & (PAGE_SIZE - 1))
+    return self._get_pg_ops_tlb(TLB_READ, addr)[0](addr & ~PAGE_MASK)
 
   def _pt_read_u16(self, addr):
     self.DEBUG('MMU._pt_read_u16: addr=%s', UINT32_FMT(addr))
 
-    return self._check_access('read', addr, align = 2).read_u16(addr & (PAGE_SIZE - 1))
+    if self.force_aligned_access is True and addr & 1:
+      raise UnalignedAccessError(core = self.core)
+
+    return self._get_pg_ops_tlb(TLB_READ, addr)[1](addr & ~PAGE_MASK)
 
   def _pt_read_u32(self, addr, not_execute = True):
     self.DEBUG('MMU._pt_read_u32: addr=%s', UINT32_FMT(addr))
 
-    pg = self._check_access('read', addr, align = 4)
-
-    if not_execute is not True:
-      pg = self._check_access('execute', addr)
+    if self.force_aligned_access is True and addr & 3:
+      raise UnalignedAccessError(core = self.core)
 
-    return pg.read_u32(addr & (PAGE_SIZE - 1))
+    return self._get_pg_ops_tlb(TLB_READ if not_execute is True else TLB_EXECUTE, addr)[2](addr & ~PAGE_MASK)
 
   def _pt_write_u8(self, addr, value):
     self.DEBUG('MMU._pt_write_u8: addr=%s, value=%s', UINT32_FMT(addr), UINT8_FMT(value))
 
-    return self._check_access('write', addr).write_u8(addr & (PAGE_SIZE - 1), value)
+    return self._get_pg_ops_tlb(TLB_WRITE, addr)[3](addr & ~PAGE_MASK, value)
 
   def _pt_write_u16(self, addr, value):
     self.DEBUG('MMU._pt_write_u16: addr=%s, value=%s', UINT32_FMT(addr), UINT16_FMT(value))
 
-    return self._check_access('write', addr).write_u16(addr & (PAGE_SIZE - 1), value)
+    return self._get_pg_ops_tlb(TLB_WRITE, addr)[4](addr & ~PAGE_MASK, value)
 
   def _pt_write_u32(self, addr, value):
     self.DEBUG('MMU._pt_write_u32: addr=%s, value=%s', UINT32_FMT(addr), UINT32_FMT(value))
 
-    return self._check_access('write', addr).write_u32(addr & (PAGE_SIZE - 1), value)
+    return self._get_pg_ops_tlb(TLB_WRITE, addr)[5](addr & ~PAGE_MASK, value)
 
 class CPUCore(ISnapshotable, IMachineWorker):
   """
@@ -557,6 +862,7 @@ class CPUCore(ISnapshotable, IMachineWorker):
     config.memory_force_aligned_access = partial(config.getbool, 'memory', 'force-aligned-access', default = False)
     config.cpu_pt_address = partial(config.getint, 'cpu', 'pt-address', default = DEFAULT_PT_ADDRESS)
     config.cpu_pt_enabled = partial(config.getbool, 'cpu', 'pt-enabled', default = False)
+    config.cpu_tlb_size = partial(config.getint, 'cpu', 'tlb-size', default = DEFAULT_CORE_TLB_SIZE)
     config.cpu_instr_cache = partial(config.get, 'cpu', 'instr-cache', default = 'simple')
     config.cpu_page_cache = partial(config.get, 'cpu', 'page-cache', default = 'simple')
 
@@ -586,6 +892,14 @@ class CPUCore(ISnapshotable, IMachineWorker):
 
     self.debug = None
 
+    if cpu.machine.smp_threads is True:
+      from ..smp import CoreThread
+      self.thread = self.executor = CoreThread(self)
+
+    else:
+      self.thread = None
+      self.executor = cpu.machine.reactor
+
     self.mmu = MMU(self, memory_controller)
 
     self.registers = registers.RegisterSet()
@@ -675,16 +989,14 @@ class CPUCore(ISnapshotable, IMachineWorker):
     self.flags = CoreFlags.from_int(state.flags)
 
     for i, reg in enumerate(REGISTER_NAMES):
-      self.registers[reg] = state.registers[i]
+      self.registers[i] = state.registers[i]
 
     self.evt_address = state.evt_address
     self.mmu.pt_address = state.pt_address
     self.mmu.pt_enabled = state.pt_enabled
 
     self.exit_code = state.exit_code
-    self.idle = state.idle
-    self.alive = state.alive
-    self.running = state.running
+    self.change_runnable_state(alive = state.alive, running = state.running, idle = state.idle)
 
     if self.has_coprocessor('math'):
       self.math_coprocessor.load_state(state.get_children()['math_coprocessor'])
@@ -1001,6 +1313,31 @@ class CPUCore(ISnapshotable, IMachineWorker):
 
     self.change_runnable_state(idle = False)
 
+  def deliver_irq(self, index):
+    """
+    Deliver hardware interrupt to this core. When core runs in its own thread,
+    interrupt is handed over to this thread, and it's entered between two
+    instructions. Otherwise, :py:meth:`ducky.cpu.CPUCore.irq` is called
+    directly.
+
+    :param int index: exception ID - EVT index
+    """
+
+    if self.thread is None:
+      self.irq(index)
+      return
+
+    self.thread.add_call(self._deliver_threaded_irq, index)
+
+  def _deliver_threaded_irq(self, index):
+    # Core could have disabled interrupts before it got to this call - return
+    # interrupt to the router, it will find another core.
+    if self.hwint_allowed is not True:
+      self.cpu.machine.trigger_irq_index(index)
+      return
+
+    self.irq(index)
+
   def __get_flags(self):
     return CoreFlags.create(privileged = self.privileged, hwint_allowed = self.hwint_allowed, equal = self.arith_equal, zero = self.arith_zero, overflow = self.arith_overflow, sign = self.arith_sign)
 
@@ -1093,10 +1430,10 @@ class CPUCore(ISnapshotable, IMachineWorker):
 
     if old_state != new_state:
       if new_state is True:
-        self.cpu.machine.reactor.task_runnable(self)
+        self.executor.task_runnable(self)
 
       else:
-        self.cpu.machine.reactor.task_suspended(self)
+        self.executor.task_suspended(self)
 
   def suspend(self):
     self.DEBUG('CPUCore.suspend')
@@ -1131,7 +1468,7 @@ class CPUCore(ISnapshotable, IMachineWorker):
 
     log_cpu_core_state(self)
 
-    self.cpu.machine.reactor.remove_task(self)
+    self.executor.remove_task(self)
 
     self.cpu.machine.tenh('%r: CPU core halted', self)
 
@@ -1152,7 +1489,7 @@ class CPUCore(ISnapshotable, IMachineWorker):
 
     log_cpu_core_state(self)
 
-    self.cpu.machine.reactor.add_task(self)
+    self.executor.add_task(self)
     self.change_runnable_state(alive = True, running = True)
     self.cpu.machine.events.trigger('on-core-alive', self)
     self.cpu.machine.events.trigger('on-core-running', self)
@@ -1222,8 +1559,9 @@ class CPU(ISnapshotable, IMachineWorker):
     if core.cpu != self:
       return
 
-    self.halted_cores.remove(core)
-    self.living_cores.append(core)
+    with self.machine.lock:
+      self.halted_cores.remove(core)
+      self.living_cores.append(core)
 
   def on_core_halted(self, core):
     """
@@ -1235,8 +1573,9 @@ class CPU(ISnapshotable, IMachineWorker):
     if core.cpu != self:
       return
 
-    self.living_cores.remove(core)
-    self.halted_cores.append(core)
+    with self.machine.lock:
+      self.living_cores.remove(core)
+      self.halted_cores.append(core)
 
   def on_core_running(self, core):
     """
@@ -1248,8 +1587,9 @@ class CPU(ISnapshotable, IMachineWorker):
     if core.cpu != self:
       return
 
-    self.suspended_cores.remove(core)
-    self.running_cores.append(core)
+    with self.machine.lock:
+      self.suspended_cores.remove(core)
+      self.running_cores.append(core)
 
   def on_core_suspended(self, core):
     """
@@ -1261,19 +1601,20 @@ class CPU(ISnapshotable, IMachineWorker):
     if core.cpu != self:
       return
 
-    self.running_cores.remove(core)
-    self.suspended_cores.append(core)
+    with self.machine.lock:
+      self.running_cores.remove(core)
+      self.suspended_cores.append(core)
 
   def suspend(self):
     self.DEBUG('CPU.suspend')
 
-    for core in self.running_cores:
+    for core in self.running_cores[:]:
       core.suspend()
 
   def wake_up(self):
     self.DEBUG('CPU.wake_up')
 
-    for core in self.suspended_cores:
+    for core in self.suspended_cores[:]:
       core.wake_up()
 
   def die(self, exc):
@@ -1286,7 +1627,7 @@ class CPU(ISnapshotable, IMachineWorker):
   def halt(self):
     self.DEBUG('CPU.halt')
 
-    for core in self.living_cores:
+    for core in self.living_cores[:]:
       core.halt()
 
     self.machine.events.remove_listener('on-core-alive', self.on_core_alive)
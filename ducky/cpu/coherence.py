@@ -0,0 +1,331 @@
+"""
+Cache coherence service.
+
+Each CPU core keeps its private caches - PTE cache, TLB, page cache and
+instruction cache. When the state these caches mirror changes - page table is
+modified, memory page is mapped or unmapped, code is overwritten - caches of
+all cores must drop affected entries.
+
+Invalidations are collected for each core, and the whole batch is applied by
+core's executor at the next dispatch boundary, i.e. between two instructions,
+without stopping other cores. Core that caused the invalidation, if there is
+such core, applies it immediately.
+
+To notice writes into page tables and into code, pages holding page tables or
+instructions are *watched* - cores wrap write methods of such pages, and every
+write is reported to the bus.
+"""
+
+import threading
+
+from six.moves import range
+
+from ..mm import PAGE_SHIFT, PAGE_SIZE
+
+class PendingInvalidations(object):
+  """
+  Batch of invalidations waiting to be applied by a single core.
+  """
+
+  def __init__(self):
+    self.full = False
+    self.ptes = set()
+    self.pages = set()
+    self.page_ops = set()
+    self.instructions = set()
+    self.scheduled = False
+
+class CoherenceBus(object):
+  """
+  Machine-wide invalidation bus, delivering invalidation requests to MMUs of
+  all cores.
+
+  :param ducky.machine.Machine machine: machine this bus belongs to.
+  """
+
+  def __init__(self, machine):
+    super(CoherenceBus, self).__init__()
+
+    self.machine = machine
+
+    self.lock = threading.RLock()
+
+    self.mmus = []
+    self.pending = {}
+
+    #: Pages holding page table of at least one core.
+    self.pt_pages = set()
+
+    #: Pages instructions were fetched from.
+    self.code_pages = set()
+
+    #: Union of ``pt_pages`` and ``code_pages`` - writes into these pages are
+    #: reported to the bus.
+    self.watched_pages = set()
+
+    self.pte_invalidations = 0
+    self.page_invalidations = 0
+    self.instruction_invalidations = 0
+    self.full_invalidations = 0
+    self.batches = 0
+
+  def register_mmu(self, mmu):
+    """
+    Start delivering invalidations to a MMU.
+
+    :param ducky.cpu.MMU mmu: new recipient.
+    """
+
+    with self.lock:
+      self.mmus = self.mmus + [mmu]
+      self.pending[mmu] = PendingInvalidations()
+
+  def _post(self, source, update):
+    """
+    Add invalidation to batches of all cores except ``source``, and make sure
+    their executors will apply these batches.
+    """
+
+    for mmu in self.mmus:
+      if mmu is source:
+        continue
+
+      with self.lock:
+        pending = self.pending[mmu]
+        update(pending)
+
+        if pending.scheduled is True:
+          continue
+
+        pending.scheduled = True
+
+      mmu.core.executor.add_call(self.apply, mmu)
+
+  def apply(self, mmu):
+    """
+    Apply batch of invalidations collected for a MMU.
+
+    :param ducky.cpu.MMU mmu: MMU whose caches are invalidated.
+    """
+
+    with self.lock:
+      pending = self.pending[mmu]
+      self.pending[mmu] = PendingInvalidations()
+      self.batches += 1
+
+    mmu.DEBUG('%s.apply: full=%s, ptes=%s, pages=%s, instructions=%s', self.__class__.__name__, pending.full, len(pending.ptes), len(pending.pages), len(pending.instructions))
+
+    if pending.full is True:
+      mmu.flush_caches()
+      return
+
+    for pg_index in pending.ptes:
+      mmu.invalidate_ptes(pg_index)
+
+    for pg_index in pending.pages:
+      mmu.invalidate_page(pg_index)
+
+    for pg_index in pending.page_ops:
+      mmu.invalidate_page_ops(pg_index)
+
+    for index in pending.instructions:
+      mmu.invalidate_instructions(index)
+
+  def invalidate_all(self, source = None):
+    """
+    Full shootdown - all caches of all cores are flushed.
+
+    :param ducky.cpu.MMU source: if set, this MMU is flushed immediately.
+    """
+
+    self.machine.DEBUG('%s.invalidate_all', self.__class__.__name__)
+
+    self.full_invalidations += 1
+
+    if source is not None:
+      source.flush_caches()
+
+    def __update(pending):
+      pending.full = True
+
+    self._post(source, __update)
+
+  def invalidate_pages(self, pg_index, count = 1, source = None):
+    """
+    Page-range shootdown - all cached information about pages, e.g. their
+    PTEs, accessors or instructions, are dropped. Used when pages are replaced,
+    e.g. when a file is mapped into memory.
+
+    :param int pg_index: index of the first page.
+    :param int count: number of pages.
+    :param ducky.cpu.MMU source: if set, this MMU is invalidated immediately.
+    """
+
+    self.machine.DEBUG('%s.invalidate_pages: pg=%s, count=%s', self.__class__.__name__, pg_index, count)
+
+    self.page_invalidations += count
+
+    pages = range(pg_index, pg_index + count)
+
+    if source is not None:
+      for i in pages:
+        source.invalidate_page(i)
+
+    def __update(pending):
+      pending.pages.update(pages)
+
+    self._post(source, __update)
+
+  def invalidate_pages_now(self, pg_index, count = 1):
+    """
+    Page-range shootdown applied to all cores immediately, without waiting for
+    their next dispatch boundary. Caller must run in the same thread as all
+    cores, e.g. in reactor's thread when cores do not run in their own threads.
+
+    :param int pg_index: index of the first page.
+    :param int count: number of pages.
+    """
+
+    self.machine.DEBUG('%s.invalidate_pages_now: pg=%s, count=%s', self.__class__.__name__, pg_index, count)
+
+    self.page_invalidations += count
+
+    for mmu in self.mmus:
+      for i in range(pg_index, pg_index + count):
+        mmu.invalidate_page(i)
+
+  def invalidate_ptes(self, mmu, pg_index, count = 1, source = None):
+    """
+    Drop cached PTEs and TLB entries of a range of pages.
+
+    :param ducky.cpu.MMU mmu: MMU whose page table has been modified.
+    :param int pg_index: index of the first page.
+    :param int count: number of pages.
+    :param ducky.cpu.MMU source: MMU that modified the page table.
+    """
+
+    self.pte_invalidations += count
+
+    pages = range(pg_index, pg_index + count)
+
+    if mmu is source:
+      for i in pages:
+        mmu.invalidate_ptes(i)
+
+      return
+
+    with self.lock:
+      pending = self.pending[mmu]
+      pending.ptes.update(pages)
+
+      if pending.scheduled is True:
+        return
+
+      pending.scheduled = True
+
+    mmu.core.executor.add_call(self.apply, mmu)
+
+  def invalidate_instructions(self, address, size, source = None):
+    """
+    Drop cached instructions, e.g. when code has been overwritten.
+
+    :param int address: address of the first modified byte.
+    :param int size: number of modified bytes.
+    :param ducky.cpu.MMU source: if set, this MMU is invalidated immediately.
+    """
+
+    indices = range(address >> 2, ((address + size - 1) >> 2) + 1)
+
+    self.instruction_invalidations += len(indices)
+
+    if source is not None:
+      for index in indices:
+        source.invalidate_instructions(index)
+
+    def __update(pending):
+      pending.instructions.update(indices)
+
+    self._post(source, __update)
+
+  def memory_written(self, address, size, source = None):
+    """
+    Report write into a watched page.
+
+    :param int address: address of the first modified byte.
+    :param int size: number of modified bytes.
+    :param ducky.cpu.MMU source: MMU that performed the write.
+    """
+
+    pg_index = address >> PAGE_SHIFT
+
+    if pg_index in self.pt_pages:
+      for mmu in self.mmus:
+        if mmu.pt_enabled is not True:
+          continue
+
+        first, last = max(address - mmu.pt_address, 0), min(address + size - mmu.pt_address, mmu.memory.pages_cnt)
+
+        if first < last:
+          self.invalidate_ptes(mmu, first, last - first, source = source)
+
+    if pg_index in self.code_pages:
+      self.invalidate_instructions(address, size, source = source)
+
+  def _watch_pages(self, pages, source = None):
+    """
+    Start watching pages. Accessors of these pages are dropped from all cores,
+    to let them wrap page write methods.
+    """
+
+    with self.lock:
+      pages = [pg_index for pg_index in pages if pg_index not in self.watched_pages]
+      self.watched_pages.update(pages)
+
+    if not pages:
+      return
+
+    self.machine.DEBUG('%s._watch_pages: pages=%s', self.__class__.__name__, pages)
+
+    if source is not None:
+      for pg_index in pages:
+        source.invalidate_page_ops(pg_index)
+
+    def __update(pending):
+      pending.page_ops.update(pages)
+
+    self._post(source, __update)
+
+  def add_code_page(self, pg_index, source = None):
+    """
+    Mark page as containing code - writes into this page will then invalidate
+    cached instructions.
+
+    :param int pg_index: page index.
+    :param ducky.cpu.MMU source: MMU that fetched instructions from the page.
+    """
+
+    with self.lock:
+      self.code_pages.add(pg_index)
+
+    self._watch_pages([pg_index], source = source)
+
+  def update_pt_pages(self, source = None):
+    """
+    Recompute set of pages holding page tables, e.g. when core changed address
+    of its page table.
+
+    :param ducky.cpu.MMU source: MMU that changed its page table.
+    """
+
+    pt_pages = set()
+
+    for mmu in self.mmus:
+      if mmu.pt_enabled is not True:
+        continue
+
+      pt_pages.update(range(mmu.pt_address >> PAGE_SHIFT, ((mmu.pt_address + mmu.memory.pages_cnt + PAGE_SIZE - 1) >> PAGE_SHIFT)))
+
+    with self.lock:
+      self.pt_pages = pt_pages
+
+    self._watch_pages(pt_pages, source = source)
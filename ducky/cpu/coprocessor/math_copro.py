@@ -81,8 +81,7 @@ class RegisterSet(ISnapshotable):
   def load_state(self, state):
     self.DEBUG('RegisterSet.load_state')
 
-    for lr in state.depth:
-      self.stack.append(u64_t(lr))
+    self.stack = [u64_t(lr) for lr in state.stack]
 
   def push(self, v):
     """
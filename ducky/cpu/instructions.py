@@ -617,7 +617,7 @@ class IPI(Descriptor_R_RI):
     cpuid = core.registers[inst.reg1]
     cpuid, coreid = cpuid >> 16, cpuid & 0xFFFF
 
-    core.cpu.machine.cpus[cpuid].cores[coreid].irq(RI_VAL(core, inst, 'reg2'))
+    core.cpu.machine.cpus[cpuid].cores[coreid].deliver_irq(RI_VAL(core, inst, 'reg2'))
 
 class RETINT(Descriptor):
   mnemonic = 'retint'
@@ -2716,16 +2716,18 @@ class CAS(Descriptor):
     core.arith_equal = False
 
     addr = core.registers[inst.reg1]
-    actual_value = core.MEM_IN32(core.registers[inst.reg1])
 
-    core.DEBUG('CAS.execute: value=%s', UINT32_FMT(actual_value))
+    with core.mmu.memory.atomic_lock:
+      actual_value = core.MEM_IN32(addr)
 
-    if actual_value == core.registers[inst.reg2]:
-      core.MEM_OUT32(addr, core.registers[inst.reg3])
-      core.arith_equal = True
+      core.DEBUG('CAS.execute: value=%s', UINT32_FMT(actual_value))
 
-    else:
-      core.registers[inst.reg2] = actual_value
+      if actual_value == core.registers[inst.reg2]:
+        core.MEM_OUT32(addr, core.registers[inst.reg3])
+        core.arith_equal = True
+
+      else:
+        core.registers[inst.reg2] = actual_value
 
 class _LOAD(Descriptor):
   operands = 'r,a'
@@ -62,6 +62,17 @@ class Device(IMachineWorker):
     self.logger.debug('%s.halt', self.__class__.__name__)
     pass
 
+  def reattach(self):
+    """
+    Called in a new process, running a clone of the machine - see
+    :py:meth:`ducky.machine.Machine.clone`. Device should stop using
+    resources it shares with the original machine and other clones, e.g.
+    files it writes into.
+    """
+
+    self.logger.debug('%s.reattach', self.__class__.__name__)
+    pass
+
   def is_slave(self):
     return self.master is not None
 
@@ -93,6 +93,22 @@ class Frontend(DeviceFrontend):
 
     self._streams.append(stream)
 
+  def set_input(self, streams):
+    """
+    Replace all input streams, including the one being read.
+
+    :param list streams: new input streams.
+    """
+
+    self.machine.DEBUG('%s.set_input: streams=%s', self.__class__.__name__, streams)
+
+    for stream in streams:
+      if not stream.has_poll_support():
+        raise InvalidResourceError('Keyboard stream must support polling')
+
+    self._streams = list(streams)
+    self._open_input()
+
   def _close_input(self):
     self.machine.DEBUG('%s._close_input: input=%s', self.__class__.__name__, self._stream)
 
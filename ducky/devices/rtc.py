@@ -1,11 +1,9 @@
 import enum
-import time
 import datetime
 
 from . import Device, MMIOMemoryPage
 from ..errors import InvalidResourceError
 from ..mm import u8_t, UINT8_FMT, addr_to_page, u32_t, UINT32_FMT
-from ..reactor import RunInIntervalTask
 from ..hdt import HDTEntry_Device
 
 DEFAULT_IRQ  = 0x00
@@ -73,14 +71,17 @@ class RTCMMIOMemoryPage(MMIOMemoryPage):
 
     self.WARN('%s.write_u8: attempt to write unhandled MMIO offset: offset=%s, value=%s', self.__class__.__name__, UINT8_FMT(offset), UINT8_FMT(value))
 
-class RTCTask(RunInIntervalTask):
-  def __init__(self, machine, rtc):
-    super(RTCTask, self).__init__(50, self.on_tick)
+class RTCTask(object):
+  """
+  Triggers RTC interrupt ``frequency`` times per second, driven by a periodic
+  reactor timer.
+  """
 
+  def __init__(self, machine, rtc):
     self.machine = machine
     self.rtc = rtc
 
-    self.stamp = 0
+    self.timer = None
     self.tick = 0
 
     self.update_tick()
@@ -89,16 +90,21 @@ class RTCTask(RunInIntervalTask):
     self.tick = 1.0 / float(self.rtc.frequency)
     self.machine.DEBUG('rtc: new frequency: %i => %f' % (self.rtc.frequency, self.tick))
 
-  def on_tick(self, task):
-    stamp = time.time()
-    diff = stamp - self.stamp
-    self.machine.DEBUG('rtc: tick: stamp=%s, last=%s, diff=%s, tick=%s, ?=%s' % (stamp, self.stamp, diff, self.tick, diff < self.tick))
-    if diff < self.tick:
+    if self.timer is not None:
+      self.timer.interval = self.tick
+
+  def start(self):
+    self.timer = self.machine.reactor.call_periodic(self.tick, self.on_tick)
+
+  def stop(self):
+    if self.timer is None:
       return
 
-    self.machine.DEBUG('rtc: trigger irq')
+    self.timer.cancel()
+    self.timer = None
 
-    self.stamp = stamp
+  def on_tick(self):
+    self.machine.DEBUG('rtc: trigger irq')
 
     self.machine.trigger_irq(self.rtc)
 
@@ -147,8 +153,7 @@ class RTC(Device):
     self._mmio_page = RTCMMIOMemoryPage(self, self.machine.memory, addr_to_page(self._mmio_address))
     self.machine.memory.register_page(self._mmio_page)
 
-    self.machine.reactor.add_task(self.timer_task)
-    self.machine.reactor.task_runnable(self.timer_task)
+    self.timer_task.start()
 
     now = datetime.datetime.now()
 
@@ -156,4 +161,4 @@ class RTC(Device):
 
   def halt(self):
     self.machine.memory.unregister_page(self._mmio_page)
-    self.machine.reactor.remove_task(self.timer_task)
+    self.timer_task.stop()
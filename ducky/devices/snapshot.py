@@ -1,3 +1,7 @@
+import os
+import threading
+import time
+
 from . import Device
 
 class SnapshotStorage(Device):
@@ -16,23 +20,107 @@ class SnapshotStorage(Device):
 
 
 class FileSnapshotStorage(SnapshotStorage):
-  def __init__(self, machine, name, filepath = None, *args, **kwargs):
+  """
+  Saves snapshot of the machine into a file when machine halts.
+
+  With ``interval`` set, machine is checkpointed every ``interval`` seconds
+  while it runs. Machine is paused only to capture state of its cores, memory
+  pages are made copy-on-write, and the snapshot is written to the file by a
+  background thread while machine continues running.
+
+  :param str filepath: path to snapshot file.
+  :param str compression: compression of snapshot file.
+  :param float interval: number of seconds between checkpoints, ``0`` to
+    disable checkpoints.
+  """
+
+  def __init__(self, machine, name, filepath = None, compression = None, interval = None, *args, **kwargs):
     super(FileSnapshotStorage, self).__init__(machine, name, *args, **kwargs)
 
     self.filepath = filepath
+    self.compression = compression or 'none'
+    self.interval = interval or 0
+
+    self.checkpoint_timer = None
+    self.writer = None
+
+    self.checkpoints = 0
+    self.skipped_checkpoints = 0
+
+    #: Time the last checkpoint kept the machine paused, in seconds.
+    self.pause_time = 0.0
 
   @staticmethod
   def create_from_config(machine, config, section):
-    return FileSnapshotStorage(machine, section, filepath = config.get(section, 'filepath', None))
+    return FileSnapshotStorage(machine, section,
+                               filepath = config.get(section, 'filepath', None),
+                               compression = config.get(section, 'compression', None),
+                               interval = config.getfloat(section, 'interval', None))
 
   def save_snapshot(self, snapshot):
-    snapshot.save(self.filepath)
+    # Write into a temporary file first, to keep the previous snapshot intact
+    # until the new one is complete
+    tmp_filepath = self.filepath + '.tmp'
+
+    snapshot.save(tmp_filepath, compression = self.compression)
+    os.rename(tmp_filepath, self.filepath)
+
     self.machine.tenh('snapshot: saved in file %s', self.filepath)
 
+  def checkpoint(self):
+    """
+    Capture state of the machine, and start writing it into the file in a
+    background thread. When the previous checkpoint is still being written,
+    this one is skipped.
+    """
+
+    if self.writer is not None and self.writer.is_alive():
+      self.machine.DEBUG('snapshot: previous checkpoint not written yet')
+      self.skipped_checkpoints += 1
+      return
+
+    self.machine.DEBUG('snapshot: checkpoint')
+
+    # Pages can be made copy-on-write only when cores run in this thread
+    smp_threads = self.machine.smp_threads is True
+
+    stamp = time.time()
+    state = self.machine.capture_state(suspend = smp_threads, cow = not smp_threads)
+    self.pause_time = time.time() - stamp
+
+    self.checkpoints += 1
+
+    self.writer = threading.Thread(target = self.save_snapshot, args = (state,), name = 'ducky-checkpoint')
+    self.writer.daemon = True
+    self.writer.start()
+
+  def reattach(self):
+    """
+    Clone of the machine saves its snapshots into its own file, suffixed
+    by its PID.
+    """
+
+    self.filepath = '%s.%i' % (self.filepath, os.getpid())
+
+    # Writer thread did not survive the fork
+    self.writer = None
+
   def boot(self):
     self.machine.tenh('snapshot: storage ready, backed by file %s', self.filepath)
 
+    if self.interval > 0:
+      self.machine.tenh('snapshot: checkpoint every %s seconds', self.interval)
+
+      self.checkpoint_timer = self.machine.reactor.call_periodic(self.interval, self.checkpoint)
+
   def halt(self):
+    if self.checkpoint_timer is not None:
+      self.checkpoint_timer.cancel()
+      self.checkpoint_timer = None
+
+    if self.writer is not None:
+      self.writer.join()
+
     super(FileSnapshotStorage, self).halt()
 
     self.save_snapshot(self.machine.last_state)
@@ -40,4 +128,7 @@ class FileSnapshotStorage(SnapshotStorage):
 class DefaultFileSnapshotStorage(FileSnapshotStorage):
   @staticmethod
   def create_from_config(machine, config, section):
-    return DefaultFileSnapshotStorage(machine, section, filepath = 'ducky-snapshot.bin')
+    return DefaultFileSnapshotStorage(machine, section,
+                                      filepath = 'ducky-snapshot.bin',
+                                      compression = config.get(section, 'compression', None),
+                                      interval = config.getfloat(section, 'interval', None))
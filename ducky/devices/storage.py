@@ -124,6 +124,10 @@ class FileBackedStorage(Storage):
     self.filepath = filepath
     self.file = None
 
+    #: Blocks written by a clone of the machine, see
+    #: :py:meth:`ducky.devices.storage.FileBackedStorage.reattach`.
+    self.overlay = None
+
   @staticmethod
   def create_from_config(machine, config, section):
     return FileBackedStorage(machine, section, sid = config.getint(section, 'sid', None), filepath = config.get(section, 'filepath', None))
@@ -141,6 +145,21 @@ class FileBackedStorage(Storage):
     self.file.flush()
     self.file.close()
 
+  def reattach(self):
+    """
+    File is shared with other clones of the machine, therefore it's reopened
+    for reading only, and written blocks are kept in an overlay, private to
+    this clone.
+    """
+
+    self.machine.DEBUG('FileBackedStorage.reattach')
+
+    # Position in the file is shared with other processes
+    self.file.close()
+    self.file = open(self.filepath, 'rb')
+
+    self.overlay = {}
+
   if six.PY2:
     def _read(self, cnt):
       return bytearray([ord(c) for c in self.file.read(cnt)])
@@ -158,13 +177,33 @@ class FileBackedStorage(Storage):
   def do_read_blocks(self, start, cnt):
     self.machine.DEBUG('%s.do_read_blocks: start=%s, cnt=%s', self.__class__.__name__, start, cnt)
 
-    self.file.seek(start * BLOCK_SIZE)
+    if self.overlay is None:
+      self.file.seek(start * BLOCK_SIZE)
 
-    return self._read(cnt * BLOCK_SIZE)
+      return self._read(cnt * BLOCK_SIZE)
+
+    buff = bytearray()
+
+    for block in range(start, start + cnt):
+      data = self.overlay.get(block)
+
+      if data is None:
+        self.file.seek(block * BLOCK_SIZE)
+        data = self._read(BLOCK_SIZE)
+
+      buff += data
+
+    return buff
 
   def do_write_blocks(self, start, cnt, buff):
     self.machine.DEBUG('%s.do_write_blocks: start=%s, cnt=%s', self.__class__.__name__, start, cnt)
 
+    if self.overlay is not None:
+      for i in range(cnt):
+        self.overlay[start + i] = bytearray(buff[i * BLOCK_SIZE:(i + 1) * BLOCK_SIZE])
+
+      return
+
     self.file.seek(start * BLOCK_SIZE)
     self._write(buff)
     self.file.flush()
@@ -297,13 +336,12 @@ class BlockIO(Device):
   def buff_to_memory(self, addr, buff):
     self.DEBUG('%s.buff_to_memory: addr=%s', self.__class__.__name__, UINT32_FMT(addr))
 
-    for i in range(0, len(buff)):
-      self.machine.memory.write_u8(addr + i, buff[i])
+    self.machine.memory.write_block(addr, buff)
 
   def memory_to_buff(self, addr, length):
     self.DEBUG('%s.memory_to_buff: addr=%s, length=%s', self.__class__.__name__, UINT32_FMT(addr), length)
 
-    return bytearray([self.machine.memory.read_u8(addr + i) for i in range(0, length)])
+    return self.machine.memory.read_block(addr, length)
 
   def _flag_busy(self):
     """
@@ -15,7 +15,6 @@ from . import Device, MMIOMemoryPage
 from ..errors import InvalidResourceError
 from ..mm import PAGE_SIZE, ExternalMemoryPage, addr_to_page, u8_t
 from ..util import sizeof_fmt, F, UINT16_FMT, UINT32_FMT, UINT8_FMT
-from ..reactor import RunInIntervalTask
 from ..streams import OutputStream
 
 #: Default memory size, in bytes
@@ -27,6 +26,9 @@ DEFAULT_MEMORY_BANKS = 8
 #: Default MMIO address
 DEFAULT_MMIO_ADDRESS = 0x8100
 
+#: Default number of seconds between two display refreshes
+DEFAULT_REFRESH_INTERVAL = 0.1
+
 
 class SimpleVGAPorts(enum.IntEnum):
   CONTROL = 0x00
@@ -132,16 +134,32 @@ class Char(LittleEndianStructure):
   def from_u16(u):
     return Char.from_u8(u & 0x00FF, u >> 8)
 
-class DisplayRefreshTask(RunInIntervalTask):
-  def __init__(self, display):
-    super(DisplayRefreshTask, self).__init__(200, self.on_tick)
+class DisplayRefreshTask(object):
+  """
+  Redraws display every ``interval`` seconds, driven by a periodic reactor
+  timer.
+  """
 
+  def __init__(self, display, interval = None):
     self.display = display
+    self.interval = interval or DEFAULT_REFRESH_INTERVAL
     self.first_tick = True
 
+    self.timer = None
+
     self.write = display.stream_out.write
 
-  def on_tick(self, task):
+  def start(self):
+    self.timer = self.display.machine.reactor.call_periodic(self.interval, self.on_tick)
+
+  def stop(self):
+    if self.timer is None:
+      return
+
+    self.timer.cancel()
+    self.timer = None
+
+  def on_tick(self):
     self.display.machine.DEBUG('Display: refresh display')
 
     gpu = self.display.gpu
@@ -198,7 +216,7 @@ class DisplayRefreshTask(RunInIntervalTask):
       self.display.machine.WARN(F('Unhandled gpu mode: mode={mode}', mode = gpu.active_mode))
 
 class Display(Device):
-  def __init__(self, machine, name, gpu = None, stream_out = None, *args, **kwargs):
+  def __init__(self, machine, name, gpu = None, stream_out = None, refresh_interval = None, *args, **kwargs):
     super(Display, self).__init__(machine, 'display', name, *args, **kwargs)
 
     self.gpu = gpu
@@ -206,7 +224,7 @@ class Display(Device):
 
     self.gpu.master = self
 
-    self.refresh_task = DisplayRefreshTask(self)
+    self.refresh_task = DisplayRefreshTask(self, interval = refresh_interval)
 
   @staticmethod
   def get_slave_gpu(machine, config, section):
@@ -223,7 +241,7 @@ class Display(Device):
     gpu = Display.get_slave_gpu(machine, config, section)
     stream_out =  OutputStream.create(machine, config.get(section, 'stream_out', '<stdout>'))
 
-    return Display(machine, section, gpu = gpu, stream_out = stream_out)
+    return Display(machine, section, gpu = gpu, stream_out = stream_out, refresh_interval = config.getfloat(section, 'refresh-interval', DEFAULT_REFRESH_INTERVAL))
 
   def boot(self):
     self.machine.DEBUG('Display.boot')
@@ -231,8 +249,7 @@ class Display(Device):
     super(Display, self).boot()
 
     self.gpu.boot()
-    self.machine.reactor.add_task(self.refresh_task)
-    self.machine.reactor.task_runnable(self.refresh_task)
+    self.refresh_task.start()
 
     self.machine.tenh(F('display: generic {name} connected to gpu {gpu}, output stream {stream}', name = self.name, gpu = self.gpu.name, stream = self.stream_out))
 
@@ -241,7 +258,7 @@ class Display(Device):
 
     super(Display, self).halt()
 
-    self.machine.reactor.remove_task(self.refresh_task)
+    self.refresh_task.stop()
     self.gpu.halt()
 
     self.machine.DEBUG('Display: halted')
@@ -127,6 +127,24 @@ class StreamIOTerminal(Terminal):
       self._stream_out = stream_out
       self._output.set_output(stream_out)
 
+  def attach_streams(self, streams_in, stream_out):
+    """
+    Replace streams of a running terminal, e.g. to connect a clone of the
+    machine to its user. Previous streams are not closed, they may be still
+    used by other clones.
+
+    :param list streams_in: new input streams.
+    :param ducky.streams.OutputStream stream_out: new output stream.
+    """
+
+    self.machine.DEBUG('%s.attach_streams: streams_in=%s, stream_out=%s', self.__class__.__name__, streams_in, stream_out)
+
+    self._input.set_input(streams_in)
+    self._streams_in = streams_in
+
+    self._stream_out = stream_out
+    self._output.set_output(stream_out)
+
   @staticmethod
   def create_from_config(machine, config, section):
     input_device, output_device = get_slave_devices(machine, config, section)
@@ -0,0 +1,249 @@
+"""
+Memory access heatmap - sampling profiler counting reads, writes and
+instruction fetches of each memory page, and optionally of each 16-byte line.
+
+Heatmap is enabled and disabled at runtime, from console. While enabled, MMUs
+of all cores wrap their memory-access methods, in the same way they do when
+debugging is enabled. When heatmap is disabled, methods are restored, and
+there is no overhead at all.
+
+Counters are indexed by addresses cores use, i.e. by virtual addresses when
+page table is enabled. Accesses beyond the end of memory are not counted.
+When cores run in their own threads, some samples may be lost.
+"""
+
+import array
+
+from six.moves import range
+
+from .mm import PAGE_SHIFT, PAGE_SIZE
+from .util import str2int, UINT32_FMT
+
+#: Counter indices, one per kind of memory access.
+READ  = 0
+WRITE = 1
+FETCH = 2
+
+LINE_SHIFT = 4
+LINE_SIZE = 1 << LINE_SHIFT
+
+def _counters(size):
+  return [array.array('L', [0]) * size for _ in range(3)]
+
+class MemoryHeatmap(object):
+  """
+  Access counters of all memory pages.
+
+  :param ducky.machine.Machine machine: machine this heatmap belongs to.
+  :param bool lines: if set, accesses are counted for each line of
+    :py:data:`ducky.heatmap.LINE_SIZE` bytes, too.
+  :param int frequency: sampling frequency - only every ``frequency``-th
+    access is counted.
+  """
+
+  def __init__(self, machine, lines = False, frequency = 1):
+    super(MemoryHeatmap, self).__init__()
+
+    self.machine = machine
+    self.frequency = frequency
+
+    self.size = machine.memory.pages_cnt
+
+    self.pages = _counters(self.size)
+    self.lines = _counters(self.size * (PAGE_SIZE // LINE_SIZE)) if lines is True else None
+
+    self.countdown = frequency
+
+  def sample(self, kind, address):
+    """
+    Count memory access.
+
+    :param int kind: kind of access, one of :py:data:`ducky.heatmap.READ`,
+      :py:data:`ducky.heatmap.WRITE` or :py:data:`ducky.heatmap.FETCH`.
+    :param u32_t address: accessed address.
+    """
+
+    self.countdown -= 1
+
+    if self.countdown > 0:
+      return
+
+    self.countdown = self.frequency
+
+    index = address >> PAGE_SHIFT
+
+    if index >= self.size:
+      return
+
+    self.pages[kind][index] += 1
+
+    if self.lines is not None:
+      self.lines[kind][address >> LINE_SHIFT] += 1
+
+  def _entries(self, counters, shift):
+    reads, writes, fetches = counters
+
+    for index in range(len(reads)):
+      if reads[index] or writes[index] or fetches[index]:
+        yield index << shift, reads[index], writes[index], fetches[index]
+
+  def hot_pages(self, count = None):
+    """
+    Find the most accessed pages.
+
+    :param int count: if set, return only this many pages.
+    :returns: list of ``(address, reads, writes, fetches)`` tuples, sorted by
+      number of all accesses.
+    """
+
+    entries = sorted(self._entries(self.pages, PAGE_SHIFT), key = lambda entry: sum(entry[1:]), reverse = True)
+
+    return entries if count is None else entries[0:count]
+
+  def report(self, symbols = None, base = 0, count = 20):
+    """
+    Create table of the most accessed pages.
+
+    :param ducky.util.SymbolTable symbols: if set, addresses are mapped to
+      symbols.
+    :param u32_t base: address the binary of ``symbols`` was loaded to.
+    :param int count: number of pages.
+    :rtype: list
+    :returns: table, with the header in the first row.
+    """
+
+    table = [
+      ['Page', 'Symbol', 'Reads', 'Writes', 'Fetches']
+    ]
+
+    for address, reads, writes, fetches in self.hot_pages(count = count):
+      symbol = ''
+
+      if symbols is not None and address >= base:
+        name, offset = symbols[address - base]
+
+        if name is not None:
+          symbol = '%s+%s' % (name, UINT32_FMT(offset)) if offset else name
+
+      table.append([UINT32_FMT(address), symbol, reads, writes, fetches])
+
+    return table
+
+  def dump(self, filename):
+    """
+    Save all counters into a CSV file, for plotting. Each row contains address
+    and size of a page or a line, and numbers of reads, writes and fetches.
+
+    :param str filename: path to file.
+    """
+
+    with open(filename, 'w') as f:
+      f.write('address,size,reads,writes,fetches\n')
+
+      for counters, shift in ((self.pages, PAGE_SHIFT), (self.lines, LINE_SHIFT)):
+        if counters is None:
+          continue
+
+        for entry in self._entries(counters, shift):
+          f.write('%i,%i,%i,%i,%i\n' % ((entry[0], 1 << shift) + entry[1:]))
+
+def enable(machine, lines = False, frequency = 1):
+  """
+  Start collecting new heatmap.
+
+  :param ducky.machine.Machine machine: profiled machine.
+  :param bool lines: if set, count accesses of each line, too.
+  :param int frequency: sampling frequency.
+  :rtype: ducky.heatmap.MemoryHeatmap
+  """
+
+  machine.heatmap = MemoryHeatmap(machine, lines = lines, frequency = frequency)
+
+  for core in machine.cores:
+    core.executor.add_call(core.mmu.set_heatmap, machine.heatmap)
+
+  return machine.heatmap
+
+def disable(machine):
+  """
+  Stop collecting heatmap. Collected data are kept in ``machine.heatmap``.
+
+  :param ducky.machine.Machine machine: profiled machine.
+  """
+
+  for core in machine.cores:
+    core.executor.add_call(core.mmu.set_heatmap, None)
+
+def load_symbols(machine):
+  """
+  Load symbols of the bootloader binary.
+
+  :returns: pair of symbol table and base address of bootloader, or
+    ``(None, 0)`` when there is no bootloader.
+  """
+
+  from .boot import DEFAULT_BOOTLOADER_ADDRESS
+  from .mm.binary import File
+  from .util import SymbolTable
+
+  path = machine.config.get('bootloader', 'file', None)
+
+  if path is None:
+    return None, 0
+
+  with File.open(machine.LOGGER, path, 'r') as binary:
+    binary.load()
+    binary.load_symbols()
+
+  return SymbolTable(binary), machine.config.getint('bootloader', 'base', DEFAULT_BOOTLOADER_ADDRESS)
+
+def cmd_heatmap_on(console, cmd):
+  """
+  Start collecting memory heatmap: heatmap-on [lines] [frequency]
+  """
+
+  lines = len(cmd) >= 2 and cmd[1] == 'lines'
+  frequency = str2int(cmd[2]) if len(cmd) >= 3 else 1
+
+  enable(console.master.machine, lines = lines, frequency = frequency)
+
+  console.writeln('# OK')
+
+def cmd_heatmap_off(console, cmd):
+  """
+  Stop collecting memory heatmap
+  """
+
+  disable(console.master.machine)
+
+  console.writeln('# OK')
+
+def cmd_heatmap_report(console, cmd):
+  """
+  Show the most accessed pages: heatmap-report [count]
+  """
+
+  M = console.master.machine
+
+  if M.heatmap is None:
+    console.writeln('go away')
+    return
+
+  symbols, base = load_symbols(M)
+
+  console.table(M.heatmap.report(symbols = symbols, base = base, count = str2int(cmd[1]) if len(cmd) >= 2 else 20))
+
+def cmd_heatmap_dump(console, cmd):
+  """
+  Save memory heatmap into CSV file: heatmap-dump <file>
+  """
+
+  M = console.master.machine
+
+  if M.heatmap is None or len(cmd) < 2:
+    console.writeln('go away')
+    return
+
+  M.heatmap.dump(cmd[1])
+
+  console.writeln('Heatmap saved as %s', cmd[1])
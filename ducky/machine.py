@@ -8,11 +8,13 @@ import itertools
 import collections
 import os
 import sys
+import threading
 import time
 
 from six import iteritems, itervalues
 from collections import defaultdict, OrderedDict, deque
 
+from . import heatmap
 from . import mm
 from . import snapshot
 
@@ -21,9 +23,12 @@ from . import __version__
 from .interfaces import IMachineWorker, ISnapshotable, IReactorTask
 
 from .console import ConsoleMaster
+from .cpu.coherence import CoherenceBus
+from .cpu.registers import Registers
 from .errors import InvalidResourceError, ExceptionList
 from .log import create_logger
 from .reactor import Reactor
+from .smp import current_core_thread
 from .snapshot import SnapshotNode
 from .util import F
 from .boot import ROMLoader
@@ -120,7 +125,7 @@ class IRQRouterTask(IReactorTask):
         self.machine.DEBUG('irq: interrupt %s', core.cpuid)
 
         self.queue[irq] = False
-        core.irq(irq)
+        core.deliver_irq(irq)
         break
 
       else:
@@ -136,6 +141,66 @@ class HaltMachineTask(IReactorTask):
   def run(self):
     self.machine.halt()
 
+class TemplateMarkerTask(IReactorTask):
+  """
+  Watches a machine booted as a template for its clones, see
+  :py:meth:`ducky.machine.Machine.clone`. When machine reaches a marker, all
+  its living cores are suspended, and callback is called. Marker is reached
+  when any of set conditions is true:
+
+  - ``cnt`` - cores executed at least this number of instructions,
+  - ``idle`` - all living cores wait for an interrupt, i.e. they executed
+    ``idle`` instruction,
+  - ``poke`` - tuple ``(address, value, length)``, memory at ``address``
+    holds ``value``, i.e. it has been poked by the guest.
+
+  :param ducky.machine.Machine machine: machine this task belongs to.
+  :param callback: called, with no arguments, when marker is reached.
+  """
+
+  def __init__(self, machine, callback, cnt = None, idle = False, poke = None):
+    self.machine = machine
+    self.callback = callback
+
+    self.cnt = cnt
+    self.idle = idle
+    self.poke = poke
+
+  def is_reached(self):
+    M = self.machine
+
+    if self.cnt is not None and sum(core.registers[Registers.CNT] for core in M.cores) >= self.cnt:
+      return True
+
+    if self.idle is True and M.living_cores and all(core.idle is True for core in M.living_cores):
+      return True
+
+    if self.poke is not None:
+      address, value, length = self.poke
+
+      if length == 1:
+        return M.memory.read_u8(address) == value
+
+      if length == 2:
+        return M.memory.read_u16(address) == value
+
+      return M.memory.read_u32(address) == value
+
+    return False
+
+  def run(self):
+    if not self.is_reached():
+      return
+
+    self.machine.DEBUG('%s.run: marker reached', self.__class__.__name__)
+
+    self.machine.reactor.remove_task(self)
+
+    for core in self.machine.living_cores:
+      core.change_runnable_state(running = False)
+
+    self.callback()
+
 class EventBus(object):
   def __init__(self, machine):
     super(EventBus, self).__init__()
@@ -143,21 +208,29 @@ class EventBus(object):
     self.machine = machine
 
     self.listeners = defaultdict(OrderedDict)
+    self.lock = threading.Lock()
 
   def add_listener(self, event, callback, *args, **kwargs):
     self.machine.DEBUG('%s.add_listener: event=%s, callback=%s, args=%s, kwargs=%s', self.__class__.__name__, event, callback, args, kwargs)
 
-    self.listeners[event][callback] = (args, kwargs)
+    with self.lock:
+      self.listeners[event][callback] = (args, kwargs)
 
   def remove_listener(self, event, callback):
     self.machine.DEBUG('%s.remove_listener: event=%s, callback=%s', self.__class__.__name__, event, callback)
 
-    del self.listeners[event][callback]
+    with self.lock:
+      del self.listeners[event][callback]
 
   def trigger(self, event, *args, **kwargs):
     self.machine.DEBUG('%s.trigger: event=%s, args=%s, kwargs=%s', self.__class__.__name__, event, args, kwargs)
 
-    for listener, (_args, _kwargs) in iteritems(self.listeners[event]):
+    # Listeners may be added or removed by other threads, or even by listeners
+    # themselves, therefore walk a copy of the list.
+    with self.lock:
+      listeners = list(iteritems(self.listeners[event]))
+
+    for listener, (_args, _kwargs) in listeners:
       _args = _args + args
       _kwargs = _kwargs.copy()
       _kwargs.update(kwargs)
@@ -209,6 +282,13 @@ class Machine(ISnapshotable, IMachineWorker):
     self.console.register_command('boot', cmd_boot)
     self.console.register_command('run', cmd_run)
     self.console.register_command('snap', cmd_snapshot)
+    self.console.register_command('heatmap-on', heatmap.cmd_heatmap_on)
+    self.console.register_command('heatmap-off', heatmap.cmd_heatmap_off)
+    self.console.register_command('heatmap-report', heatmap.cmd_heatmap_report)
+    self.console.register_command('heatmap-dump', heatmap.cmd_heatmap_dump)
+
+    #: Memory access heatmap, see :py:mod:`ducky.heatmap`.
+    self.heatmap = None
 
     self.irq_router_task = IRQRouterTask(self)
     self.reactor.add_task(self.irq_router_task)
@@ -220,8 +300,15 @@ class Machine(ISnapshotable, IMachineWorker):
 
     self.events = EventBus(self)
 
+    self.coherence = CoherenceBus(self)
+
     self.living_cores = []
 
+    #: Guards machine-wide bookkeeping that is shared by cores running in
+    #: their own threads.
+    self.lock = threading.RLock()
+    self.smp_threads = False
+
     self.running = False
     self.halted = False
 
@@ -232,6 +319,11 @@ class Machine(ISnapshotable, IMachineWorker):
 
     self.last_state = None
 
+    #: If set, state is captured when machine halts, and stored in
+    #: ``last_state``. Capturing state of a large machine is expensive,
+    #: therefore only components that use the state should ask for it.
+    self.capture_state_on_halt = False
+
   @property
   def cores(self):
     """
@@ -248,17 +340,19 @@ class Machine(ISnapshotable, IMachineWorker):
     Signal machine that one of CPU cores is now alive.
     """
 
-    self.living_cores.append(core)
+    with self.lock:
+      self.living_cores.append(core)
 
   def on_core_halted(self, core):
     """
     Signal machine that one of CPU cores is no longer alive.
     """
 
-    self.living_cores.remove(core)
+    with self.lock:
+      self.living_cores.remove(core)
 
-    if not self.living_cores:
-      self.reactor.task_runnable(self.check_living_cores_task)
+      if not self.living_cores:
+        self.reactor.task_runnable(self.check_living_cores_task)
 
   def get_device_by_name(self, name, klass = None):
     """
@@ -306,7 +400,7 @@ class Machine(ISnapshotable, IMachineWorker):
 
     raise InvalidResourceError(F('No such storage: sid={sid:d}', sid = sid))
 
-  def save_state(self, parent):
+  def save_state(self, parent, incremental = False, cow = False):
     state = parent.add_child('machine', MachineState())
 
     state.nr_cpus = self.nr_cpus
@@ -315,7 +409,7 @@ class Machine(ISnapshotable, IMachineWorker):
     for cpu in self.cpus:
       cpu.save_state(state)
 
-    self.memory.save_state(state)
+    self.memory.save_state(state, incremental = incremental, cow = cow)
 
   def load_state(self, state):
     self.nr_cpus = state.nr_cpus
@@ -358,6 +452,7 @@ class Machine(ISnapshotable, IMachineWorker):
     self.config = machine_config
 
     self._tenh_enabled = machine_config.getbool('machine', 'tenh-enabled', False)
+    self.smp_threads = machine_config.getbool('machine', 'smp-threads', False)
 
     self.nr_cpus = self.config.getint('machine', 'cpus')
     self.nr_cores = self.config.getint('machine', 'cores')
@@ -382,7 +477,12 @@ class Machine(ISnapshotable, IMachineWorker):
   def trigger_irq(self, handler):
     self.DEBUG('Machine.trigger_irq: handler=%s', handler)
 
-    self.irq_router_task.queue[handler.irq] = True
+    self.trigger_irq_index(handler.irq)
+
+  def trigger_irq_index(self, index):
+    self.DEBUG('Machine.trigger_irq_index: index=%s', index)
+
+    self.irq_router_task.queue[index] = True
     self.reactor.task_runnable(self.irq_router_task)
 
   def _do_tenh(self, printer, s, *args):
@@ -407,32 +507,135 @@ class Machine(ISnapshotable, IMachineWorker):
 
     self._tenh(s, *args)
 
-  def boot(self):
+  def boot(self, resume = False):
+    """
+    Boot machine and all its components.
+
+    :param bool resume: if set, machine is being resumed, see
+      :py:meth:`ducky.machine.Machine.resume`.
+    """
+
     self.tenh('Ducky VM, version %s', __version__)
     self.tenh('Running on %s', sys.version.replace('\n', ' '))
 
     if self.config.getbool('machine', 'jit', False) is True:
       self.tenh('JIT enabled')
 
+    if self.smp_threads is True:
+      self.tenh('SMP threads enabled')
+
     self.DEBUG('Machine.boot')
 
     self.events.add_listener('on-core-alive', self.on_core_alive)
     self.events.add_listener('on-core-halted', self.on_core_halted)
 
-    self.memory.boot()
+    self.memory.boot(resume = resume)
     self.console.boot()
 
     for devs in itervalues(self.devices):
       for dev in [dev for dev in itervalues(devs) if not dev.is_slave()]:
         dev.boot()
 
-    self.rom_loader.boot()
+    self.rom_loader.boot(resume = resume)
 
     for __cpu in self.cpus:
       __cpu.boot()
 
     self.running = True
 
+  def resume(self, state):
+    """
+    Boot machine suspended by taking its snapshot. Machine must use the same
+    configuration. Bootloader is not loaded again, and living cores continue
+    running.
+
+    When RAM lives in a file - see ``file`` memory backend - it's mapped back
+    without any copying, and content of RAM is not reloaded. With ``pages``
+    backend, pages share their content with the snapshot, and when the
+    snapshot was loaded lazily, pages are read from the snapshot file on
+    their first access.
+
+    :param ducky.snapshot.VMState state: snapshot of suspended machine.
+    """
+
+    self.DEBUG('Machine.resume')
+
+    self.boot(resume = True)
+    self.load_state(state.get_child('machine'))
+
+    # Snapshot of a running machine is taken with cores suspended
+    for __core in self.cores:
+      if __core.alive is True:
+        __core.change_runnable_state(running = True)
+
+  def clone(self):
+    """
+    Create a copy of the machine, running in a new process. Process is forked,
+    therefore the clone shares memory with the original machine, copied by
+    the host's kernel only when written to. In the new process, all devices
+    and the reactor are told to stop using resources shared with other clones,
+    see :py:meth:`ducky.devices.Device.reattach`.
+
+    Cores must not run in their own threads, and RAM of the machine must not
+    be a shared mapping, i.e. machine must use ``pages`` memory backend.
+
+    :returns: in the original process PID of the clone, in the clone ``0``.
+    :raises ducky.errors.InvalidResourceError: when machine cannot be cloned.
+    """
+
+    self.DEBUG('Machine.clone')
+
+    if self.smp_threads is True:
+      raise InvalidResourceError('Machine with cores running in their own threads cannot be cloned')
+
+    if self.memory.ram is not None:
+      raise InvalidResourceError('Machine with flat or file-backed RAM cannot be cloned')
+
+    pid = os.fork()
+
+    if pid != 0:
+      return pid
+
+    self.reactor.reattach()
+
+    for devs in itervalues(self.devices):
+      for dev in itervalues(devs):
+        dev.reattach()
+
+    return 0
+
+  def set_template_marker(self, callback, cnt = None, idle = False, poke = None):
+    """
+    Let machine run until it reaches a marker, then suspend it and call
+    ``callback``. Callback is expected to create clones of the machine, and
+    in each clone it should call :py:meth:`ducky.machine.Machine.wake_clone`
+    before it returns. See :py:class:`ducky.machine.TemplateMarkerTask` for
+    description of markers.
+
+    :rtype: ducky.machine.TemplateMarkerTask
+    :returns: task watching the machine.
+    """
+
+    self.DEBUG('Machine.set_template_marker: callback=%s, cnt=%s, idle=%s, poke=%s', callback, cnt, idle, poke)
+
+    task = TemplateMarkerTask(self, callback, cnt = cnt, idle = idle, poke = poke)
+
+    self.reactor.add_task(task)
+    self.reactor.task_runnable(task)
+
+    return task
+
+  def wake_clone(self):
+    """
+    Let cores, suspended when template machine reached its marker, continue
+    running.
+    """
+
+    self.DEBUG('Machine.wake_clone')
+
+    for __core in self.living_cores:
+      __core.change_runnable_state(running = True)
+
   def run(self):
     self.DEBUG('Machine.run')
 
@@ -443,6 +646,10 @@ class Machine(ISnapshotable, IMachineWorker):
     for __cpu in self.cpus:
       __cpu.run()
 
+    if self.smp_threads is True:
+      for __core in self.cores:
+        __core.thread.start()
+
     self.start_time = self.end_time = time.time()
     self.reactor.run()
     self.end_time = time.time()
@@ -466,10 +673,36 @@ class Machine(ISnapshotable, IMachineWorker):
 
     self.halt()
 
+  def stop_core_threads(self):
+    """
+    Stop all core threads, and wait for them to finish. After this call, all
+    remaining work is done by the reactor's thread.
+    """
+
+    self.DEBUG('Machine.stop_core_threads')
+
+    for __core in self.cores:
+      if __core.thread is None:
+        continue
+
+      __core.thread.stop()
+
+      if __core.thread.is_alive():
+        __core.thread.join()
+
   def halt(self):
     self.DEBUG('Machine.halt')
 
-    self.capture_state()
+    # Core threads can't wait for themselves - let reactor do the job.
+    if current_core_thread() is not None:
+      self.reactor.add_call(self.halt)
+      return
+
+    if self.smp_threads is True:
+      self.stop_core_threads()
+
+    if self.capture_state_on_halt is True:
+      self.capture_state()
 
     for __cpu in self.cpus:
       __cpu.halt()
@@ -499,14 +732,18 @@ class Machine(ISnapshotable, IMachineWorker):
     self.running = False
     self.halted = True
 
-  def capture_state(self, suspend = False):
+  def capture_state(self, suspend = False, incremental = False, cow = False):
     """
     Capture current state of the VM, and store it in it's `last_state` attribute.
 
     :param bool suspend: if `True`, suspend VM before taking snapshot.
+    :param bool incremental: if `True`, capture only memory pages changed since
+      the previous snapshot. See :py:func:`ducky.snapshot.merge_states`.
+    :param bool cow: if `True`, memory pages are not copied, but made
+      copy-on-write. See :py:meth:`ducky.mm.MemoryController.save_state`.
     """
 
-    self.last_state = snapshot.VMState.capture_vm_state(self, suspend = suspend)
+    self.last_state = snapshot.VMState.capture_vm_state(self, suspend = suspend, incremental = incremental, cow = cow)
     return self.last_state
 
 def cmd_boot(console, cmd):
@@ -1,3 +1,8 @@
+import mmap
+import os
+import struct
+import threading
+
 from six import iteritems, itervalues
 from six.moves import range
 
@@ -5,6 +10,8 @@ from ..interfaces import ISnapshotable
 from ..errors import AccessViolationError, InvalidResourceError
 from ..util import align, sizeof_fmt, Flags
 from ..snapshot import SnapshotNode
+from .extents import FreeExtents
+from .directory import PageDirectory
 
 import enum
 
@@ -31,6 +38,12 @@ PAGE_MASK = (~(PAGE_SIZE - 1))
 
 MINIMAL_SIZE = 16
 
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+
+#: Content of all pages that were not written to yet.
+ZERO_PAGE = bytes(bytearray(PAGE_SIZE))
+
 class MMOperationList(enum.IntEnum):
   ALLOC    = 3
   FREE     = 4
@@ -124,7 +137,7 @@ class MemoryPage(object):
     state = parent.add_child('page_{}'.format(self.index), MemoryPageState())
 
     state.index = self.index
-    state.content = [ord(i) if isinstance(i, str) else i for i in self.data]
+    state.content = bytearray(self.data)
 
     return state
 
@@ -133,8 +146,7 @@ class MemoryPage(object):
     Restore page from a snapshot.
     """
 
-    for i in range(0, PAGE_SIZE):
-      self.data[i] = state.content[i]
+    self.write_block(0, bytearray(state.content))
 
   def __len__(self):
     """
@@ -225,6 +237,48 @@ class MemoryPage(object):
 
     raise NotImplementedError('Not allowed to access memory on this address: page={}, offset={}'.format(self.index, offset))
 
+  def read_block(self, offset, length):
+    """
+    Read block of bytes.
+
+    Bytes are read one by one, using :py:meth:`read_u8`. Child classes with
+    direct access to their storage are expected to provide faster
+    implementation.
+
+    :param int offset: offset of the first byte.
+    :param int length: number of bytes to read.
+    :rtype: bytearray
+    """
+
+    return bytearray([self.read_u8(offset + i) for i in range(0, length)])
+
+  def write_block(self, offset, buff):
+    """
+    Write block of bytes.
+
+    Bytes are written one by one, using :py:meth:`write_u8`. Child classes with
+    direct access to their storage are expected to provide faster
+    implementation.
+
+    :param int offset: offset of the first byte.
+    :param buff: bytes to write.
+    """
+
+    for i, b in enumerate(bytearray(buff)):
+      self.write_u8(offset + i, b)
+
+  def fill(self, offset, value, length):
+    """
+    Set block of bytes to the same value.
+
+    :param int offset: offset of the first byte.
+    :param int value: new value of bytes.
+    :param int length: number of bytes to set.
+    """
+
+    for i in range(offset, offset + length):
+      self.write_u8(i, value)
+
 class AnonymousMemoryPage(MemoryPage):
   """
   "Anonymous" memory page - this page is just a plain array of bytes, and is
@@ -236,13 +290,12 @@ class AnonymousMemoryPage(MemoryPage):
   def __init__(self, controller, index):
     super(AnonymousMemoryPage, self).__init__(controller, index)
 
-    self.data = bytearray([0 for _ in range(0, PAGE_SIZE)])
+    self.data = bytearray(PAGE_SIZE)
 
   def clear(self):
     self.DEBUG('%s.clear', self.__class__.__name__)
 
-    for i in range(0, PAGE_SIZE):
-      self.data[i] = 0
+    self.data[:] = bytearray(PAGE_SIZE)
 
   def read_u8(self, offset):
     self.DEBUG('%s.read_u8: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
@@ -252,12 +305,12 @@ class AnonymousMemoryPage(MemoryPage):
   def read_u16(self, offset):
     self.DEBUG('%s.read_u16: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
 
-    return self.data[offset] | (self.data[offset + 1] << 8)
+    return _U16.unpack_from(self.data, offset)[0]
 
   def read_u32(self, offset):
     self.DEBUG('%s.do_read_u32: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
 
-    return self.data[offset] | (self.data[offset + 1] << 8) | (self.data[offset + 2] << 16) | (self.data[offset + 3] << 24)
+    return _U32.unpack_from(self.data, offset)[0]
 
   def write_u8(self, offset, value):
     self.DEBUG('%s.do_write_u8: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
@@ -267,16 +320,209 @@ class AnonymousMemoryPage(MemoryPage):
   def write_u16(self, offset, value):
     self.DEBUG('%s.write_u16: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
 
-    self.data[offset]     =  value & 0x00FF
-    self.data[offset + 1] = (value & 0xFF00) >> 8
+    _U16.pack_into(self.data, offset, value & 0xFFFF)
+
+  def write_u32(self, offset, value):
+    self.DEBUG('%s.write_u32: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
+
+    _U32.pack_into(self.data, offset, value & 0xFFFFFFFF)
+
+  def read_block(self, offset, length):
+    self.DEBUG('%s.read_block: page=%s, offset=%s, length=%s', self.__class__.__name__, self.index, offset, length)
+
+    return bytearray(self.data[offset:offset + length])
+
+  def write_block(self, offset, buff):
+    self.DEBUG('%s.write_block: page=%s, offset=%s, length=%s', self.__class__.__name__, self.index, offset, len(buff))
+
+    self.data[offset:offset + len(buff)] = buff
+
+  def fill(self, offset, value, length):
+    self.DEBUG('%s.fill: page=%s, offset=%s, value=%s, length=%s', self.__class__.__name__, self.index, offset, value, length)
+
+    self.data[offset:offset + length] = bytearray([value]) * length
+
+class FlatMemoryPage(MemoryPage):
+  """
+  Memory page living in the flat RAM of its controller - instead of owning its
+  own storage, page is just a view of its part of the RAM.
+
+  Page is created with all bytes set to zero.
+  """
+
+  def __init__(self, controller, index):
+    super(FlatMemoryPage, self).__init__(controller, index)
+
+    self.ram = controller.ram
+    self.data = memoryview(self.ram)[self.base_address:self.base_address + PAGE_SIZE]
+
+  def clear(self):
+    self.DEBUG('%s.clear', self.__class__.__name__)
+
+    self.data[:] = bytearray(PAGE_SIZE)
+
+  def read_u8(self, offset):
+    self.DEBUG('%s.read_u8: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return self.data[offset]
+
+  def read_u16(self, offset):
+    self.DEBUG('%s.read_u16: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return _U16.unpack_from(self.ram, self.base_address + offset)[0]
+
+  def read_u32(self, offset):
+    self.DEBUG('%s.read_u32: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return _U32.unpack_from(self.ram, self.base_address + offset)[0]
+
+  def write_u8(self, offset, value):
+    self.DEBUG('%s.write_u8: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
+
+    self.data[offset] = value
+
+  def write_u16(self, offset, value):
+    self.DEBUG('%s.write_u16: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
+
+    _U16.pack_into(self.ram, self.base_address + offset, value & 0xFFFF)
 
   def write_u32(self, offset, value):
     self.DEBUG('%s.write_u32: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
 
-    self.data[offset]     =  value &       0xFF
-    self.data[offset + 1] = (value &     0xFF00) >> 8
-    self.data[offset + 2] = (value &   0xFF0000) >> 16
-    self.data[offset + 3] = (value & 0xFF000000) >> 24
+    _U32.pack_into(self.ram, self.base_address + offset, value & 0xFFFFFFFF)
+
+  def read_block(self, offset, length):
+    self.DEBUG('%s.read_block: page=%s, offset=%s, length=%s', self.__class__.__name__, self.index, offset, length)
+
+    return bytearray(self.data[offset:offset + length])
+
+  def write_block(self, offset, buff):
+    self.DEBUG('%s.write_block: page=%s, offset=%s, length=%s', self.__class__.__name__, self.index, offset, len(buff))
+
+    self.data[offset:offset + len(buff)] = buff
+
+  def fill(self, offset, value, length):
+    self.DEBUG('%s.fill: page=%s, offset=%s, value=%s, length=%s', self.__class__.__name__, self.index, offset, value, length)
+
+    self.data[offset:offset + length] = bytearray([value]) * length
+
+class SharedMemoryPage(MemoryPage):
+  """
+  Anonymous page whose content is shared with other pages - its ``data`` is a
+  read-only ``bytes`` object. Reads are served from the shared content, and the
+  first write replaces this page with a private page of its controller, holding
+  a copy of the content, see :py:meth:`ducky.mm.MemoryController.commit_page`.
+
+  Cores may keep this page in their caches for a while after it has been
+  committed, therefore once the private page exists, all accesses are
+  forwarded to it.
+
+  :param bytes content: shared content of the page.
+  :param release: if set, it's called with ``content`` when page stops using
+    the shared content.
+  """
+
+  def __init__(self, controller, index, content, release = None):
+    super(SharedMemoryPage, self).__init__(controller, index)
+
+    self.data = content
+
+    #: Private page, created by the first write.
+    self.page = None
+
+    self._release = release
+
+  def release(self):
+    """
+    Page no longer uses its shared content.
+    """
+
+    if self._release is not None:
+      self._release(self.data)
+      self._release = None
+
+  def save_state(self, parent):
+    if self.page is not None:
+      return self.page.save_state(parent)
+
+    return super(SharedMemoryPage, self).save_state(parent)
+
+  def clear(self):
+    self.controller.commit_page(self).clear()
+
+  def read_u8(self, offset):
+    self.DEBUG('%s.read_u8: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return self.data[offset] if self.page is None else self.page.read_u8(offset)
+
+  def read_u16(self, offset):
+    self.DEBUG('%s.read_u16: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return _U16.unpack_from(self.data, offset)[0] if self.page is None else self.page.read_u16(offset)
+
+  def read_u32(self, offset):
+    self.DEBUG('%s.read_u32: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return _U32.unpack_from(self.data, offset)[0] if self.page is None else self.page.read_u32(offset)
+
+  def read_block(self, offset, length):
+    return bytearray(self.data[offset:offset + length]) if self.page is None else self.page.read_block(offset, length)
+
+  def write_u8(self, offset, value):
+    self.DEBUG('%s.write_u8: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
+
+    self.controller.commit_page(self).write_u8(offset, value)
+
+  def write_u16(self, offset, value):
+    self.DEBUG('%s.write_u16: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
+
+    self.controller.commit_page(self).write_u16(offset, value)
+
+  def write_u32(self, offset, value):
+    self.DEBUG('%s.write_u32: page=%s, offset=%s, value=%s', self.__class__.__name__, self.index, offset, value)
+
+    self.controller.commit_page(self).write_u32(offset, value)
+
+  def write_block(self, offset, buff):
+    self.controller.commit_page(self).write_block(offset, buff)
+
+  def fill(self, offset, value, length):
+    self.controller.commit_page(self).fill(offset, value, length)
+
+class ZeroMemoryPage(SharedMemoryPage):
+  """
+  Placeholder of an anonymous page that has not been written to yet. Reads are
+  served from the shared, read-only :py:data:`ducky.mm.ZERO_PAGE`.
+  """
+
+  def __init__(self, controller, index):
+    super(ZeroMemoryPage, self).__init__(controller, index, ZERO_PAGE)
+
+  def clear(self):
+    if self.page is not None:
+      self.page.clear()
+
+  def read_u8(self, offset):
+    self.DEBUG('%s.read_u8: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return 0 if self.page is None else self.page.read_u8(offset)
+
+  def read_u16(self, offset):
+    self.DEBUG('%s.read_u16: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return 0 if self.page is None else self.page.read_u16(offset)
+
+  def read_u32(self, offset):
+    self.DEBUG('%s.read_u32: page=%s, offset=%s', self.__class__.__name__, self.index, offset)
+
+    return 0 if self.page is None else self.page.read_u32(offset)
+
+  def fill(self, offset, value, length):
+    # Filling with zeros changes nothing
+    if value == 0 and self.page is None:
+      return
+
+    self.controller.commit_page(self).fill(offset, value, length)
 
 class VirtualMemoryPage(MemoryPage):
   """
@@ -305,13 +551,13 @@ class ExternalMemoryPage(MemoryPage):
     return '<%s index=%i, base=%s, offset=%s>' % (self.__class__.__name__, self.index, UINT32_FMT(self.base_address), UINT32_FMT(self.offset))
 
   def save_state(self, parent):
-    state = super(ExternalMemoryPage, self).save_state(parent)
+    # Data may be much larger than a page, e.g. a whole mmaped file
+    state = parent.add_child('page_{}'.format(self.index), MemoryPageState())
 
-    if self.data:
-      state.content = [ord(i) if isinstance(i, str) else i for i in self.data[self.offset:self.offset + PAGE_SIZE]]
+    state.index = self.index
+    state.content = bytearray(self.data[self.offset:self.offset + PAGE_SIZE]) if self.data else bytearray()
 
-    else:
-      state.content = []
+    return state
 
   def clear(self):
     self.DEBUG('%s.clear', self.__class__.__name__)
@@ -418,7 +664,7 @@ class MemoryRegion(ISnapshotable, object):
 
 class MemoryState(SnapshotNode):
   def __init__(self):
-    super(MemoryState, self).__init__('size')
+    super(MemoryState, self).__init__('size', 'ram_file', 'incremental', 'removed_pages')
 
   def get_page_states(self):
     return [__state for __name, __state in iteritems(self.get_children()) if __name.startswith('page_')]
@@ -429,6 +675,12 @@ class MemoryController(object):
 
   :param ducky.machine.Machine machine: virtual machine that owns this controller.
   :param int size: size of memory, in bytes.
+  :param str memory.backend: ``pages`` (default) to give each page its own
+    storage, or ``flat`` to keep all RAM in one anonymous mapping, with pages
+    being just views of it. MMIO and other external pages overlay the flat RAM.
+    ``file`` works like ``flat``, but RAM is a shared mapping of a file.
+  :param str memory.file: path of RAM file, used by ``file`` backend.
+    Snapshots do not contain RAM content then, it's kept in the file instead.
   :raises ducky.errors.InvalidResourceError: when memory size is not multiple of
     :py:data:`ducky.mm.PAGE_SIZE`.
   """
@@ -455,24 +707,199 @@ class MemoryController(object):
 
     self.size = size
     self.pages_cnt = size // PAGE_SIZE
-    self.pages = {}
+    self.pages = PageDirectory(self.pages_cnt)
 
-  def save_state(self, parent):
-    self.DEBUG('mc.save_state')
+    #: Pages neither allocated nor claimed by an external area.
+    self.free_extents = FreeExtents(self.pages_cnt)
+
+    #: External memory areas, e.g. mmap-ed files. Pages of an area are created
+    #: when accessed for the first time.
+    self.areas = []
+
+    #: Number of anonymous pages visible to the guest, including those not
+    #: written to yet.
+    self.virtual_pages = 0
+
+    #: Number of anonymous pages with their own storage, i.e. pages that were
+    #: written to.
+    self.committed_pages = 0
+
+    backend = self.machine.config.get('memory', 'backend', default = 'pages')
+
+    #: Path of file backing the RAM.
+    self.ram_file = None
+
+    if backend == 'file':
+      self.ram_file = self.machine.config.get('memory', 'file')
+
+      # Existing content is kept - it may be RAM of a suspended machine, see
+      # boot() - and host reads pages of the file when they are accessed.
+      fd = os.open(self.ram_file, os.O_RDWR | os.O_CREAT, 0o600)
+
+      try:
+        os.ftruncate(fd, size)
+        self.ram = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+      finally:
+        os.close(fd)
+
+      self._page_class = FlatMemoryPage
+
+    elif backend == 'flat':
+      # Anonymous mapping is zero-filled, and host allocates its pages lazily
+      self.ram = mmap.mmap(-1, size)
+      self._page_class = FlatMemoryPage
+
+    else:
+      self.ram = None
+      self._page_class = AnonymousMemoryPage
+
+    #: Indices of pages written to since the last snapshot, or ``None`` when
+    #: dirty pages are not tracked. See
+    #: :py:meth:`ducky.mm.MemoryController.track_dirty_pages`.
+    self.dirty_pages = None
+
+    #: Same-page merging service, see :py:mod:`ducky.mm.dedup`.
+    self.merger = None
+
+    if self.machine.config.getbool('memory', 'dedup', default = False) is True:
+      if self.ram is not None:
+        self.WARN('mm: page merging is not available with flat memory backend')
+
+      elif self.machine.smp_threads is True:
+        self.WARN('mm: page merging is not available with threaded SMP')
+
+      else:
+        from .dedup import PageMerger
+
+        self.merger = PageMerger(self)
+
+    #: Guards page allocation and (un)registration - cores running in their own
+    #: threads may ask for yet unallocated pages at the same time.
+    self.lock = threading.RLock()
+
+    #: Serializes atomic read-modify-write operations, e.g. ``cas`` instruction.
+    self.atomic_lock = threading.Lock()
+
+  def __freeze_page(self, pg):
+    """
+    Make content of a page immutable, to let snapshot use it without copying.
+    Private anonymous page is replaced by a page sharing its content, and the
+    first write gives page a new private copy of the content.
+
+    :returns: content of the page, or ``None`` when page cannot be frozen.
+    """
+
+    if isinstance(pg, SharedMemoryPage):
+      return pg.data if pg.page is None else None
+
+    if self.ram is not None or type(pg) is not self._page_class:
+      return None
+
+    with self.lock:
+      if self.pages.get(pg.index) is not pg:
+        return None
+
+      self.pages[pg.index] = SharedMemoryPage(self, pg.index, pg.data)
+      self.committed_pages -= 1
+
+    self.machine.coherence.invalidate_pages_now(pg.index)
+
+    return pg.data
+
+  def save_state(self, parent, incremental = False, cow = False):
+    """
+    Capture state of memory.
+
+    When dirty pages are tracked, each snapshot starts a new tracking period.
+
+    :param bool incremental: if set, only pages written to since the previous
+      snapshot are captured, together with a list of pages removed since then.
+    :param bool cow: if set, contents of anonymous pages are not copied.
+      Instead, pages are made copy-on-write, and snapshot holds their current
+      content, which is left intact by any following writes. All cores must
+      run in the caller's thread. Pages of ``flat`` and ``file`` backends are
+      always copied.
+    :raises ducky.errors.InvalidResourceError: when incremental snapshot is
+      requested, but dirty pages are not tracked.
+    """
+
+    self.DEBUG('mc.save_state: incremental=%s, cow=%s', incremental, cow)
+
+    if incremental is True and self.dirty_pages is None:
+      raise InvalidResourceError('Incremental snapshot requires tracking of dirty pages')
 
     state = parent.add_child('memory', MemoryState())
 
     state.size = self.size
+    state.ram_file = self.ram_file
+    state.incremental = incremental
+    state.removed_pages = []
+
+    with self.lock:
+      # Writes made while pages are being captured are recorded by the new set
+      dirty, self.dirty_pages = self.dirty_pages, (set() if self.dirty_pages is not None else None)
+
+      if incremental is True:
+        pages = [self.pages.get(index) for index in sorted(dirty)]
+        state.removed_pages = [index for index, page in zip(sorted(dirty), pages) if page is None]
+        pages = [page for page in pages if page is not None]
+
+      else:
+        pages = list(itervalues(self.pages))
 
-    for page in itervalues(self.pages):
-      page.save_state(state)
+    for page in pages:
+      # Content of RAM pages is already in the RAM file
+      if self.ram_file is not None and isinstance(page, FlatMemoryPage):
+        continue
+
+      content = self.__freeze_page(page) if cow is True else None
+
+      if content is None:
+        page.save_state(state)
+        continue
+
+      page_state = state.add_child('page_{}'.format(page.index), MemoryPageState())
+      page_state.index = page.index
+      page_state.content = content
+
+    if self.ram_file is not None:
+      self.sync()
 
   def load_state(self, state):
     self.size = state.size
 
-    for page_state in state.get_children():
-      page = self.get_page(page_state.index)
-      page.load_state(page_state)
+    ram_file = getattr(state, 'ram_file', None)
+
+    if ram_file is not None and ram_file != self.ram_file:
+      raise InvalidResourceError('RAM of snapshot lives in %s, memory.file must point to it' % ram_file)
+
+    if getattr(state, 'incremental', False) is True:
+      raise InvalidResourceError('Incremental snapshot must be merged with its parents first')
+
+    for page_state in state.get_page_states():
+      index = page_state.index
+      pg = self.pages.get(index)
+
+      # Anonymous pages are replaced by pages sharing content of the snapshot,
+      # which, when loaded lazily, is read from the snapshot file on the first
+      # access. First write gives page its private copy.
+      if self.ram is None and (pg is None or isinstance(pg, (self._page_class, SharedMemoryPage))):
+        with self.lock:
+          if pg is not None:
+            self.__remove_page(pg)
+
+          if page_state.content is ZERO_PAGE:
+            self.__set_page(ZeroMemoryPage(self, index))
+
+          else:
+            self.__set_page(SharedMemoryPage(self, index, page_state.content))
+
+        continue
+
+      self.get_page(index).load_state(page_state)
+
+    self.machine.coherence.invalidate_all()
 
   def __set_page(self, pg):
     """
@@ -489,6 +916,21 @@ class MemoryController(object):
       raise InvalidResourceError('Attempt to create page with index out of bounds: pg.index=%d' % pg.index)
 
     self.pages[pg.index] = pg
+
+    if self.dirty_pages is not None:
+      self.dirty_pages.add(pg.index)
+
+    # Pages of external areas were reserved when their area was mapped
+    if self.free_extents.is_free(pg.index):
+      self.free_extents.reserve(pg.index)
+
+    if isinstance(pg, SharedMemoryPage):
+      self.virtual_pages += 1
+
+    elif isinstance(pg, self._page_class):
+      self.virtual_pages += 1
+      self.committed_pages += 1
+
     return pg
 
   def __remove_page(self, pg):
@@ -500,7 +942,26 @@ class MemoryController(object):
 
     assert pg.index in self.pages
 
-    del self.pages[pg.index]
+    # Caller may hold already committed zero page, remove what's installed
+    pg = self.pages.pop(pg.index)
+
+    if self._area_of(pg.index) is None:
+      self.free_extents.release(pg.index)
+
+    if isinstance(pg, SharedMemoryPage):
+      self.virtual_pages -= 1
+      pg.release()
+
+    elif isinstance(pg, self._page_class):
+      self.virtual_pages -= 1
+      self.committed_pages -= 1
+
+    if self.dirty_pages is not None:
+      self.dirty_pages.add(pg.index)
+
+    # Next page allocated at this index must start zeroed, like a new anonymous page
+    if isinstance(pg, FlatMemoryPage):
+      pg.clear()
 
   def __alloc_page(self, index):
     """
@@ -509,12 +970,103 @@ class MemoryController(object):
     Be aware that this method does NOT check if page is already allocated. If
     it is, it is just overwritten by new anonymous page.
 
+    New page has no storage of its own until it's written to for the first
+    time, see :py:meth:`ducky.mm.MemoryController.commit_page`. Pages of RAM
+    file are the exception - their content is in the file already.
+
     :param int index: index of requested page.
     :returns: newly reserved page.
-    :rtype: :py:class:`ducky.mm.AnonymousMemoryPage`
+    :rtype: :py:class:`ducky.mm.ZeroMemoryPage`, or
+      :py:class:`ducky.mm.FlatMemoryPage` when RAM lives in a file.
     """
 
-    return self.__set_page(AnonymousMemoryPage(self, index))
+    if self.ram_file is not None:
+      return self.__set_page(self._page_class(self, index))
+
+    return self.__set_page(ZeroMemoryPage(self, index))
+
+  def commit_page(self, pg):
+    """
+    Replace shared page - e.g. zero page - with a private anonymous page,
+    because it is being written to. Cores are told to drop their cached
+    accessors of the shared page.
+
+    :param ducky.mm.SharedMemoryPage pg: page being written to.
+    :returns: committed page.
+    :rtype: :py:class:`ducky.mm.AnonymousMemoryPage` or
+      :py:class:`ducky.mm.FlatMemoryPage`
+    """
+
+    with self.lock:
+      if pg.page is not None:
+        return pg.page
+
+      self.DEBUG('mc.commit_page: page=%s', pg.index)
+
+      pg.page = self._page_class(self, pg.index)
+
+      if pg.data is not ZERO_PAGE:
+        pg.page.write_block(0, pg.data)
+
+      if self.pages.get(pg.index) is pg:
+        self.pages[pg.index] = pg.page
+        self.committed_pages += 1
+
+      pg.release()
+
+    self.machine.coherence.invalidate_pages(pg.index)
+
+    return pg.page
+
+  def merge_page(self, pg, content, store):
+    """
+    Replace private anonymous page with a page sharing its content with other
+    pages. Content of zeros is replaced by a zero page.
+
+    All cores must run in the caller's thread - their caches are invalidated
+    immediately, and no core may write into the private page after it's been
+    merged.
+
+    :param pg: private page, :py:class:`ducky.mm.AnonymousMemoryPage` or
+      :py:class:`ducky.mm.FlatMemoryPage`.
+    :param bytes content: current content of the page.
+    :param ducky.mm.dedup.PageStore store: store of shared contents.
+    :returns: new page, or ``None`` when page was replaced in the meantime.
+    :rtype: :py:class:`ducky.mm.SharedMemoryPage`
+    """
+
+    self.DEBUG('mc.merge_page: page=%s', pg.index)
+
+    with self.lock:
+      if self.pages.get(pg.index) is not pg:
+        return None
+
+      if content == ZERO_PAGE:
+        shared = ZeroMemoryPage(self, pg.index)
+
+      else:
+        shared = SharedMemoryPage(self, pg.index, store.acquire(content), release = store.release)
+
+      self.__remove_page(pg)
+      self.__set_page(shared)
+
+    self.machine.coherence.invalidate_pages_now(pg.index)
+
+    return shared
+
+  def _area_of(self, index):
+    """
+    Find external memory area page belongs to.
+
+    :param int index: page index.
+    :returns: memory area, or ``None`` when page does not belong to any area.
+    """
+
+    for area in self.areas:
+      if area.pages_start <= index < area.pages_start + area.pages_cnt:
+        return area
+
+    return None
 
   def alloc_specific_page(self, index):
     """
@@ -522,16 +1074,17 @@ class MemoryController(object):
 
     :param int index: allocate page with this particular index.
     :returns: newly reserved page.
-    :rtype: :py:class:`ducky.mm.AnonymousMemoryPage`
+    :rtype: :py:class:`ducky.mm.ZeroMemoryPage`
     :raises ducky.errors.AccessViolationError: when page is already allocated.
     """
 
     self.DEBUG('mc.alloc_specific_page: index=%s', index)
 
-    if index in self.pages:
-      raise AccessViolationError('Page {} is already allocated'.format(index))
+    with self.lock:
+      if not self.free_extents.is_free(index):
+        raise AccessViolationError('Page {} is already allocated'.format(index))
 
-    return self.__alloc_page(index)
+      return self.__alloc_page(index)
 
   def alloc_pages(self, base = None, count = 1):
     """
@@ -540,7 +1093,7 @@ class MemoryController(object):
     :param u24 base: if set, start searching pages from this address.
     :param int count: number of requested pages.
     :returns: list of newly allocated pages.
-    :rtype: ``list`` of :py:class:`ducky.mm.AnonymousMemoryPage`
+    :rtype: ``list`` of :py:class:`ducky.mm.ZeroMemoryPage`
     :raises ducky.errors.InvalidResourceError: when there is no available sequence of
       pages.
     """
@@ -556,12 +1109,10 @@ class MemoryController(object):
 
     self.DEBUG('mc.alloc_pages: page=%s, cnt=%s', pages_start, pages_cnt)
 
-    for i in range(pages_start, pages_start + pages_cnt):
-      for j in range(i, i + count):
-        if j in self.pages:
-          break
+    with self.lock:
+      i = self.free_extents.first_fit(count = count, base = pages_start)
 
-      else:
+      if i is not None:
         return [self.__alloc_page(j) for j in range(i, i + count)]
 
     raise InvalidResourceError('No sequence of free pages available')
@@ -572,7 +1123,7 @@ class MemoryController(object):
 
     :param int base: if set, start searching pages from this address.
     :returns: newly reserved page.
-    :rtype: :py:class:`ducky.mm.AnonymousMemoryPage`
+    :rtype: :py:class:`ducky.mm.ZeroMemoryPage`
     :raises ducky.errors.InvalidResourceError: when there is no available page.
     """
 
@@ -587,8 +1138,10 @@ class MemoryController(object):
 
     self.DEBUG('mc.alloc_page: page=%s, cnt=%s', pages_start, pages_cnt)
 
-    for i in range(pages_start, pages_start + pages_cnt):
-      if i not in self.pages:
+    with self.lock:
+      i = self.free_extents.first_fit(base = pages_start)
+
+      if i is not None:
         self.DEBUG('mc.alloc_page: page=%s', i)
         return self.__alloc_page(i)
 
@@ -608,10 +1161,15 @@ class MemoryController(object):
 
     self.DEBUG('mc.register_page: pg=%s', pg)
 
-    if pg.index in self.pages:
-      raise AccessViolationError('Page {} is already allocated'.format(pg.index))
+    with self.lock:
+      if not self.free_extents.is_free(pg.index):
+        raise AccessViolationError('Page {} is already allocated'.format(pg.index))
+
+      self.__set_page(pg)
 
-    return self.__set_page(pg)
+    self.machine.coherence.invalidate_pages(pg.index)
+
+    return pg
 
   def unregister_page(self, pg):
     """
@@ -625,10 +1183,60 @@ class MemoryController(object):
 
     self.DEBUG('mc.unregister_page: pg=%s', pg)
 
-    if pg.index not in self.pages:
-      raise AccessViolationError('Page {} is not allocated'.format(pg.index))
+    with self.lock:
+      if pg.index not in self.pages:
+        raise AccessViolationError('Page {} is not allocated'.format(pg.index))
+
+      self.__remove_page(pg)
+
+    self.machine.coherence.invalidate_pages(pg.index)
+
+  def map_area(self, area):
+    """
+    Attach external memory area, e.g. a mmap-ed file. Area claims a range of
+    pages, but page objects are created lazily, when accessed for the first
+    time, by area's ``create_page(controller, index)`` method.
+
+    :param area: area to attach. It must provide ``pages_start`` and
+      ``pages_cnt`` attributes, and ``create_page`` method.
+    :raises ducky.errors.InvalidResourceError: when area overlaps with
+      allocated pages or with another area.
+    """
+
+    self.DEBUG('mc.map_area: area=%s', area)
 
-    self.__remove_page(pg)
+    pages_end = area.pages_start + area.pages_cnt
+
+    with self.lock:
+      if pages_end > self.pages_cnt:
+        raise InvalidResourceError('Area does not fit into memory: area=%s' % area)
+
+      if not self.free_extents.is_free(area.pages_start, area.pages_cnt):
+        raise InvalidResourceError('Area overlaps with existing pages or another area: area=%s' % area)
+
+      self.free_extents.reserve(area.pages_start, area.pages_cnt)
+      self.areas = self.areas + [area]
+
+    self.machine.coherence.invalidate_pages(area.pages_start, area.pages_cnt)
+
+  def unmap_area(self, area):
+    """
+    Detach external memory area, and remove all its pages created so far.
+
+    :param area: area to detach.
+    """
+
+    self.DEBUG('mc.unmap_area: area=%s', area)
+
+    with self.lock:
+      for i in range(area.pages_start, area.pages_start + area.pages_cnt):
+        if i in self.pages:
+          self.__remove_page(self.pages[i])
+
+      self.areas = [other for other in self.areas if other is not area]
+      self.free_extents.release(area.pages_start, area.pages_cnt)
+
+    self.machine.coherence.invalidate_pages(area.pages_start, area.pages_cnt)
 
   def free_page(self, page):
     """
@@ -639,7 +1247,10 @@ class MemoryController(object):
 
     self.DEBUG('mc.free_page: page=%i, base=%s', page.index, UINT32_FMT(page.base_address))
 
-    self.__remove_page(page)
+    with self.lock:
+      self.__remove_page(page)
+
+    self.machine.coherence.invalidate_pages(page.index)
 
   def free_pages(self, page, count = 1):
     """
@@ -663,11 +1274,24 @@ class MemoryController(object):
     :raises ducky.errors.AccessViolationError: when requested page is not allocated.
     """
 
-    if index not in self.pages:
-      return self.alloc_specific_page(index)
-      # raise AccessViolationError('Page {} not allocated yet'.format(index))
+    pg = self.pages.get(index)
+
+    if pg is not None:
+      return pg
+
+    # Page is missing - check again, this time with lock held, another core may
+    # have allocated it in the meantime.
+    with self.lock:
+      if index not in self.pages:
+        area = self._area_of(index)
+
+        if area is not None:
+          return self.__set_page(area.create_page(self, index))
 
-    return self.pages[index]
+        return self.__alloc_page(index)
+        # raise AccessViolationError('Page {} not allocated yet'.format(index))
+
+      return self.pages[index]
 
   def get_pages(self, pages_start = 0, pages_cnt = None, ignore_missing = False):
     """
@@ -711,15 +1335,71 @@ class MemoryController(object):
 
     return self.get_pages(pages_start = pages_start, pages_cnt = pages_cnt, ignore_missing = ignore_missing)
 
-  def boot(self):
+  def track_dirty_pages(self):
+    """
+    Start tracking pages written to, to allow incremental snapshots. All
+    existing pages are considered dirty.
+
+    Writes through memory controller are recorded directly, cores wrap write
+    methods of pages, see :py:meth:`ducky.cpu.MMU._page_ops`. When tracking
+    is not enabled, there's no overhead.
+    """
+
+    self.DEBUG('mc.track_dirty_pages')
+
+    with self.lock:
+      if self.dirty_pages is not None:
+        return
+
+      self.dirty_pages = set(self.pages.keys())
+
+    # Let cores wrap write methods of pages
+    self.machine.coherence.invalidate_all()
+
+  def sync(self):
+    """
+    Flush RAM to its file, see ``memory.file``. Does nothing when RAM is not
+    backed by a file.
+    """
+
+    self.DEBUG('mc.sync')
+
+    if self.ram_file is not None:
+      self.ram.flush()
+
+  def boot(self, resume = False):
     """
     Prepare memory controller for immediate usage by other components.
+
+    :param bool resume: if set, machine is being resumed, and content of RAM
+      file is kept. Otherwise, RAM file is cleared.
     """
 
+    if self.ram_file is not None and resume is not True:
+      # Truncating the file drops all its blocks, so clearing is cheap
+      with open(self.ram_file, 'r+b') as f:
+        f.truncate(0)
+        f.truncate(self.size)
+
+    if self.machine.config.getbool('memory', 'dirty-tracking', default = False) is True:
+      self.track_dirty_pages()
+
     self.machine.tenh('mm: %s, %s available', sizeof_fmt(self.size, max_unit = 'Ki'), sizeof_fmt(self.size - len(self.pages) * PAGE_SIZE, max_unit = 'Ki'))
 
+    if self.merger is not None:
+      self.merger.boot()
+
   def halt(self):
-    pass
+    if self.merger is not None:
+      self.merger.halt()
+
+    self.sync()
+
+    # Let other VMs' pages keep the shared contents only
+    with self.lock:
+      for pg in itervalues(self.pages):
+        if isinstance(pg, SharedMemoryPage):
+          pg.release()
 
   def read_u8(self, addr):
     self.DEBUG('mc.read_u8: addr=%s', UINT32_FMT(addr))
@@ -739,14 +1419,146 @@ class MemoryController(object):
   def write_u8(self, addr, value):
     self.DEBUG('mc.write_u8: addr=%s, value=%s', UINT32_FMT(addr), UINT8_FMT(value))
 
-    self.get_page((addr & PAGE_MASK) >> PAGE_SHIFT).write_u8(addr & (PAGE_SIZE - 1), value)
+    index = (addr & PAGE_MASK) >> PAGE_SHIFT
+
+    self.get_page(index).write_u8(addr & (PAGE_SIZE - 1), value)
+
+    if self.dirty_pages is not None:
+      self.dirty_pages.add(index)
 
   def write_u16(self, addr, value):
     self.DEBUG('mc.write_u16: addr=%s, value=%s', UINT32_FMT(addr), UINT16_FMT(value))
 
-    self.get_page((addr & PAGE_MASK) >> PAGE_SHIFT).write_u16(addr & (PAGE_SIZE - 1), value)
+    index = (addr & PAGE_MASK) >> PAGE_SHIFT
+
+    self.get_page(index).write_u16(addr & (PAGE_SIZE - 1), value)
+
+    if self.dirty_pages is not None:
+      self.dirty_pages.add(index)
 
   def write_u32(self, addr, value):
     self.DEBUG('mc.write_u32: addr=%s, value=%s', UINT32_FMT(addr), UINT32_FMT(value))
 
-    self.get_page((addr & PAGE_MASK) >> PAGE_SHIFT).write_u32(addr & (PAGE_SIZE - 1), value)
+    index = (addr & PAGE_MASK) >> PAGE_SHIFT
+
+    self.get_page(index).write_u32(addr & (PAGE_SIZE - 1), value)
+
+    if self.dirty_pages is not None:
+      self.dirty_pages.add(index)
+
+  def _block_parts(self, addr, length):
+    """
+    Split memory area into parts, each of them lying in a single page.
+
+    :param u32_t addr: address of the first byte of the area.
+    :param int length: length of the area, in bytes.
+    :returns: generator of ``(page, offset, position, size)`` tuples - ``offset``
+      is the first byte of the part in ``page``, ``position`` is the offset of
+      the part from the beginning of the area.
+    :raises ducky.errors.AccessViolationError: when the area does not fit into
+      the memory.
+    """
+
+    if addr < 0 or length < 0 or addr + length > self.size:
+      raise AccessViolationError('Memory block out of bounds: addr=%s, length=%s' % (UINT32_FMT(addr), length))
+
+    position = 0
+
+    while position < length:
+      address = addr + position
+      offset = address & (PAGE_SIZE - 1)
+      size = min(PAGE_SIZE - offset, length - position)
+
+      yield self.get_page((address & PAGE_MASK) >> PAGE_SHIFT), offset, position, size
+
+      position += size
+
+  def _block_written(self, pg, offset, size):
+    """
+    Report write into a watched page to coherence bus, to let cores drop
+    cached instructions or PTEs, and record the page as dirty.
+    """
+
+    if self.dirty_pages is not None:
+      self.dirty_pages.add(pg.index)
+
+    coherence = self.machine.coherence
+
+    if pg.index in coherence.watched_pages:
+      coherence.memory_written(pg.base_address + offset, size)
+
+  def read_block(self, addr, length):
+    """
+    Read block of bytes. Block may span multiple pages, each page is accessed
+    just once.
+
+    :param u32_t addr: address of the first byte.
+    :param int length: number of bytes to read.
+    :rtype: bytearray
+    :raises ducky.errors.AccessViolationError: when the block does not fit into
+      the memory.
+    """
+
+    self.DEBUG('mc.read_block: addr=%s, length=%s', UINT32_FMT(addr), length)
+
+    buff = bytearray(length)
+
+    for pg, offset, position, size in self._block_parts(addr, length):
+      buff[position:position + size] = pg.read_block(offset, size)
+
+    return buff
+
+  def write_block(self, addr, buff):
+    """
+    Write block of bytes. Block may span multiple pages, each page is accessed
+    just once.
+
+    :param u32_t addr: address of the first byte.
+    :param buff: bytes to write - ``bytearray``, ``bytes``, or any iterable of
+      integers.
+    :raises ducky.errors.AccessViolationError: when the block does not fit into
+      the memory.
+    """
+
+    if not isinstance(buff, (bytearray, bytes)):
+      buff = bytearray(buff)
+
+    self.DEBUG('mc.write_block: addr=%s, length=%s', UINT32_FMT(addr), len(buff))
+
+    view = memoryview(buff)
+
+    for pg, offset, position, size in self._block_parts(addr, len(buff)):
+      pg.write_block(offset, view[position:position + size])
+      self._block_written(pg, offset, size)
+
+  def fill(self, addr, value, length):
+    """
+    Set block of bytes to the same value.
+
+    :param u32_t addr: address of the first byte.
+    :param int value: new value of bytes.
+    :param int length: number of bytes to set.
+    :raises ducky.errors.AccessViolationError: when the block does not fit into
+      the memory.
+    """
+
+    self.DEBUG('mc.fill: addr=%s, value=%s, length=%s', UINT32_FMT(addr), UINT8_FMT(value), length)
+
+    for pg, offset, position, size in self._block_parts(addr, length):
+      pg.fill(offset, value & 0xFF, size)
+      self._block_written(pg, offset, size)
+
+  def copy(self, dst, src, length):
+    """
+    Copy block of bytes. Source and destination blocks may overlap.
+
+    :param u32_t dst: address of the first byte of destination block.
+    :param u32_t src: address of the first byte of source block.
+    :param int length: number of bytes to copy.
+    :raises ducky.errors.AccessViolationError: when any of blocks does not fit
+      into the memory.
+    """
+
+    self.DEBUG('mc.copy: dst=%s, src=%s, length=%s', UINT32_FMT(dst), UINT32_FMT(src), length)
+
+    self.write_block(dst, self.read_block(src, length))
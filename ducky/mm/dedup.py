@@ -0,0 +1,213 @@
+"""
+Same-page merging - anonymous pages with identical content are replaced by
+read-only pages sharing a single copy of that content, and the first write
+into such page gives it its private copy again.
+
+Contents are shared through a process-wide store, therefore pages are merged
+not only within one virtual machine, but with pages of all machines running
+in the same process, e.g. VMs booted from the same binaries.
+
+Merging runs as a reactor task, scanning a few pages of memory in each step.
+To avoid merging pages that are being actively written to, page is merged only
+when its content did not change since the previous pass over memory.
+"""
+
+import threading
+
+from six.moves import range
+
+from . import PAGE_SIZE, ZeroMemoryPage
+from ..reactor import RunInIntervalTask
+
+#: Number of pages inspected by one step of merging task.
+DEFAULT_BATCH = 64
+
+#: Number of reactor loop iterations between two steps of merging task.
+DEFAULT_INTERVAL = 100
+
+#: When a pass over memory merges nothing, interval is doubled, up to this many
+#: times the configured interval.
+MAX_BACKOFF = 16
+
+class PageStore(object):
+  """
+  Reference-counted set of page contents shared by pages.
+  """
+
+  def __init__(self):
+    super(PageStore, self).__init__()
+
+    self.lock = threading.Lock()
+
+    #: Maps content to a pair of ``[content, number of pages]``. Stored content
+    #: object is handed to all pages with the same content.
+    self.contents = {}
+
+  def acquire(self, content):
+    """
+    Start using content.
+
+    :param bytes content: page content.
+    :returns: shared content object, equal to ``content``.
+    :rtype: bytes
+    """
+
+    with self.lock:
+      entry = self.contents.get(content)
+
+      if entry is None:
+        entry = self.contents[content] = [content, 0]
+
+      entry[1] += 1
+
+      return entry[0]
+
+  def release(self, content):
+    """
+    Stop using content. When no page uses the content, it's removed from the
+    store.
+
+    :param bytes content: content returned by :py:meth:`ducky.mm.dedup.PageStore.acquire`.
+    """
+
+    with self.lock:
+      entry = self.contents[content]
+      entry[1] -= 1
+
+      if entry[1] == 0:
+        del self.contents[content]
+
+  @property
+  def shared_pages(self):
+    """
+    Number of distinct contents in the store.
+    """
+
+    return len(self.contents)
+
+  @property
+  def sharing_pages(self):
+    """
+    Number of pages using contents from the store.
+    """
+
+    with self.lock:
+      return sum([entry[1] for entry in self.contents.values()])
+
+  @property
+  def saved_bytes(self):
+    """
+    Host memory saved by sharing contents, not counting pages merged into the
+    zero page.
+    """
+
+    return (self.sharing_pages - self.shared_pages) * PAGE_SIZE
+
+#: Store shared by all machines in the process.
+STORE = PageStore()
+
+class PageMerger(object):
+  """
+  Merges private anonymous pages of a memory controller with identical pages.
+
+  Cores must run in reactor's thread, see
+  :py:meth:`ducky.mm.MemoryController.merge_page`.
+
+  :param ducky.mm.MemoryController controller: controller whose pages are merged.
+  :param ducky.mm.dedup.PageStore store: store of shared contents.
+  :param int batch: number of pages inspected in one step.
+  :param int interval: number of reactor loop iterations between steps.
+  """
+
+  def __init__(self, controller, store = None, batch = None, interval = None):
+    super(PageMerger, self).__init__()
+
+    config = controller.machine.config
+
+    self.controller = controller
+    self.machine = controller.machine
+    self.store = store or STORE
+
+    self.batch = batch or config.getint('memory', 'dedup-batch', DEFAULT_BATCH)
+    self.interval = interval or config.getint('memory', 'dedup-interval', DEFAULT_INTERVAL)
+
+    self.task = RunInIntervalTask(self.interval, self.step)
+
+    #: Indices of pages yet to be inspected in the current pass.
+    self.queue = []
+
+    #: Hashes of page contents seen by the previous pass.
+    self.hashes = {}
+
+    self.passes = 0
+    self.merged_pages = 0
+    self.zero_pages = 0
+
+    self._pass_merged = 0
+
+  def boot(self):
+    self.machine.reactor.add_task(self.task)
+    self.machine.reactor.task_runnable(self.task)
+
+  def halt(self):
+    self.machine.reactor.remove_task(self.task)
+
+  def _start_pass(self):
+    controller = self.controller
+    page_class = controller._page_class
+
+    if self.passes > 0:
+      if self._pass_merged == 0:
+        self.task.ticks = min(self.task.ticks * 2, self.interval * MAX_BACKOFF)
+
+      else:
+        self.task.ticks = self.interval
+
+    self.passes += 1
+    self._pass_merged = 0
+
+    with controller.lock:
+      self.queue = [index for index, pg in controller.pages.items() if type(pg) is page_class]
+
+    self.queue.reverse()
+
+  def step(self, task = None):
+    """
+    Inspect next batch of pages, and merge those that did not change since
+    the previous pass.
+    """
+
+    if not self.queue:
+      self._start_pass()
+
+    controller = self.controller
+    page_class = controller._page_class
+    hashes = self.hashes
+
+    for _ in range(min(self.batch, len(self.queue))):
+      index = self.queue.pop()
+      pg = controller.pages.get(index)
+
+      if type(pg) is not page_class:
+        hashes.pop(index, None)
+        continue
+
+      content = bytes(pg.data)
+      digest = hash(content)
+
+      if hashes.get(index) != digest:
+        hashes[index] = digest
+        continue
+
+      del hashes[index]
+
+      shared = controller.merge_page(pg, content, self.store)
+
+      if shared is None:
+        continue
+
+      self._pass_merged += 1
+      self.merged_pages += 1
+
+      if isinstance(shared, ZeroMemoryPage):
+        self.zero_pages += 1
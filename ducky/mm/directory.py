@@ -0,0 +1,135 @@
+"""
+Sparse tables indexed by page or instruction numbers.
+"""
+
+#: By default, each table of :py:class:`ducky.mm.directory.PageDirectory`
+#: covers this many bits of an index.
+DEFAULT_DIRECTORY_BITS = 10
+
+class PageDirectory(object):
+  """
+  Two-level radix table, mapping integer indices - e.g. page indices - to
+  objects.
+
+  Upper bits of an index select a table in the directory, lower bits select an
+  entry in that table. Tables are allocated when the first entry falls into
+  them, and the directory itself has just one slot per table, therefore host
+  memory is spent only on parts of the index space that are actually used.
+  When the whole index space fits into a single table, directory is just
+  one list with a small overhead of an extra lookup.
+
+  Directory provides the usual mapping API. ``None`` cannot be stored as a value,
+  it marks empty entries.
+
+  :param int size: number of indices, valid indices are ``0`` to ``size - 1``.
+  :param int bits: number of index bits covered by a single table.
+  """
+
+  def __init__(self, size, bits = DEFAULT_DIRECTORY_BITS, *args, **kwargs):
+    super(PageDirectory, self).__init__(*args, **kwargs)
+
+    self.size = size
+    self.shift = bits
+    self.mask = (1 << bits) - 1
+
+    self.tables = [None] * ((size + self.mask) >> bits)
+
+    self._length = 0
+
+  def __repr__(self):
+    return '<%s: size=%i, entries=%i, tables=%i>' % (self.__class__.__name__, self.size, self._length, len([table for table in self.tables if table is not None]))
+
+  def __len__(self):
+    return self._length
+
+  def get(self, index, default = None):
+    if index >= self.size:
+      return default
+
+    table = self.tables[index >> self.shift]
+
+    if table is None:
+      return default
+
+    value = table[index & self.mask]
+
+    return default if value is None else value
+
+  def __getitem__(self, index):
+    value = self.get(index)
+
+    if value is None:
+      raise KeyError(index)
+
+    return value
+
+  def __contains__(self, index):
+    return self.get(index) is not None
+
+  def __setitem__(self, index, value):
+    assert value is not None
+
+    table = self.tables[index >> self.shift]
+
+    if table is None:
+      table = self.tables[index >> self.shift] = [None] * (self.mask + 1)
+
+    if table[index & self.mask] is None:
+      self._length += 1
+
+    table[index & self.mask] = value
+
+  def pop(self, index, *default):
+    table = self.tables[index >> self.shift]
+    value = None if table is None else table[index & self.mask]
+
+    if value is None:
+      if default:
+        return default[0]
+
+      raise KeyError(index)
+
+    table[index & self.mask] = None
+    self._length -= 1
+
+    return value
+
+  def __delitem__(self, index):
+    self.pop(index)
+
+  def clear(self):
+    """
+    Remove all entries, and release all tables.
+    """
+
+    self.tables[:] = [None] * len(self.tables)
+    self._length = 0
+
+  def items(self):
+    """
+    :returns: generator of ``(index, value)`` pairs, ordered by index.
+    """
+
+    for i, table in enumerate(self.tables):
+      if table is None:
+        continue
+
+      base = i << self.shift
+
+      for j, value in enumerate(table):
+        if value is not None:
+          yield base + j, value
+
+  def keys(self):
+    return (index for index, _ in self.items())
+
+  def values(self):
+    return (value for _, value in self.items())
+
+  def __iter__(self):
+    return self.keys()
+
+  # Python 2 - let six's helpers work with directories
+  iteritems = items
+  iterkeys = keys
+  itervalues = values
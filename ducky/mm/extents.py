@@ -0,0 +1,135 @@
+"""
+Index of free memory pages, used by memory controller to find pages for new
+allocations without scanning all pages.
+"""
+
+from bisect import bisect_right
+
+class FreeExtents(object):
+  """
+  Sorted set of free extents - continuous, non-overlapping ranges of free
+  pages. Each extent is kept as a pair of its first page, and the first page
+  after its end, and neighbouring extents are always merged.
+
+  Lookups use binary search, therefore their cost depends on number of extents,
+  i.e. on fragmentation of the memory, not on its size.
+
+  :param int size: number of pages. All pages are free at the beginning.
+  """
+
+  def __init__(self, size):
+    super(FreeExtents, self).__init__()
+
+    self.size = size
+
+    self.starts = [0]
+    self.ends = [size]
+
+    #: Number of free pages.
+    self.free = size
+
+  def __repr__(self):
+    return '<FreeExtents: free=%i, extents=%s>' % (self.free, ', '.join(['%i-%i' % (start, end - 1) for start, end in zip(self.starts, self.ends)]))
+
+  def __len__(self):
+    """
+    :returns: number of extents.
+    :rtype: int
+    """
+
+    return len(self.starts)
+
+  def _find(self, index):
+    """
+    Find extent that may contain a page.
+
+    :param int index: page index.
+    :returns: position of the last extent starting before or at ``index``,
+      or ``-1`` when there is no such extent.
+    :rtype: int
+    """
+
+    return bisect_right(self.starts, index) - 1
+
+  def is_free(self, index, count = 1):
+    """
+    Check whether a range of pages is free.
+
+    :param int index: first page of the range.
+    :param int count: number of pages.
+    :rtype: bool
+    """
+
+    i = self._find(index)
+
+    return i >= 0 and index + count <= self.ends[i]
+
+  def first_fit(self, count = 1, base = 0):
+    """
+    Find the first range of free pages that is long enough.
+
+    :param int count: number of requested pages.
+    :param int base: range must not start before this page.
+    :returns: index of the first page of the range, or ``None`` when there is
+      no such range.
+    """
+
+    starts, ends = self.starts, self.ends
+
+    for i in range(max(self._find(base), 0), len(starts)):
+      start = max(starts[i], base)
+
+      if ends[i] - start >= count:
+        return start
+
+    return None
+
+  def reserve(self, index, count = 1):
+    """
+    Remove range of pages from the set.
+
+    :param int index: first page of the range.
+    :param int count: number of pages.
+    :raises AssertionError: when any page of the range is not free.
+    """
+
+    i = self._find(index)
+
+    assert i >= 0 and index + count <= self.ends[i], 'Range not free: index=%i, count=%i' % (index, count)
+
+    start, end = self.starts[i], self.ends[i]
+    extents = [(s, e) for s, e in ((start, index), (index + count, end)) if s < e]
+
+    self.starts[i:i + 1] = [s for s, _ in extents]
+    self.ends[i:i + 1] = [e for _, e in extents]
+
+    self.free -= count
+
+  def release(self, index, count = 1):
+    """
+    Return range of pages to the set.
+
+    :param int index: first page of the range.
+    :param int count: number of pages.
+    :raises AssertionError: when any page of the range is already free.
+    """
+
+    starts, ends = self.starts, self.ends
+
+    i = bisect_right(starts, index)
+    start, end = index, index + count
+
+    assert (i == 0 or ends[i - 1] <= start) and (i == len(starts) or end <= starts[i]), 'Range already free: index=%i, count=%i' % (index, count)
+
+    first, last = i, i
+
+    if i > 0 and ends[i - 1] == start:
+      first, start = i - 1, starts[i - 1]
+
+    if i < len(starts) and starts[i] == end:
+      last, end = i + 1, ends[i]
+
+    starts[first:last] = [start]
+    ends[first:last] = [end]
+
+    self.free += count
@@ -6,17 +6,62 @@ There are two different kinds of objects that reactor manages:
 
 - task - it's called periodicaly, at least once in each reactor loop iteration
 - event - asynchronous events are queued and executed before running any tasks.
-  If there are no runnable tasks, reactor loop waits for incomming events.
+  If there are no runnable tasks, reactor loop waits for incomming events,
+  IO on registered file descriptors, or the nearest timer deadline.
+- timer - callback is called when its deadline passes, once or periodically.
+  Deadlines are measured by a monotonic clock, therefore they do not depend on
+  how fast the reactor's loop runs.
 """
 
 import collections
 import errno
+import heapq
+import itertools
+import os
 import select
+import threading
+import time
 
 from .interfaces import IReactorTask
 
 FDCallbacks = collections.namedtuple('FDCallbacks', ['on_read', 'on_write', 'on_error'])
 
+#: Clock used for timer deadlines.
+monotonic = getattr(time, 'monotonic', time.time)
+
+class Timer(object):
+  """
+  Timer registered with reactor, see :py:meth:`ducky.reactor.Reactor.call_at`.
+
+  :param float deadline: time - as returned by :py:func:`ducky.reactor.monotonic`
+    - when the callback is called.
+  :param float interval: if set, timer is periodic, and after each call its
+    deadline moves by ``interval`` seconds.
+  :param fn: callback to fire.
+  :param args: arguments for callback.
+  :param kwargs: keyword arguments for callback.
+  """
+
+  def __init__(self, deadline, interval, fn, *args, **kwargs):
+    self.deadline = deadline
+    self.interval = interval
+
+    self.fn = fn
+    self.args = args
+    self.kwargs = kwargs
+
+    self.cancelled = False
+
+  def __repr__(self):
+    return '<Timer: deadline=%s, interval=%s, fn=%s>' % (self.deadline, self.interval, self.fn)
+
+  def cancel(self):
+    """
+    Cancel the timer, its callback will not be called anymore.
+    """
+
+    self.cancelled = True
+
 class CallInReactorTask(IReactorTask):
   """
   This task request running particular function during the reactor loop. Useful
@@ -86,6 +131,10 @@ class SelectTask(IReactorTask):
 
     self.poll = select.poll()
 
+    #: Reading end of reactor's wakeup pipe, see
+    #: :py:meth:`ducky.reactor.Reactor.wakeup`.
+    self.wakeup_fd = None
+
   def add_fd(self, fd, on_read = None, on_write = None, on_error = None):
     """
     Register file descriptor with reactor. File descriptor will be checked for
@@ -125,11 +174,47 @@ class SelectTask(IReactorTask):
     self.poll.unregister(fd)
     del self.fds[fd]
 
+  def set_wakeup_fd(self, fd):
+    """
+    Set file descriptor whose only purpose is to interrupt waiting for IO.
+    Data written into it are discarded. Previous wakeup descriptor, if any,
+    is unregistered.
+
+    :param int fd: file descriptor, or ``None``.
+    """
+
+    if self.wakeup_fd is not None:
+      self.poll.unregister(self.wakeup_fd)
+
+    self.wakeup_fd = fd
+
+    if fd is not None:
+      self.poll.register(fd, select.POLLIN)
+
+  def _drain_wakeup_fd(self):
+    try:
+      while os.read(self.wakeup_fd, 512):
+        pass
+
+    except OSError as e:
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise e
+
   def run(self):
-    self.machine.DEBUG('%s.run: fds=%s', self.__class__.__name__, self.fds.keys())
+    self.wait(0.1)
+
+  def wait(self, timeout):
+    """
+    Wait for IO on registered file descriptors, and fire their callbacks.
+
+    :param timeout: maximal time to wait, in milliseconds, or ``None`` to wait
+      until there is IO on any registered descriptor, including the wakeup one.
+    """
+
+    self.machine.DEBUG('%s.wait: fds=%s, timeout=%s', self.__class__.__name__, self.fds.keys(), timeout)
 
     try:
-      events = self.poll.poll(0.1)
+      events = self.poll.poll(timeout)
 
     except select.error as e:
       if e.args[0] == errno.EINTR:
@@ -144,6 +229,10 @@ class SelectTask(IReactorTask):
     self.machine.DEBUG('%s.run: events=%s', self.__class__.__name__, events)
 
     for fd, events in events:
+      if fd == self.wakeup_fd:
+        self._drain_wakeup_fd()
+        continue
+
       callbacks = self.fds[fd]
 
       if events & select.POLLERR:
@@ -166,6 +255,15 @@ class SelectTask(IReactorTask):
 class Reactor(object):
   """
   Main reactor class.
+
+  Tasks may be added, removed, or their runnability changed by other threads,
+  e.g. by CPU cores running in their own threads. To let reactor's loop walk
+  the list of runnable tasks without holding a lock, the list is never
+  modified in place - each change replaces it with a new list.
+
+  When there is nothing to do, reactor's loop blocks in ``poll``, together
+  with file descriptors of devices. Other threads, and signal handlers, wake
+  it up by writing into a pipe, registered in the same ``poll`` set.
   """
 
   def __init__(self, machine):
@@ -173,11 +271,76 @@ class Reactor(object):
 
     self.tasks = []
     self.runnable_tasks = []
-    self.events = []
+    self.events = collections.deque()
+
+    self.lock = threading.RLock()
 
     self.fds = {}
     self.fds_task = SelectTask(self.machine, self.fds)
 
+    #: Heap of ``(deadline, sequence number, timer)`` tuples.
+    self.timers = []
+    self._timer_sequence = itertools.count()
+
+    #: Wakeup pipe, exists only while the loop runs.
+    self._wakeup_pipe = None
+
+    #: Set while the loop waits for something to do.
+    self._waiting = False
+
+  def _open_wakeup_pipe(self):
+    from .streams import fd_blocking
+
+    self._wakeup_pipe = os.pipe()
+
+    for fd in self._wakeup_pipe:
+      fd_blocking(fd, block = False)
+
+    self.fds_task.set_wakeup_fd(self._wakeup_pipe[0])
+
+  def _close_wakeup_pipe(self):
+    if self._wakeup_pipe is None:
+      return
+
+    self.fds_task.set_wakeup_fd(None)
+
+    for fd in self._wakeup_pipe:
+      os.close(fd)
+
+    self._wakeup_pipe = None
+
+  def reattach(self):
+    """
+    Called in a new process, running a clone of the machine - see
+    :py:meth:`ducky.machine.Machine.clone`. Wakeup pipe is shared with the
+    original process, therefore it's replaced by a new one.
+    """
+
+    if self._wakeup_pipe is None:
+      return
+
+    self._close_wakeup_pipe()
+    self._open_wakeup_pipe()
+
+  def wakeup(self):
+    """
+    If reactor's loop waits for something to do, wake it up. Can be called
+    from any thread, or from a signal handler.
+    """
+
+    pipe = self._wakeup_pipe
+
+    if self._waiting is not True or pipe is None:
+      return
+
+    try:
+      os.write(pipe[1], b'\0')
+
+    except OSError as e:
+      # Pipe is full, therefore the loop will wake up anyway
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise e
+
   def add_task(self, task):
     """
     Register task with reactor's main loop.
@@ -185,7 +348,8 @@ class Reactor(object):
 
     self.machine.DEBUG('%s.add_task: task=%s', self.__class__.__name__, task)
 
-    self.tasks.append(task)
+    with self.lock:
+      self.tasks = self.tasks + [task]
 
   def remove_task(self, task):
     """
@@ -194,8 +358,9 @@ class Reactor(object):
 
     self.machine.DEBUG('%s.remove_task: task=%s', self.__class__.__name__, task)
 
-    self.task_suspended(task)
-    self.tasks.remove(task)
+    with self.lock:
+      self.task_suspended(task)
+      self.tasks = [t for t in self.tasks if t is not task]
 
   def task_runnable(self, task):
     """
@@ -205,8 +370,11 @@ class Reactor(object):
 
     self.machine.DEBUG('%s.task_runnable: task=%s', self.__class__.__name__, task)
 
-    if task not in self.runnable_tasks:
-      self.runnable_tasks.append(task)
+    with self.lock:
+      if task not in self.runnable_tasks:
+        self.runnable_tasks = self.runnable_tasks + [task]
+
+    self.wakeup()
 
   def task_suspended(self, task):
     """
@@ -218,15 +386,17 @@ class Reactor(object):
 
     self.machine.DEBUG('%s.task_suspend: task=%s', self.__class__.__name__, task)
 
-    if task in self.runnable_tasks:
-      self.runnable_tasks.remove(task)
+    with self.lock:
+      if task in self.runnable_tasks:
+        self.runnable_tasks = [t for t in self.runnable_tasks if t is not task]
 
   def add_event(self, event):
     """
-    Enqueue asynchronous event.
+    Enqueue asynchronous event. Can be called from any thread.
     """
 
     self.events.append(event)
+    self.wakeup()
 
   def add_call(self, fn, *args, **kwargs):
     """
@@ -235,6 +405,77 @@ class Reactor(object):
 
     self.add_event(CallInReactorTask(fn, *args, **kwargs))
 
+  def _add_timer(self, timer):
+    with self.lock:
+      heapq.heappush(self.timers, (timer.deadline, next(self._timer_sequence), timer))
+
+    self.wakeup()
+
+    return timer
+
+  def call_at(self, deadline, fn, *args, **kwargs):
+    """
+    Call function when ``deadline`` passes. Function will be called in reactor
+    loop.
+
+    :param float deadline: time, as returned by :py:func:`ducky.reactor.monotonic`.
+    :rtype: ducky.reactor.Timer
+    :returns: new timer, it can be cancelled by its ``cancel()`` method.
+    """
+
+    self.machine.DEBUG('%s.call_at: deadline=%s, fn=%s', self.__class__.__name__, deadline, fn)
+
+    return self._add_timer(Timer(deadline, None, fn, *args, **kwargs))
+
+  def call_later(self, delay, fn, *args, **kwargs):
+    """
+    Call function after ``delay`` seconds. See
+    :py:meth:`ducky.reactor.Reactor.call_at`.
+    """
+
+    return self.call_at(monotonic() + delay, fn, *args, **kwargs)
+
+  def call_periodic(self, interval, fn, *args, **kwargs):
+    """
+    Call function every ``interval`` seconds, until the timer is cancelled.
+    Timer's ``interval`` attribute can be changed, new interval is used since
+    the next call. When reactor falls behind, missed calls are dropped.
+    See :py:meth:`ducky.reactor.Reactor.call_at`.
+    """
+
+    self.machine.DEBUG('%s.call_periodic: interval=%s, fn=%s', self.__class__.__name__, interval, fn)
+
+    return self._add_timer(Timer(monotonic() + interval, interval, fn, *args, **kwargs))
+
+  def run_timers(self, now = None):
+    """
+    Call callbacks of all timers whose deadline has passed, and reschedule
+    periodic timers.
+
+    :param float now: current time, :py:func:`ducky.reactor.monotonic` is
+      called when not set.
+    """
+
+    now = now if now is not None else monotonic()
+    timers = self.timers
+
+    while timers and timers[0][0] <= now:
+      with self.lock:
+        _, _, timer = heapq.heappop(timers)
+
+      if timer.cancelled is True:
+        continue
+
+      if timer.interval is not None:
+        timer.deadline += timer.interval
+
+        if timer.deadline <= now:
+          timer.deadline = now + timer.interval
+
+        self._add_timer(timer)
+
+      timer.fn(*timer.args, **timer.kwargs)
+
   def add_fd(self, fd, on_read = None, on_write = None, on_error = None):
     """
     Register file descriptor with reactor. File descriptor will be checked for
@@ -252,11 +493,13 @@ class Reactor(object):
     """
 
     self.machine.DEBUG('%s.add_fd: fd=%s, on_read=%s, on_write=%s, on_error=%s', self.__class__.__name__, fd, on_read, on_write, on_error)
-    self.fds_task.add_fd(fd, on_read = on_read, on_write = on_write, on_error = on_error)
 
-    if len(self.fds) == 1:
-      self.add_task(self.fds_task)
-      self.task_runnable(self.fds_task)
+    with self.lock:
+      self.fds_task.add_fd(fd, on_read = on_read, on_write = on_write, on_error = on_error)
+
+      if len(self.fds) == 1:
+        self.add_task(self.fds_task)
+        self.task_runnable(self.fds_task)
 
   def remove_fd(self, fd):
     """
@@ -266,36 +509,68 @@ class Reactor(object):
     """
 
     self.machine.DEBUG('Reactor.remove_fd: fd=%s', fd)
-    self.fds_task.remove_fd(fd)
 
-    if not self.fds:
-      self.remove_task(self.fds_task)
+    with self.lock:
+      self.fds_task.remove_fd(fd)
+
+      if not self.fds:
+        self.remove_task(self.fds_task)
+
+  def _wait(self):
+    timers = self.timers
+
+    self._waiting = True
+
+    try:
+      # Check again, something could have arrived before the flag was set
+      if self.events or [task for task in self.runnable_tasks if task is not self.fds_task]:
+        return
+
+      timeout = None
+
+      if timers:
+        timeout = max(0, int((timers[0][0] - monotonic()) * 1000.0) + 1)
+
+      self.fds_task.wait(timeout)
+
+    finally:
+      self._waiting = False
 
   def run(self):
     """
     Starts reactor loop. Enters endless loop, calling runnable tasks and events,
-    and - in case there are no runnable tasks - waits for new events.
+    and - in case there are no runnable tasks - waits for new events, IO on
+    registered file descriptors, or the nearest timer deadline.
 
-    When there are no tasks managed by reactor, loop quits.
+    When there are no tasks managed by reactor, loop quits. Timers alone do
+    not keep the loop running.
     """
 
-    while True:
-      if not self.tasks:
-        break
+    timers = self.timers
+    events = self.events
+    fds_task = self.fds_task
+
+    self._open_wakeup_pipe()
+
+    try:
+      while True:
+        if not self.tasks:
+          break
+
+        if timers and timers[0][0] <= monotonic():
+          self.run_timers()
+
+        runnable_tasks = self.runnable_tasks
+
+        if runnable_tasks and (len(runnable_tasks) > 1 or runnable_tasks[0] is not fds_task):
+          for task in runnable_tasks:
+            task.run()
 
-      if self.runnable_tasks:
-        for task in self.runnable_tasks:
-          task.run()
+        elif not events:
+          self._wait()
 
-        while self.events:
-          e = self.events.pop(0)
-          e.run()
+        while events:
+          events.popleft().run()
 
-      else:
-        # This would be better with some sort of interruptible sleep...
-        # Maybe use an Event for that, and avoid using Queue when it's
-        # not necessary. But that needs more testing, and since I don't
-        # have much use for machine that's totally idle, that will come
-        # one day in the future
-        import time
-        time.sleep(0.01)
+    finally:
+      self._close_wakeup_pipe()
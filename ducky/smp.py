@@ -0,0 +1,146 @@
+"""
+Threaded SMP support - each CPU core can run its own execution loop in a
+dedicated host thread, while devices and other reactor tasks stay with the
+reactor, in the thread that called :py:meth:`ducky.machine.Machine.run`.
+
+On free-threaded (no-GIL) Python builds cores then execute in parallel. On
+builds with GIL the machine still works correctly, there is just no speedup.
+
+Core thread provides the subset of :py:class:`ducky.reactor.Reactor` API
+cores use to manage their runnability, therefore core can use either reactor
+or its thread as its *executor*, without knowing which one it is.
+"""
+
+import collections
+import threading
+
+from .reactor import CallInReactorTask
+
+class CoreThread(threading.Thread):
+  """
+  Host thread running a single CPU core.
+
+  Core is stepped as long as it is runnable. When it is not - e.g. it's
+  idle, waiting for an interrupt - thread sleeps until core becomes runnable
+  again, or until there is a call enqueued by other threads.
+
+  :param ducky.cpu.CPUCore core: core this thread is running.
+  """
+
+  def __init__(self, core):
+    super(CoreThread, self).__init__(name = 'ducky-core-{}'.format(core.cpuid))
+
+    self.daemon = True
+
+    self.core = core
+    self.machine = core.cpu.machine
+
+    self.runnable = False
+    self.quit = False
+
+    self.calls = collections.deque()
+    self.condition = threading.Condition()
+
+  def __repr__(self):
+    return '<CoreThread: core=%s>' % self.core.cpuid
+
+  def _wakeup(self):
+    with self.condition:
+      self.condition.notify()
+
+  def add_task(self, task):
+    """
+    Register core with this executor. Thread serves its core only, therefore
+    there is nothing to do.
+    """
+
+    pass
+
+  def remove_task(self, task):
+    """
+    Unregister core - thread will quit its loop.
+    """
+
+    self.machine.DEBUG('%s.remove_task: task=%s', self.__class__.__name__, task)
+
+    self.stop()
+
+  def task_runnable(self, task):
+    """
+    Core is runnable, it will be stepped in thread's loop.
+    """
+
+    self.machine.DEBUG('%s.task_runnable: task=%s', self.__class__.__name__, task)
+
+    with self.condition:
+      self.runnable = True
+      self.condition.notify()
+
+  def task_suspended(self, task):
+    """
+    Core is no longer runnable, thread will wait for it to become runnable
+    again.
+    """
+
+    self.machine.DEBUG('%s.task_suspended: task=%s', self.__class__.__name__, task)
+
+    with self.condition:
+      self.runnable = False
+
+  def add_call(self, fn, *args, **kwargs):
+    """
+    Enqueue function call. Function will be called in core's thread, between
+    two instructions.
+    """
+
+    self.calls.append(CallInReactorTask(fn, *args, **kwargs))
+    self._wakeup()
+
+  def stop(self):
+    """
+    Ask thread to quit its loop. Does not wait for thread to finish, see
+    :py:meth:`ducky.smp.CoreThread.join`.
+    """
+
+    self.machine.DEBUG('%s.stop', self.__class__.__name__)
+
+    with self.condition:
+      self.quit = True
+      self.condition.notify()
+
+  def run(self):
+    self.machine.DEBUG('%s.run: core=%s', self.__class__.__name__, self.core)
+
+    core = self.core
+    calls = self.calls
+
+    try:
+      while not self.quit:
+        while calls:
+          calls.popleft().run()
+
+        if self.runnable is True:
+          core.run()
+          continue
+
+        with self.condition:
+          while not self.quit and not self.runnable and not calls:
+            self.condition.wait()
+
+    except Exception as e:
+      self.machine.EXCEPTION(e)
+      self.machine.reactor.add_call(self.machine.die, e)
+
+    self.machine.DEBUG('%s.run: quit', self.__class__.__name__)
+
+def current_core_thread():
+  """
+  Return core thread the caller runs in.
+
+  :rtype: :py:class:`ducky.smp.CoreThread`
+  :returns: current core thread, or ``None`` when called from other threads.
+  """
+
+  thread = threading.current_thread()
+
+  return thread if isinstance(thread, CoreThread) else None
@@ -1,8 +1,72 @@
+"""
+Snapshots of virtual machine state.
+
+State is captured as a tree of :py:class:`ducky.snapshot.SnapshotNode`
+objects. Core dump files store the tree in a versioned binary format:
+
+  - header - magic bytes, format version, and compression method;
+  - sequence of records, each prefixed by its type and length. The first
+    record holds state of CPUs and other components except memory pages.
+    Each memory page gets its own record with raw page content, and pages
+    full of zeros are stored as just their index. The last record marks
+    the end of the snapshot.
+
+Records are optionally compressed, as one stream, by ``zlib`` or ``lzma``.
+Both writing and reading process records one by one, without creating the
+whole file content in memory. Uncompressed snapshots can be loaded lazily:
+file is memory-mapped, and contents of pages are just views of the mapping,
+read from disk when accessed for the first time.
+"""
+
+import mmap
+import struct
+import zlib
+
+from ctypes import c_ubyte as u8_t, c_ushort as u16_t, c_uint as u32_t
+
 from six import print_, iteritems
 from six.moves import cPickle as pickle
 
+from .errors import InvalidResourceError
 from .util import BinaryFile
 
+try:
+  import lzma
+
+except ImportError:
+  lzma = None
+
+#: Snapshot file starts with these bytes.
+SNAPSHOT_MAGIC = b'DUCKYSNP'
+
+#: Current version of snapshot file format.
+SNAPSHOT_VERSION = 1
+
+#: Supported compression methods.
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+
+COMPRESSION_METHODS = {
+  'none': COMPRESSION_NONE,
+  'zlib': COMPRESSION_ZLIB,
+  'lzma': COMPRESSION_LZMA
+}
+
+RECORD_END       = 0
+RECORD_STATE     = 1
+RECORD_PAGE      = 2
+RECORD_ZERO_PAGE = 3
+
+_HEADER = struct.Struct('<8sHB')
+_RECORD = struct.Struct('<BI')
+_INDEX = struct.Struct('<I')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+
+#: Size of chunks read from compressed files.
+_CHUNK_SIZE = 65536
+
 class SnapshotNode(object):
   def __init__(self, *fields):
     self.__children = {}
@@ -18,6 +82,9 @@ class SnapshotNode(object):
   def get_child(self, name):
     return self.__children[name]
 
+  def remove_child(self, name):
+    return self.__children.pop(name)
+
   def get_children(self):
     return self.__children
 
@@ -47,8 +114,8 @@ class VMState(SnapshotNode):
     self.logger = logger
 
   @staticmethod
-  def capture_vm_state(machine, suspend = True):
-    machine.DEBUG('capture_vm_state')
+  def capture_vm_state(machine, suspend = True, incremental = False, cow = False):
+    machine.DEBUG('capture_vm_state: incremental=%s, cow=%s', incremental, cow)
 
     state = VMState(machine.LOGGER)
 
@@ -57,7 +124,7 @@ class VMState(SnapshotNode):
       machine.suspend()
 
     machine.DEBUG('capture state...')
-    machine.save_state(state)
+    machine.save_state(state, incremental = incremental, cow = cow)
 
     if suspend:
       machine.DEBUG('wake vm up...')
@@ -66,26 +133,382 @@ class VMState(SnapshotNode):
     return state
 
   @staticmethod
-  def load_vm_state(logger, filename):
-    return CoreDumpFile.open(logger, filename, 'r').load()
+  def load_vm_state(logger, filename, lazy = False):
+    with CoreDumpFile.open(logger, filename, 'r') as f_in:
+      return f_in.load(lazy = lazy)
 
-  def save(self, filename):
+  def save(self, filename, compression = 'none'):
     with CoreDumpFile.open(self.logger, filename, 'w') as f_out:
-      f_out.save(self)
+      f_out.save(self, compression = compression)
+
+def merge_states(states):
+  """
+  Merge chain of snapshots into a single, full snapshot.
+
+  The first snapshot must be a full one, each following one is an incremental
+  snapshot, captured after the previous one. The result is the last snapshot,
+  with memory pages of all snapshots in the chain.
+
+  :param list states: list of :py:class:`ducky.snapshot.VMState` objects.
+  :rtype: ducky.snapshot.VMState
+  :raises ducky.errors.InvalidResourceError: when the chain does not start
+    with a full snapshot.
+  """
+
+  def __memory(state):
+    return state.get_child('machine').get_child('memory')
+
+  if getattr(__memory(states[0]), 'incremental', False) is True:
+    raise InvalidResourceError('Chain of snapshots must start with a full snapshot')
+
+  pages = {}
+
+  for state in states:
+    memory = __memory(state)
+
+    for index in getattr(memory, 'removed_pages', None) or []:
+      pages.pop(index, None)
+
+    for pg_state in memory.get_page_states():
+      memory.remove_child('page_{}'.format(pg_state.index))
+      pages[pg_state.index] = pg_state
+
+  memory = __memory(states[-1])
+  memory.incremental = False
+  memory.removed_pages = []
+
+  for index, pg_state in sorted(iteritems(pages)):
+    memory.add_child('page_{}'.format(index), pg_state)
+
+  return states[-1]
+
+def _compressor(compression):
+  if compression == COMPRESSION_ZLIB:
+    return zlib.compressobj()
+
+  if compression == COMPRESSION_LZMA and lzma is not None:
+    return lzma.LZMACompressor()
+
+  raise InvalidResourceError('Unsupported snapshot compression: %s' % compression)
+
+def _decompressor(compression):
+  if compression == COMPRESSION_ZLIB:
+    return zlib.decompressobj()
+
+  if compression == COMPRESSION_LZMA and lzma is not None:
+    return lzma.LZMADecompressor()
+
+  raise InvalidResourceError('Unsupported snapshot compression: %s' % compression)
+
+class _RecordReader(object):
+  """
+  Reads records from a (possibly compressed) stream, decompressing only as
+  much data as needed.
+  """
+
+  def __init__(self, stream, compression):
+    self.stream = stream
+    self.decompressor = _decompressor(compression) if compression != COMPRESSION_NONE else None
+
+    self.buffer = bytearray()
+
+  def _read(self, length):
+    if self.decompressor is None:
+      data = self.stream.read(length)
+
+      if len(data) != length:
+        raise InvalidResourceError('Snapshot file is truncated')
+
+      return data
+
+    while len(self.buffer) < length:
+      chunk = self.stream.read(_CHUNK_SIZE)
+
+      if not chunk:
+        raise InvalidResourceError('Snapshot file is truncated')
+
+      self.buffer += self.decompressor.decompress(chunk)
+
+    data = bytes(self.buffer[0:length])
+    del self.buffer[0:length]
+
+    return data
+
+  def __iter__(self):
+    while True:
+      record_type, length = _RECORD.unpack(self._read(_RECORD.size))
+
+      if record_type == RECORD_END:
+        return
+
+      yield record_type, self._read(length)
+
+class _MappedRecordReader(object):
+  """
+  Reads records of an uncompressed snapshot from a memory-mapped file. Payloads
+  are views of the mapping, no data are copied.
+  """
+
+  def __init__(self, stream, offset):
+    self.mapping = mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ)
+    self.view = memoryview(self.mapping)
+    self.offset = offset
+
+  def __iter__(self):
+    view, offset = self.view, self.offset
+
+    while True:
+      if offset + _RECORD.size > len(view):
+        raise InvalidResourceError('Snapshot file is truncated')
+
+      record_type, length = _RECORD.unpack_from(view, offset)
+      offset += _RECORD.size
+
+      if record_type == RECORD_END:
+        return
+
+      if offset + length > len(view):
+        raise InvalidResourceError('Snapshot file is truncated')
+
+      yield record_type, view[offset:offset + length]
+
+      offset += length
 
 class CoreDumpFile(BinaryFile):
   @staticmethod
   def open(*args, **kwargs):
     return BinaryFile.do_open(*args, klass = CoreDumpFile, **kwargs)
 
-  def load(self):
-    self.DEBUG('CoreDumpFile.load')
+  def load(self, lazy = False):
+    """
+    Load snapshot. Snapshots saved as a pickled tree, by older versions, are
+    accepted as well.
+
+    :param bool lazy: if set, and snapshot is not compressed, file is
+      memory-mapped, and contents of pages are read-only views of the mapping
+      instead of their copies. Contents of pages full of zeros are always
+      :py:data:`ducky.mm.ZERO_PAGE`.
+    :rtype: ducky.snapshot.VMState
+    :raises ducky.errors.InvalidResourceError: when file is malformed.
+    """
+
+    self.DEBUG('CoreDumpFile.load: lazy=%s', lazy)
+
+    header = self.read(_HEADER.size)
+
+    if not header.startswith(SNAPSHOT_MAGIC):
+      self.seek(0)
+      return pickle.load(self)
+
+    magic, version, compression = _HEADER.unpack(header)
+
+    if version > SNAPSHOT_VERSION:
+      raise InvalidResourceError('Unsupported snapshot version: %s' % version)
+
+    from .mm import MemoryPageState, ZERO_PAGE
 
-    return pickle.load(self)
+    if lazy is True and compression == COMPRESSION_NONE:
+      reader = _MappedRecordReader(self.stream, _HEADER.size)
 
-  def save(self, state):
-    self.DEBUG('CoreDumpFile.save: state=%s', state)
+    else:
+      reader = _RecordReader(self.stream, compression)
+      lazy = False
+
+    state, memory = None, None
+
+    for record_type, payload in reader:
+      if record_type == RECORD_STATE:
+        state = pickle.loads(bytes(payload))
+        memory = state.get_child('machine').get_children().get('memory')
+        continue
+
+      if memory is None:
+        raise InvalidResourceError('Snapshot page found before machine state')
+
+      index = _INDEX.unpack_from(payload)[0]
+
+      if record_type == RECORD_PAGE:
+        content = payload[_INDEX.size:] if lazy is True else bytearray(payload[_INDEX.size:])
+
+      elif record_type == RECORD_ZERO_PAGE:
+        content = ZERO_PAGE if lazy is True else bytearray(ZERO_PAGE)
+
+      else:
+        raise InvalidResourceError('Unknown snapshot record: %s' % record_type)
+
+      page_state = memory.add_child('page_{}'.format(index), MemoryPageState())
+      page_state.index = index
+      page_state.content = content
+
+    if state is None:
+      raise InvalidResourceError('Snapshot contains no machine state')
+
+    return state
+
+  def save(self, state, compression = 'none'):
+    """
+    Save snapshot.
+
+    :param ducky.snapshot.VMState state: snapshot.
+    :param str compression: ``none``, ``zlib`` or ``lzma``.
+    """
+
+    self.DEBUG('CoreDumpFile.save: state=%s, compression=%s', state, compression)
+
+    from .mm import ZERO_PAGE
+
+    if compression not in COMPRESSION_METHODS:
+      raise InvalidResourceError('Unsupported snapshot compression: %s' % compression)
+
+    compression = COMPRESSION_METHODS[compression]
+    compressor = _compressor(compression) if compression != COMPRESSION_NONE else None
+
+    def __write(data):
+      self.write(data if compressor is None else compressor.compress(data))
+
+    def __record(record_type, payload):
+      __write(_RECORD.pack(record_type, len(payload)))
+      __write(payload)
+
+    self.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, compression))
+
+    # Pages are stored as records of their own - detach them from the tree
+    # before pickling it.
+    memory = state.get_child('machine').get_children().get('memory')
+    pages = [memory.remove_child(name) for name in list(memory.get_children().keys()) if name.startswith('page_')] if memory is not None else []
 
     logger, state.logger = state.logger, None
-    pickle.dump(state, self)
-    state.logger = logger
+
+    try:
+      __record(RECORD_STATE, pickle.dumps(state, 2))
+
+    finally:
+      state.logger = logger
+
+      for page_state in pages:
+        memory.add_child('page_{}'.format(page_state.index), page_state)
+
+    for page_state in sorted(pages, key = lambda page_state: page_state.index):
+      if page_state.content == ZERO_PAGE:
+        __record(RECORD_ZERO_PAGE, _INDEX.pack(page_state.index))
+
+      else:
+        __record(RECORD_PAGE, _INDEX.pack(page_state.index) + bytes(page_state.content))
+
+    __record(RECORD_END, b'')
+
+    if compressor is not None:
+      self.write(compressor.flush())
+
+class CoreDumpReader(object):
+  """
+  Random access to memory captured by a snapshot. Pages are indexed by their
+  numbers, and, when the snapshot is loaded lazily, their contents are read
+  from memory-mapped file only when accessed. Pages missing in the snapshot
+  are read as zeros.
+
+  :param ducky.snapshot.VMState state: snapshot.
+  """
+
+  def __init__(self, state):
+    super(CoreDumpReader, self).__init__()
+
+    from .mm import ZERO_PAGE
+
+    self.state = state
+    self.pages = dict((pg.index, pg.content) for pg in state.get_child('machine').get_child('memory').get_page_states())
+
+    self._zero_page = ZERO_PAGE
+
+  @staticmethod
+  def open(logger, filename, deltas = None):
+    """
+    Load snapshot, and create its reader.
+
+    :param str filename: path to snapshot file.
+    :param list deltas: if set, paths to incremental snapshots, merged with
+      the snapshot in the given order.
+    :rtype: ducky.snapshot.CoreDumpReader
+    """
+
+    states = [VMState.load_vm_state(logger, path, lazy = True) for path in [filename] + (deltas or [])]
+
+    return CoreDumpReader(merge_states(states) if len(states) > 1 else states[0])
+
+  def page(self, index):
+    """
+    Get content of a page.
+
+    :param int index: index of page.
+    """
+
+    return self.pages.get(index, self._zero_page)
+
+  def iter_pages(self, empty_pages = False):
+    """
+    Iterate over pages captured by the snapshot, in order of their addresses.
+
+    :param bool empty_pages: if not set, pages full of zeros are skipped.
+    :returns: pairs of page index and its content.
+    """
+
+    for index in sorted(self.pages.keys()):
+      content = self.pages[index]
+
+      if empty_pages is False and content == self._zero_page:
+        continue
+
+      yield index, content
+
+  def read_block(self, address, length):
+    """
+    Read block of memory.
+
+    :param u32_t address: address of the first byte.
+    :param int length: number of bytes.
+    :rtype: bytearray
+    """
+
+    from .mm import PAGE_SIZE, PAGE_SHIFT
+
+    buff = bytearray()
+
+    while length > 0:
+      offset = address & (PAGE_SIZE - 1)
+      size = min(PAGE_SIZE - offset, length)
+
+      buff += bytearray(self.page(address >> PAGE_SHIFT)[offset:offset + size])
+
+      address += size
+      length -= size
+
+    return buff
+
+  def read_u8(self, address):
+    return u8_t(self.read_block(address, 1)[0])
+
+  def read_u16(self, address):
+    return u16_t(_U16.unpack_from(self.read_block(address, 2))[0])
+
+  def read_u32(self, address):
+    return u32_t(_U32.unpack_from(self.read_block(address, 4))[0])
+
+  def iter_rows(self, address, length, width = 32):
+    """
+    Iterate over block of memory in rows of bytes, e.g. for hex dumps. Only
+    one row is read at a time.
+
+    :param u32_t address: address of the first byte.
+    :param int length: number of bytes.
+    :param int width: number of bytes in a row.
+    :returns: pairs of address of row and its bytes.
+    """
+
+    end = address + length
+
+    while address < end:
+      size = min(width, end - address)
+
+      yield address, self.read_block(address, size)
+
+      address += size
@@ -3,10 +3,9 @@ import optparse
 import string
 
 from six import print_, iteritems
-from functools import partial
 
-from ..snapshot import CoreDumpFile
-from ..mm import PAGE_SIZE, UINT32_FMT, PAGE_MASK, u32_t, u16_t, u8_t, UINT8_FMT, UINT16_FMT
+from ..snapshot import CoreDumpReader
+from ..mm import PAGE_SIZE, UINT32_FMT, UINT8_FMT, UINT16_FMT
 from ..mm.binary import File, SectionTypes
 from ..cpu import CoreFlags
 from ..cpu.registers import Registers
@@ -55,42 +54,50 @@ def show_memory(logger, state):
   logger.info('  # of dirty pages: %s', len(state.get_page_states()))
   logger.info('')
 
-def show_pages(logger, state, empty_pages = False):
-  logger.info('=== Memory pages ===')
-
+def __show_rows(logger, rows):
   GREEN = logger.handlers[0].formatter.green
   WHITE = logger.handlers[0].formatter.white
 
-  for pg in sorted(state.get_child('machine').get_child('memory').get_page_states(), key = lambda x: x.index):
-    if not empty_pages and all(i == 0 for i in pg.content):
-      continue
+  for address, row in rows:
+    s = []
+    t = []
 
-    CPR = 32
-    pg_addr = pg.index * PAGE_SIZE
+    for b in row:
+      c = '%02X' % b
+      s.append(GREEN(c) if b == 0 else WHITE(c))
 
-    logger.info('  Page #%8i   %s    %s', pg.index, ' '.join(['%02X' % i for i in range(CPR)]), '0123456789ABCDEF0123456789ABCDEF')
-    # logger.info('    Flags: %s', pg.flags.to_string())
+      c = chr(b)
+      if c in string.printable[0:-5]:
+        c = r'%' if c == '%' else c
+        t.append(c)
 
-    for i in range(0, 256 // CPR):
-      s = []
-      t = []
+      else:
+        t.append('.')
 
-      for b in pg.content[CPR * i:CPR * (i + 1)]:
-        c = '%02X' % b
-        s.append(GREEN(c) if b == 0 else WHITE(c))
+    logger.info('    ' + UINT32_FMT(address) + ':    ' + ' '.join(s) + '    ' + ''.join(t))
 
-        c = chr(b)
-        if c in string.printable[0:-5]:
-          c = r'%' if c == '%' else c
-          t.append(c)
+def show_pages(logger, reader, empty_pages = False):
+  logger.info('=== Memory pages ===')
 
-        else:
-          t.append('.')
+  CPR = 32
 
-      logger.info('    ' + UINT32_FMT(pg_addr + i * CPR) + ':    ' + ' '.join(s) + '    ' + ''.join(t))
+  for index, _ in reader.iter_pages(empty_pages = empty_pages):
+    logger.info('  Page #%8i   %s    %s', index, ' '.join(['%02X' % i for i in range(CPR)]), '0123456789ABCDEF0123456789ABCDEF')
+
+    __show_rows(logger, reader.iter_rows(index * PAGE_SIZE, PAGE_SIZE, width = CPR))
 
     logger.info('')
 
+def show_hexdump(logger, reader, hexdumps):
+  logger.info('=== Memory ===')
+
+  for hexdump in hexdumps:
+    address, length = hexdump.split(':')
+
+    __show_rows(logger, reader.iter_rows(str2int(address), str2int(length)))
+
+  logger.info('')
+
 def __load_forth_symbols(logger):
   symbols = {}
 
@@ -104,27 +111,12 @@ def __load_forth_symbols(logger):
 
   return symbols
 
-def __read(state, cnt, address):
-  pid = (address & PAGE_MASK) >> 8
-  offset = address & 0xFF
-
-  pg = [pg for pg in state.get_child('machine').get_child('memory').get_page_states() if pg.index == pid][0]
-
-  if cnt == 1:
-    return u8_t(pg.content[offset])
-
-  if cnt == 2:
-    return u16_t(pg.content[offset] | (pg.content[offset + 1] << 8))
-
-  if cnt == 4:
-    return u32_t(pg.content[offset] | (pg.content[offset + 1] << 8) | (pg.content[offset + 2] << 16) | (pg.content[offset + 3] << 24))
-
-def __show_forth_word(state, symbols, base_address, ending_addresses):
+def __show_forth_word(reader, symbols, base_address, ending_addresses):
   I = get_logger().info
 
-  __read_u8  = partial(__read, state, 1)
-  __read_u16 = partial(__read, state, 2)
-  __read_u32 = partial(__read, state, 4)
+  __read_u8  = reader.read_u8
+  __read_u16 = reader.read_u16
+  __read_u32 = reader.read_u32
 
   namelen = __read_u8(base_address + 7).value
 
@@ -135,7 +127,7 @@ def __show_forth_word(state, symbols, base_address, ending_addresses):
   I('CRC:          %s', UINT16_FMT(__read_u16(base_address + 4)))
   I('flags:        %s', UINT8_FMT(__read_u8(base_address + 6)))
   I('namelen:      %s', namelen)
-  I('name:         %s', ''.join([chr(__read_u8(base_address + 8 + i).value) for i in range(0, namelen)]))
+  I('name:         %s', ''.join([chr(b) for b in reader.read_block(base_address + 8, namelen)]))
 
   while True:
     code_token = __read_u32(code_address).value
@@ -151,21 +143,21 @@ def __show_forth_word(state, symbols, base_address, ending_addresses):
 
     code_address += 4
 
-def show_forth_word(logger, state, base_address):
+def show_forth_word(logger, reader, base_address):
   I = get_logger().info
 
   I('=== FORTH word ===')
 
   symbols = __load_forth_symbols(logger)
 
-  __show_forth_word(state, symbols, base_address, [[k for k, v in iteritems(symbols) if v == 'EXIT'][0]])
+  __show_forth_word(reader, symbols, base_address, [[k for k, v in iteritems(symbols) if v == 'EXIT'][0]])
 
-def show_forth_dict(logger, state, last):
+def show_forth_dict(logger, reader, last):
   I = get_logger().info
 
   I('== FORTH dictionary ===')
 
-  __read_u32 = partial(__read, state, 4)
+  __read_u32 = reader.read_u32
 
   symbols = __load_forth_symbols(logger)
 
@@ -174,15 +166,15 @@ def show_forth_dict(logger, state, last):
 
   while base_address != 0x00000000:
     I('')
-    __show_forth_word(state, symbols, base_address, ending_addresses)
+    __show_forth_word(reader, symbols, base_address, ending_addresses)
     base_address = __read_u32(base_address).value
 
-def show_dump(state, dumps):
+def show_dump(reader, dumps):
   I = get_logger().info
 
-  __read_u8  = partial(__read, state, 1)
-  __read_u16 = partial(__read, state, 2)
-  __read_u32 = partial(__read, state, 4)
+  __read_u8  = reader.read_u8
+  __read_u16 = reader.read_u16
+  __read_u32 = reader.read_u32
 
   for i, dump in enumerate(dumps):
     fmt, address = dump.split(':')
@@ -212,6 +204,7 @@ def main():
   add_common_options(parser)
 
   parser.add_option('-i', dest = 'file_in', default = None, help = 'Input file')
+  parser.add_option('--delta', dest = 'deltas', default = [], action = 'append', metavar = 'FILE', help = 'Incremental snapshot, taken after the input file or the previous one')
 
   parser.add_option('-H',         dest = 'header',   default = False, action = 'store_true', help = 'Show file header')
   parser.add_option('-C',         dest = 'cores',    default = False, action = 'store_true', help = 'Show cores')
@@ -221,6 +214,7 @@ def main():
   parser.add_option('--forth-word',  dest = 'forth_word',  default = None,  action = 'store',    help = 'Show FORTH word')
   parser.add_option('--forth-dict',  dest = 'forth_dict',  default = None,  action = 'store',      help = 'Show FORTH dictionary')
   parser.add_option('--dump',  dest = 'dumps',  default = [],  action = 'append',      help = 'Show FORTH dictionary')
+  parser.add_option('--hexdump', dest = 'hexdumps', default = [], action = 'append', metavar = 'ADDRESS:LENGTH', help = 'Show block of memory')
   parser.add_option('-a',         dest = 'all',      default = False, action = 'store_true', help = 'All of above')
 
   parser.add_option('-Q',         dest = 'queries',  default = [],    action = 'append',     help = 'Query snapshot')
@@ -236,36 +230,42 @@ def main():
 
   logger.info('Input file: %s', options.file_in)
 
-  with CoreDumpFile.open(logger, options.file_in, 'r') as f_in:
-    state = f_in.load()
+  for filename in options.deltas:
+    logger.info('Incremental snapshot: %s', filename)
 
-    if not options.queries:
-      logger.info('')
+  reader = CoreDumpReader.open(logger, options.file_in, deltas = options.deltas)
+  state = reader.state
+
+  if not options.queries:
+    logger.info('')
+
+    if options.header:
+      show_header(logger, state)
 
-      if options.header:
-        show_header(logger, state)
+    if options.cores:
+      show_cores(logger, state)
 
-      if options.cores:
-        show_cores(logger, state)
+    if options.memory:
+      show_memory(logger, state)
 
-      if options.memory:
-        show_memory(logger, state)
+    if options.pages:
+      show_pages(logger, reader, empty_pages = options.empty_pages)
 
-      if options.pages:
-        show_pages(logger, state, empty_pages = options.empty_pages)
+    if options.forth_word:
+      show_forth_word(logger, reader, str2int(options.forth_word))
 
-      if options.forth_word:
-        show_forth_word(logger, state, str2int(options.forth_word))
+    if options.forth_dict:
+      show_forth_dict(logger, reader, str2int(options.forth_dict))
 
-      if options.forth_dict:
-        show_forth_dict(logger, state, str2int(options.forth_dict))
+    if options.dumps:
+      show_dump(reader, options.dumps)
 
-      if options.dumps:
-        show_dump(state, options.dumps)
+    if options.hexdumps:
+      show_hexdump(logger, reader, options.hexdumps)
 
-    else:
-      for query in options.queries:
-        print_(eval(query, {'STATE': state}), end = '')
+  else:
+    for query in options.queries:
+      print_(eval(query, {'STATE': state, 'MEMORY': reader}), end = '')
 
 if __name__ == '__main__':
   main()
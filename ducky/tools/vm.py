@@ -6,15 +6,18 @@ if not hasattr(urllib, 'parse'):
 
 from .. import patch  # noqa
 from ..machine import Machine
-from ..util import str2int, UINT32_FMT
-from ..streams import OutputStream, InputStream
+from ..util import str2int, sizeof_fmt, UINT32_FMT
+from ..streams import OutputStream, InputStream, FDInputStream, FDOutputStream
 from ..interfaces import IReactorTask
 from ..profiler import STORE
 from ..cpu.registers import Registers
 
+import errno
 import optparse
 import os
+import select
 import signal
+import socket
 import sys
 import threading
 
@@ -143,7 +146,7 @@ def print_machine_stats(logger, M):
   ]
 
   table_cnts = [
-    ['Core', 'Ticks']
+    ['Core', 'Ticks', 'TLB misses', 'TLB flushes']
   ]
 
   def __check_stats(core):
@@ -151,7 +154,9 @@ def print_machine_stats(logger, M):
 
     table_cnts.append([
       str(core),
-      core.registers[Registers.CNT]
+      core.registers[Registers.CNT],
+      core.mmu._tlb.misses,
+      core.mmu._tlb.flushes
     ])
 
   for core in M.cores:
@@ -164,12 +169,105 @@ def print_machine_stats(logger, M):
   logger.table(table_cnts)
   logger.info('')
 
+  coherence = M.coherence
+  logger.info('Invalidations: ptes=%i, pages=%i, instructions=%i, full=%i, batches=%i', coherence.pte_invalidations, coherence.page_invalidations, coherence.instruction_invalidations, coherence.full_invalidations, coherence.batches)
+  logger.info('Memory pages: virtual=%i, committed=%i', M.memory.virtual_pages, M.memory.committed_pages)
+
+  merger = M.memory.merger
+  if merger is not None:
+    logger.info('Page merging: passes=%i, merged=%i, zero=%i, shared=%i, saved=%s', merger.passes, merger.merged_pages, merger.zero_pages, merger.store.shared_pages, sizeof_fmt(merger.store.saved_bytes))
+  logger.info('')
+
   inst_executed = sum([core.registers[Registers.CNT] for core in M.cores])
   runtime = float(M.end_time - M.start_time)
   if runtime > 0:
     logger.info('Executed instructions: %i %f (%.4f/sec)', inst_executed, runtime, float(inst_executed) / runtime)
   logger.info('')
 
+def serve_clones(logger, M, options):
+  """
+  Serve sessions with clones of a template machine. For each connection
+  accepted on a UNIX socket, machine is cloned, and terminal of the clone is
+  connected to the socket.
+
+  Called when template machine reaches its marker, see
+  :py:meth:`ducky.machine.Machine.set_template_marker`. In clones, function
+  returns, and clone continues running. In server, function returns when
+  server is told to quit by ``SIGINT``, and template machine is halted.
+
+  :param logging.Logger logger: ``Logger`` instance to use for logging.
+  :param ducky.machine.Machine M: template machine.
+  :param options: command-line options, as returned by option parser.
+  """
+
+  path = options.clone_server
+
+  if os.path.exists(path):
+    os.unlink(path)
+
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(path)
+  server.listen(options.queue)
+
+  quit = []
+  orig_sigint_handler = signal.signal(signal.SIGINT, lambda sig, frame: quit.append(sig))
+
+  M.tenh('Template machine ready, serving clones at %s', path)
+
+  sessions = 0
+
+  while not quit:
+    try:
+      while os.waitpid(-1, os.WNOHANG)[0] != 0:
+        pass
+
+    except OSError as e:
+      if e.errno != errno.ECHILD:
+        raise e
+
+    try:
+      readable, _, _ = select.select([server], [], [], 1.0)
+
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        continue
+
+      raise e
+
+    if not readable:
+      continue
+
+    conn, _ = server.accept()
+
+    pid = M.clone()
+
+    if pid != 0:
+      sessions += 1
+      logger.info('Session #%i served by clone %i', sessions, pid)
+
+      conn.close()
+      continue
+
+    signal.signal(signal.SIGINT, orig_sigint_handler)
+    server.close()
+
+    # Socket object would close its descriptor when collected
+    fd = os.dup(conn.fileno())
+    conn.close()
+
+    M.get_device_by_name(options.clone_terminal, klass = 'terminal').attach_streams([FDInputStream(M, fd)], FDOutputStream(M, fd))
+    M.wake_clone()
+    return
+
+  server.close()
+  os.unlink(path)
+
+  signal.signal(signal.SIGINT, orig_sigint_handler)
+
+  logger.info('Served %i sessions, halting template machine', sessions)
+
+  M.halt()
+
 class DuckyProtocol(WebSocketServerProtocol):
   """
   Protocol handling communication between VM and remote terminal emulator.
@@ -381,6 +479,7 @@ def main():
   opt_group.add_option('--enable-device',   dest = 'enable_devices',  action = 'append',     default = [],    metavar = 'DEVICE', help = 'Enable device')
   opt_group.add_option('--disable-device',  dest = 'disable_devices', action = 'append',     default = [],    metavar = 'DEVICE', help = 'Disable device')
   opt_group.add_option('--poke',            dest = 'poke',            action = 'append',     default = [],    metavar = 'ADDRESS:VALUE:<124>', help = 'Modify content of memory before running binaries')
+  opt_group.add_option('--restore',         dest = 'restore',         action = 'store',      default = None,  metavar = 'FILE', help = 'Restore machine from snapshot instead of booting it')
   opt_group.add_option('--jit',             dest = 'jit',             action = 'store_true', default = False, help = 'Optimize instructions')
 
   # Network options
@@ -391,6 +490,15 @@ def main():
   opt_group.add_option('--port', dest = 'port', action = 'store', type = 'int', default = 19000, metavar = 'PORT', help = 'Listen at PORT port')
   opt_group.add_option('--queue', dest = 'queue', action = 'store', type = 'int', default = 10, metavar = 'LENGTH', help = 'Listen queue is LENGTH at max')
 
+  # Clone server options
+  opt_group = optparse.OptionGroup(parser, 'Clone server options')
+  parser.add_option_group(opt_group)
+  opt_group.add_option('--clone-server',   dest = 'clone_server',   action = 'store',      default = None,  metavar = 'PATH', help = 'Boot template machine, and serve clones of it at UNIX socket PATH')
+  opt_group.add_option('--clone-terminal', dest = 'clone_terminal', action = 'store',      default = 'device-3', metavar = 'DEVICE', help = 'Connect terminal DEVICE of clones to their sessions')
+  opt_group.add_option('--template-cnt',   dest = 'template_cnt',   action = 'store',      default = None,  type = 'int', metavar = 'N', help = 'Template is ready when it executed N instructions')
+  opt_group.add_option('--template-idle',  dest = 'template_idle',  action = 'store_true', default = False, help = 'Template is ready when all its cores are idle')
+  opt_group.add_option('--template-poke',  dest = 'template_poke',  action = 'store',      default = None,  metavar = 'ADDRESS:VALUE:<124>', help = 'Template is ready when memory at ADDRESS holds VALUE')
+
   # Debugging options
   opt_group = optparse.OptionGroup(parser, 'Debugging options')
   parser.add_option_group(opt_group)
@@ -459,7 +567,15 @@ def main():
     signal.signal(signal.SIGUSR2, signal_handler)
     signal.signal(signal.SIGSEGV, signal_handler)
 
-    M.boot()
+    if options.restore is not None:
+      from ..snapshot import VMState
+
+      logger.info('Restoring machine from %s', options.restore)
+
+      M.resume(VMState.load_vm_state(logger, options.restore, lazy = True))
+
+    else:
+      M.boot()
 
     for poke in options.poke:
       address, value, length = poke.split(':')
@@ -469,6 +585,25 @@ def main():
 
       M.poke(str2int(address), str2int(value), str2int(length))
 
+    if options.clone_server is not None:
+      template_poke = None
+
+      if options.template_poke is not None:
+        address, value, length = options.template_poke.split(':')
+
+        if length not in ('1', '2', '4'):
+          raise ValueError('Unknown poke size: poke=%s' % options.template_poke)
+
+        template_poke = (str2int(address), str2int(value), str2int(length))
+
+      template_cnt = options.template_cnt
+
+      # Without any marker, clone machine right after its boot
+      if template_cnt is None and options.template_idle is not True and template_poke is None:
+        template_cnt = 0
+
+      M.set_template_marker(lambda: serve_clones(logger, M, options), cnt = template_cnt, idle = options.template_idle, poke = template_poke)
+
     try:
       M.run()
 
@@ -1,3 +1,4 @@
+import bisect
 import collections
 import functools
 import string
@@ -264,26 +265,44 @@ class StringTable(object):
     return self._offset_to_string[offset]
 
 class SymbolTable(dict):
+  """
+  Maps addresses to symbols of a binary. Lookups use an index of symbols
+  sorted by their addresses, built by the first lookup.
+  """
+
   def __init__(self, binary):
     self.binary = binary
 
+    self._addresses = None
+    self._names = None
+
+  def _build_index(self):
+    # Symbols sharing an address are kept in the order of the binary
+    entries = sorted([(symbol.address, i, symbol_name) for i, (symbol_name, symbol) in enumerate(iteritems(self.binary.symbols))])
+
+    self._addresses = [entry[0] for entry in entries]
+    self._names = [entry[2] for entry in entries]
+
   def __getitem__(self, address):
-    last_symbol = None
-    last_symbol_offset = 0xFFFE
+    if self._addresses is None:
+      self._build_index()
+
+    addresses = self._addresses
+
+    i = bisect.bisect_right(addresses, address)
+
+    if i == 0:
+      return (None, 0xFFFE)
 
-    for symbol_name, symbol in iteritems(self.binary.symbols):
-      if symbol.address > address:
-        continue
+    symbol_address = addresses[i - 1]
+    symbol_name = self._names[bisect.bisect_left(addresses, symbol_address)]
 
-      if symbol.address == address:
-        return (symbol_name, 0)
+    offset = address - symbol_address
 
-      offset = abs(address - symbol.address)
-      if offset < last_symbol_offset:
-        last_symbol = symbol_name
-        last_symbol_offset = offset
+    if offset >= 0xFFFE:
+      return (None, 0xFFFE)
 
-    return (last_symbol, last_symbol_offset)
+    return (symbol_name, offset)
 
   def get_symbol(self, name):
     return self.binary.symbols[name]
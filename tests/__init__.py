@@ -231,6 +231,9 @@ def run_machine(code = None, binary = None, machine_config = None, coredump_file
 
   M.hw_setup(machine_config)
 
+  if post_run:
+    M.capture_state_on_halt = True
+
   if not all(fn(M) in (True, None) for fn in post_setup):
     if code is not None:
       os.unlink(binary)
@@ -0,0 +1,75 @@
+from ducky.errors import MemoryAccessError
+from ducky.mm import PageTableEntry, PAGE_SIZE, PAGE_SHIFT, AnonymousMemoryPage
+
+from .. import assert_raises
+from .control import create_machine
+
+def run_pending_calls(M):
+  while M.reactor.events:
+    M.reactor.events.popleft().run()
+
+def test_page_shootdown():
+  M = create_machine(cores = 2)
+  core0, core1 = M.cpus[0].cores
+  bus = M.coherence
+
+  pg_index = 0x100
+  addr = pg_index * PAGE_SIZE
+
+  core0.MEM_IN8(addr)
+  core1.MEM_IN8(addr)
+
+  pg = M.memory.get_page(pg_index)
+  M.memory.unregister_page(pg)
+  M.memory.register_page(AnonymousMemoryPage(M.memory, pg_index))
+
+  assert bus.page_invalidations == 2
+
+  # only one batch per core
+  assert len(M.reactor.events) == 2
+
+  run_pending_calls(M)
+
+  for core in (core0, core1):
+    assert pg_index not in core.mmu._page_cache
+
+def test_pte_shootdown():
+  pt_address = 0x10000
+  pg_index = 0x100
+  addr = pg_index * PAGE_SIZE
+
+  M = create_machine(cores = 2, pt_address = pt_address, pt_enabled = True)
+  core0, core1 = M.cpus[0].cores
+
+  M.memory.write_u8(pt_address + pg_index, PageTableEntry.READ)
+
+  core1.privileged = False
+  core1.MEM_IN8(addr)
+
+  # core #0 revokes access of core #1 - both cores share the page table
+  core0.MEM_OUT8(pt_address + pg_index, 0)
+
+  assert M.coherence.pte_invalidations == 2
+
+  run_pending_calls(M)
+
+  assert_raises(lambda: core1.MEM_IN8(addr), MemoryAccessError)
+
+def test_code_shootdown():
+  M = create_machine(cores = 2)
+  core0, core1 = M.cpus[0].cores
+
+  addr = 0x2000
+
+  core1.fetch_instr(addr)
+  assert (addr >> PAGE_SHIFT) in M.coherence.code_pages
+
+  run_pending_calls(M)
+
+  core0.MEM_OUT32(addr, 0)
+
+  assert M.coherence.instruction_invalidations == 1
+
+  run_pending_calls(M)
+
+  assert (addr >> 2) not in core1.mmu._instruction_cache
@@ -185,3 +185,51 @@ def test_pt_enabled():
 
   __check(True, CONTROL_FLAG_PT_ENABLED)
   __check(False, 0)
+
+def test_tlb():
+  from ducky.cpu.coprocessor.control import CONTROL_FLAG_PT_ENABLED
+  from ducky.errors import MemoryAccessError
+  from ducky.mm import PageTableEntry, PAGE_SIZE
+
+  pt_address = 0x10000
+  pg_index = 0x100
+  addr = pg_index * PAGE_SIZE
+
+  M = create_machine(pt_address = pt_address, pt_enabled = True)
+  core = M.cpus[0].cores[0]
+  tlb = core.mmu._tlb
+
+  M.memory.write_u8(pt_address + pg_index, PageTableEntry.READ)
+
+  core.privileged = False
+
+  core.MEM_IN8(addr)
+  assert_raises(lambda: core.MEM_OUT8(addr, 0xFF), MemoryAccessError)
+  assert_raises(lambda: core.MEM_IN32(addr, not_execute = False), MemoryAccessError)
+
+  # second read of the same page is served by TLB
+  misses = tlb.misses
+  core.MEM_IN8(addr + 1)
+  assert tlb.misses == misses
+
+  # privileged access bypasses PTEs
+  core.privileged = True
+  core.MEM_OUT8(addr, 0xFF)
+
+  # modifying page table drops stale entries
+  core.MEM_OUT8(pt_address + pg_index, 0)
+  core.privileged = False
+  assert_raises(lambda: core.MEM_IN8(addr), MemoryAccessError)
+
+  # CR2 and CR3 writes flush TLB
+  core.privileged = True
+
+  flushes = tlb.flushes
+  core.control_coprocessor.write(ControlRegisters.CR2, pt_address)
+  assert tlb.flushes == flushes + 1
+
+  core.control_coprocessor.write(ControlRegisters.CR3, 0)
+  assert tlb.flushes == flushes + 2
+
+  core.control_coprocessor.write(ControlRegisters.CR3, CONTROL_FLAG_PT_ENABLED)
+  assert tlb.flushes == flushes + 3
@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+import ducky.config
+import ducky.devices.snapshot
+
+from ducky.mm import PAGE_SIZE, AnonymousMemoryPage, SharedMemoryPage
+from ducky.snapshot import VMState
+
+from .. import common_run_machine, LOGGER
+
+def test_checkpoint():
+  fd, filepath = tempfile.mkstemp()
+  os.close(fd)
+
+  try:
+    machine_config = ducky.config.MachineConfig()
+    section = machine_config.add_device('snapshot', 'ducky.devices.snapshot.FileSnapshotStorage')
+    machine_config.set(section, 'filepath', filepath)
+    machine_config.set(section, 'interval', '0.5')
+
+    M = common_run_machine(machine_config = machine_config, post_boot = [lambda _M: False])
+
+    storage = M.get_device_by_name(section, klass = 'snapshot')
+    timer = storage.checkpoint_timer
+    assert timer is not None and timer.interval == 0.5
+
+    core = M.cpus[0].cores[0]
+    core.MEM_OUT32(0x1000, 0xDEADBEEF)
+
+    storage.checkpoint()
+
+    # page is copy-on-write now, and writes do not change the checkpoint
+    assert isinstance(M.memory.get_page(0x1000 // PAGE_SIZE), SharedMemoryPage)
+
+    core.MEM_OUT32(0x1000, 0x12345678)
+
+    assert isinstance(M.memory.get_page(0x1000 // PAGE_SIZE), AnonymousMemoryPage)
+    assert core.MEM_IN32(0x1000) == 0x12345678
+
+    storage.writer.join()
+
+    assert storage.checkpoints == 1
+    assert not os.path.exists(filepath + '.tmp')
+
+    state = VMState.load_vm_state(LOGGER, filepath)
+    pages = dict((pg.index, pg.content) for pg in state.get_child('machine').get_child('memory').get_page_states())
+
+    assert pages[0x1000 // PAGE_SIZE][0:4] == bytearray([0xEF, 0xBE, 0xAD, 0xDE])
+
+    M.halt()
+
+    assert storage.checkpoint_timer is None and timer.cancelled is True
+
+  finally:
+    os.unlink(filepath)
@@ -90,8 +90,10 @@ def test_simple_loop():
 def test_svga():
   run_example('vga')
 
-def test_smp():
-  run_example('smp', options = ['--set-option=bootloader:file=%s' % loader_dir('loader'), '--set-option=device-6:filepath=%s' % examples_dir('smp', 'smp.img')], exit_code = 1, snapshot_device = 'device-4')
+def __base_smp_test(options = None):
+  options = options or []
+
+  run_example('smp', options = ['--set-option=bootloader:file=%s' % loader_dir('loader'), '--set-option=device-6:filepath=%s' % examples_dir('smp', 'smp.img')] + options, exit_code = 1, snapshot_device = 'device-4')
 
   expected_exit_codes = [
     [0x00000000, 0x00000001],
@@ -106,3 +108,9 @@ def test_smp():
         expected_exit_code = expected_exit_codes[core_state.cpuid][core_state.coreid]
 
         assert expected_exit_code == core_state.exit_code, 'Core #%d:#%d has unexpected exit code: 0x%08X instead of 0x%08X' % (core_state.cpuid, core_state.coreid, core_state.exit_code, expected_exit_code)
+
+def test_smp():
+  __base_smp_test()
+
+def test_smp_threads():
+  __base_smp_test(options = ['--set-option=machine:smp-threads=yes'])
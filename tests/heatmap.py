@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+from ducky import heatmap
+from ducky.mm import PAGE_SIZE
+
+from .cpu.coherence import run_pending_calls
+from .cpu.control import create_machine
+
+def test_heatmap():
+  M = create_machine(cores = 2)
+  core0, core1 = M.cpus[0].cores
+
+  in8 = core0.MEM_IN8
+
+  hm = heatmap.enable(M, lines = True)
+  run_pending_calls(M)
+
+  core0.MEM_IN8(0x1000)
+  core0.MEM_IN32(0x1010)
+  core1.MEM_OUT16(0x1012, 0xBEEF)
+  core1.MEM_OUT32(0x2000, 0)
+  core0.fetch_instr(0x3000)
+
+  heatmap.disable(M)
+  run_pending_calls(M)
+
+  # no counting once disabled
+  core0.MEM_IN8(0x1000)
+  assert core0.MEM_IN8 == in8
+
+  pg = 0x1000 // PAGE_SIZE
+
+  assert hm.pages[heatmap.READ][pg] == 2
+  assert hm.pages[heatmap.WRITE][pg] == 1
+  assert hm.pages[heatmap.FETCH][0x3000 // PAGE_SIZE] == 1
+
+  # instruction fetch is not counted as read
+  assert hm.pages[heatmap.READ][0x3000 // PAGE_SIZE] == 0
+
+  assert hm.lines[heatmap.READ][0x1010 >> heatmap.LINE_SHIFT] == 1
+  assert hm.lines[heatmap.WRITE][0x1010 >> heatmap.LINE_SHIFT] == 1
+
+  assert hm.hot_pages(count = 1) == [(0x1000, 2, 1, 0)]
+
+  table = hm.report()
+  assert len(table) == 4
+  assert table[1][0] == '0x00001000'
+
+  fd, filename = tempfile.mkstemp()
+  os.close(fd)
+
+  try:
+    hm.dump(filename)
+
+    with open(filename, 'r') as f:
+      rows = f.read().strip().split('\n')
+
+  finally:
+    os.unlink(filename)
+
+  assert rows[0] == 'address,size,reads,writes,fetches'
+  assert '4096,%i,2,1,0' % PAGE_SIZE in rows
+  assert '4112,16,1,1,0' in rows
+
+def test_heatmap_sampling():
+  M = create_machine()
+  core = M.cpus[0].cores[0]
+
+  hm = heatmap.enable(M, frequency = 4)
+  run_pending_calls(M)
+
+  for _ in range(10):
+    core.MEM_IN8(0x1000)
+
+  assert hm.pages[heatmap.READ][0x1000 // PAGE_SIZE] == 2
@@ -0,0 +1,70 @@
+import os
+
+import ducky.config
+
+from ducky.cpu.registers import Registers
+
+from . import common_run_machine
+
+def create_template(cores = 1):
+  return common_run_machine(machine_config = ducky.config.MachineConfig(), cores = cores, post_boot = [lambda _M: False])
+
+def test_template_marker():
+  M = create_template(cores = 2)
+  core0, core1 = M.cores
+
+  reached = []
+
+  task = M.set_template_marker(lambda: reached.append(True), cnt = 10, poke = (0x1000, 0xDEADBEEF, 4))
+  assert task in M.reactor.runnable_tasks
+
+  task.run()
+  assert not reached
+
+  core0.MEM_OUT32(0x1000, 0xDEADBEEF)
+
+  task.run()
+  assert reached == [True]
+
+  # marker is reached just once, and cores are suspended
+  assert task not in M.reactor.tasks
+  assert core0.running is False and core1.running is False
+
+  M.wake_clone()
+  assert core0.running is True and core1.running is True
+
+  reached = []
+  task = M.set_template_marker(lambda: reached.append(True), cnt = 10)
+
+  core0.registers[Registers.CNT] = 6
+  core1.registers[Registers.CNT] = 4
+
+  task.run()
+  assert reached == [True]
+
+def test_clone():
+  M = create_template()
+  core = M.cpus[0].cores[0]
+
+  core.MEM_OUT32(0x1000, 0xDEADBEEF)
+
+  pid = M.clone()
+
+  if pid == 0:
+    # Never return into the test runner from the clone
+    try:
+      status = 0 if core.MEM_IN32(0x1000) == 0xDEADBEEF else 1
+      core.MEM_OUT32(0x1000, 0x12345678)
+
+    except Exception:
+      status = 2
+
+    finally:
+      os._exit(status)
+
+  _, status = os.waitpid(pid, 0)
+
+  assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+  # writes of the clone are private to the clone
+  assert core.MEM_IN32(0x1000) == 0xDEADBEEF
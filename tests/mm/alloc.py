@@ -1,6 +1,12 @@
+import os
+import tempfile
+
 from .. import TestCase, common_run_machine, assert_mm_pages, mock, LOGGER
-from ducky.mm import PAGE_SIZE, MemoryController, MINIMAL_SIZE, AnonymousMemoryPage
-from ducky.errors import InvalidResourceError
+from ducky.config import MachineConfig
+from ducky.mm import PAGE_SIZE, MemoryController, MINIMAL_SIZE, AnonymousMemoryPage, FlatMemoryPage, ZeroMemoryPage
+from ducky.errors import InvalidResourceError, AccessViolationError
+from ducky.cpu.registers import Registers
+from ducky.snapshot import VMState
 
 from hypothesis import given, assume
 from hypothesis.strategies import integers
@@ -22,6 +28,131 @@ def test_memory_size(pages):
     else:
       raise e
 
+def __test_block_transfer(backend):
+  machine = mock.MagicMock()
+  machine.config = MachineConfig()
+  machine.config.add_section('memory')
+  machine.config.set('memory', 'backend', backend)
+  machine.coherence.watched_pages = set([3])
+
+  mc = MemoryController(machine, size = MINIMAL_SIZE * PAGE_SIZE)
+
+  # block spanning three pages, starting and ending in the middle of a page
+  addr = PAGE_SIZE + 200
+  data = bytearray([i & 0xFF for i in range(0, 2 * PAGE_SIZE)])
+
+  mc.write_block(addr, data)
+
+  assert mc.read_block(addr, len(data)) == data
+  assert mc.read_u8(addr + PAGE_SIZE) == data[PAGE_SIZE]
+  assert mc.read_u8(addr - 1) == 0
+  assert mc.read_u8(addr + len(data)) == 0
+
+  # write into watched page is reported to coherence bus
+  machine.coherence.memory_written.assert_called_once_with(3 * PAGE_SIZE, 200)
+
+  mc.fill(addr + 10, 0x1FF, 300)
+  assert mc.read_block(addr + 10, 300) == bytearray([0xFF] * 300)
+  assert mc.read_u8(addr + 9) == data[9]
+  assert mc.read_u8(addr + 310) == data[310]
+
+  # overlapping copy behaves like memmove
+  expected = mc.read_block(addr, 400)
+  mc.copy(addr + 100, addr, 400)
+  assert mc.read_block(addr + 100, 400) == expected
+
+  for a, length in [(mc.size - 10, 11), (-1, 1)]:
+    try:
+      mc.read_block(a, length)
+
+    except AccessViolationError:
+      pass
+
+    else:
+      assert False, 'AccessViolationError expected'
+
+def test_block_transfer():
+  __test_block_transfer('pages')
+
+def test_block_transfer_flat():
+  __test_block_transfer('flat')
+
+def test_zero_page():
+  machine = mock.MagicMock()
+  mc = MemoryController(machine, size = MINIMAL_SIZE * PAGE_SIZE)
+
+  # reads do not commit any memory
+  assert mc.read_u32(5 * PAGE_SIZE) == 0
+  assert mc.read_block(6 * PAGE_SIZE - 2, 4) == bytearray(4)
+
+  zero_pg = mc.get_page(5)
+  assert isinstance(zero_pg, ZeroMemoryPage)
+  assert mc.virtual_pages == 2
+  assert mc.committed_pages == 0
+
+  # the first write replaces the zero page with a private one
+  mc.write_u16(5 * PAGE_SIZE + 2, 0xBEEF)
+
+  pg = mc.get_page(5)
+  assert isinstance(pg, AnonymousMemoryPage)
+  assert mc.virtual_pages == 2
+  assert mc.committed_pages == 1
+  machine.coherence.invalidate_pages.assert_called_with(5)
+
+  # stale references to the zero page reach the committed page
+  assert zero_pg.read_u32(0) == 0xBEEF0000
+  zero_pg.write_u8(0, 0x12)
+  assert pg.read_u8(0) == 0x12
+
+  mc.free_page(zero_pg)
+  assert mc.virtual_pages == 1
+  assert mc.committed_pages == 0
+
+def test_file_backend():
+  fd, path = tempfile.mkstemp()
+  os.close(fd)
+
+  def __config():
+    machine_config = MachineConfig()
+    machine_config.add_section('memory')
+    machine_config.set('memory', 'backend', 'file')
+    machine_config.set('memory', 'file', path)
+    machine_config.set('memory', 'size', 0x10000)
+    return machine_config
+
+  try:
+    M = common_run_machine(machine_config = __config(), post_boot = [lambda _M: False])
+
+    M.memory.write_u32(0x4000, 0xDEADBEEF)
+    M.cpus[0].cores[0].registers[Registers.R01] = 0x79
+
+    state = VMState.capture_vm_state(M)
+    M.halt()
+
+    # RAM is not part of the snapshot
+    assert state.get_child('machine').get_child('memory').get_page_states() == []
+    assert os.path.getsize(path) == 0x10000
+
+    # new machine maps RAM file back
+    M = common_run_machine(machine_config = __config(), post_setup = [lambda _M: False])
+    M.resume(state)
+
+    core = M.cpus[0].cores[0]
+    assert M.memory.read_u32(0x4000) == 0xDEADBEEF
+    assert core.registers[Registers.R01] == 0x79
+    assert core.running is True
+
+    M.halt()
+
+    # fresh boot starts with clear RAM
+    M = common_run_machine(machine_config = __config(), post_boot = [lambda _M: False])
+    assert M.memory.read_u32(0x4000) == 0
+
+    M.halt()
+
+  finally:
+    os.unlink(path)
+
 @given(pages = integers(min_value = MINIMAL_SIZE, max_value = 0x100000000 // PAGE_SIZE), pg = integers(min_value = 0, max_value = 0x100000000 // PAGE_SIZE))
 def test_memory_alloc_beyond(pages, pg):
   assume(pg >= pages)
@@ -91,3 +222,33 @@ class Tests(TestCase):
       return False
 
     common_run_machine(post_boot = [__test])
+
+  def test_flat_backend(self):
+    def __test(M):
+      pg_index = 79
+      addr = pg_index * PAGE_SIZE + 16
+
+      M.memory.write_u32(addr, 0xFADEABCA)
+
+      pg = M.memory.get_page(pg_index)
+      assert isinstance(pg, FlatMemoryPage)
+
+      assert M.memory.read_u32(addr) == 0xFADEABCA
+      assert M.memory.read_u16(addr + 2) == 0xFADE
+      assert M.memory.read_u8(addr) == 0xCA
+      assert M.memory.ram[addr:addr + 4] == b'\xca\xab\xde\xfa'
+
+      S = M.capture_state()
+      assert_mm_pages(S.get_child('machine').get_child('memory'), *[1, pg_index])
+
+      # freed page must not leak its content to its successor
+      M.memory.free_page(pg)
+      assert M.memory.read_u32(addr) == 0
+
+      return False
+
+    machine_config = MachineConfig()
+    machine_config.add_section('memory')
+    machine_config.set('memory', 'backend', 'flat')
+
+    common_run_machine(machine_config = machine_config, post_boot = [__test])
@@ -0,0 +1,71 @@
+from .. import mock
+from ducky.mm import PAGE_SIZE, MemoryController, MINIMAL_SIZE, AnonymousMemoryPage, SharedMemoryPage, ZeroMemoryPage
+from ducky.mm.dedup import PageStore, PageMerger
+
+def __create_controller(store):
+  machine = mock.MagicMock()
+  mc = MemoryController(machine, size = MINIMAL_SIZE * PAGE_SIZE)
+
+  return mc, PageMerger(mc, store = store, batch = 4, interval = 1)
+
+def __run_passes(merger, passes):
+  for _ in range(passes):
+    merger.step()
+
+    while merger.queue:
+      merger.step()
+
+def test_merge():
+  store = PageStore()
+
+  mc1, merger1 = __create_controller(store)
+  mc2, merger2 = __create_controller(store)
+
+  content = bytearray(range(256)) * (PAGE_SIZE // 256)
+
+  for mc in (mc1, mc2):
+    mc.write_block(3 * PAGE_SIZE, content)
+    mc.write_u8(4 * PAGE_SIZE + 7, 0x79)
+    mc.write_u8(5 * PAGE_SIZE, 0)
+
+  # page changed between passes is not merged
+  merger1.step()
+  mc1.write_u8(3 * PAGE_SIZE, 0xAA)
+  __run_passes(merger1, 1)
+
+  assert isinstance(mc1.get_page(3), AnonymousMemoryPage)
+  assert isinstance(mc1.get_page(4), SharedMemoryPage)
+  assert isinstance(mc1.get_page(5), ZeroMemoryPage)
+  assert merger1.merged_pages == 2
+  assert merger1.zero_pages == 1
+
+  __run_passes(merger1, 1)
+  __run_passes(merger2, 2)
+
+  for mc in (mc1, mc2):
+    assert isinstance(mc.get_page(3), SharedMemoryPage)
+    assert mc.committed_pages == 0
+    assert mc.read_u8(4 * PAGE_SIZE + 7) == 0x79
+
+  assert mc1.get_page(4).data is mc2.get_page(4).data
+  assert store.shared_pages == 3
+  assert store.sharing_pages == 4
+  assert store.saved_bytes == PAGE_SIZE
+
+  mc1.machine.coherence.invalidate_pages_now.assert_called_with(3)
+
+  # write gives page its private copy
+  mc2.write_u8(4 * PAGE_SIZE, 0xFF)
+
+  pg = mc2.get_page(4)
+  assert isinstance(pg, AnonymousMemoryPage)
+  assert pg.read_u8(0) == 0xFF
+  assert pg.read_u8(7) == 0x79
+  assert mc2.committed_pages == 1
+  assert store.sharing_pages == 3
+
+  mc1.halt()
+  mc2.halt()
+
+  assert store.sharing_pages == 0
+  assert store.shared_pages == 0
@@ -0,0 +1,43 @@
+from six import iteritems
+
+from ducky.mm.directory import PageDirectory
+
+def test_directory():
+  d = PageDirectory(1 << 20, bits = 8)
+
+  assert len(d.tables) == (1 << 12)
+  assert len(d) == 0
+  assert 17 not in d
+  assert d.get(17) is None
+  assert d.get(1 << 20) is None
+
+  d[17] = 'foo'
+  d[(1 << 20) - 1] = 'bar'
+
+  # only tables with entries are allocated
+  assert len([table for table in d.tables if table is not None]) == 2
+
+  assert len(d) == 2
+  assert 17 in d
+  assert d[17] == 'foo'
+  assert list(iteritems(d)) == [(17, 'foo'), ((1 << 20) - 1, 'bar')]
+
+  d[17] = 'baz'
+  assert len(d) == 2
+
+  assert d.pop(17) == 'baz'
+  assert d.pop(17, None) is None
+  assert len(d) == 1
+
+  try:
+    d[18]
+
+  except KeyError:
+    pass
+
+  else:
+    assert False, 'KeyError expected'
+
+  d.clear()
+  assert len(d) == 0
+  assert all(table is None for table in d.tables)
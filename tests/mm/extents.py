@@ -0,0 +1,57 @@
+from ducky.mm.extents import FreeExtents
+
+from hypothesis import given
+from hypothesis.strategies import integers, lists, tuples
+
+def test_reserve_release():
+  extents = FreeExtents(100)
+
+  extents.reserve(10, count = 5)
+  extents.reserve(50)
+
+  assert list(zip(extents.starts, extents.ends)) == [(0, 10), (15, 50), (51, 100)]
+  assert extents.free == 94
+
+  assert extents.is_free(0, count = 10)
+  assert not extents.is_free(5, count = 6)
+  assert not extents.is_free(50)
+
+  assert extents.first_fit(count = 10) == 0
+  assert extents.first_fit(count = 11) == 15
+  assert extents.first_fit(count = 35, base = 5) == 15
+  assert extents.first_fit(count = 36) == 51
+  assert extents.first_fit(count = 50) is None
+  assert extents.first_fit(base = 12) == 15
+
+  # releasing merges neighbouring extents
+  extents.release(50)
+  extents.release(10, count = 5)
+
+  assert list(zip(extents.starts, extents.ends)) == [(0, 100)]
+  assert extents.free == 100
+
+@given(ranges = lists(tuples(integers(min_value = 0, max_value = 255), integers(min_value = 1, max_value = 16)), max_size = 32))
+def test_against_set(ranges):
+  size = 256
+  extents = FreeExtents(size)
+  used = set()
+
+  for index, count in ranges:
+    pages = set(range(index, min(index + count, size)))
+
+    if pages & used or index + count > size:
+      continue
+
+    extents.reserve(index, count = count)
+    used |= pages
+
+    assert extents.free == size - len(used)
+
+  for count in (1, 4, 16):
+    expected = next((i for i in range(0, size - count + 1) if not used & set(range(i, i + count))), None)
+    assert extents.first_fit(count = count) == expected
+
+  for index in sorted(used):
+    extents.release(index)
+
+  assert list(zip(extents.starts, extents.ends)) == [(0, size)]
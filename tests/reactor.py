@@ -0,0 +1,92 @@
+import threading
+
+import ducky.config
+
+from ducky.interfaces import IReactorTask
+from ducky.reactor import monotonic
+
+from . import common_run_machine
+
+def create_reactor():
+  M = common_run_machine(machine_config = ducky.config.MachineConfig(), post_setup = [lambda _M: False])
+
+  return M.reactor
+
+def test_timers():
+  reactor = create_reactor()
+
+  calls = []
+
+  now = monotonic()
+
+  reactor.call_at(now + 2.0, calls.append, 'later')
+  reactor.call_at(now + 1.0, calls.append, 'sooner')
+  cancelled = reactor.call_at(now + 1.0, calls.append, 'cancelled')
+  cancelled.cancel()
+
+  reactor.run_timers(now = now + 0.5)
+  assert calls == []
+
+  reactor.run_timers(now = now + 1.5)
+  assert calls == ['sooner']
+
+  reactor.run_timers(now = now + 2.5)
+  assert calls == ['sooner', 'later']
+  assert not reactor.timers
+
+def test_periodic_timer():
+  reactor = create_reactor()
+
+  calls = []
+
+  timer = reactor.call_periodic(1.0, lambda: calls.append(True))
+  start = timer.deadline - 1.0
+
+  reactor.run_timers(now = start + 1.0)
+  assert len(calls) == 1
+  assert timer.deadline == start + 2.0
+
+  # missed calls are dropped
+  reactor.run_timers(now = start + 5.5)
+  assert len(calls) == 2
+  assert timer.deadline == start + 6.5
+
+  timer.interval = 0.5
+  reactor.run_timers(now = start + 6.5)
+  assert timer.deadline == start + 7.0
+
+  timer.cancel()
+  reactor.run_timers(now = start + 10.0)
+  assert len(calls) == 3
+  assert not reactor.timers
+
+def test_idle_wakeup():
+  reactor = create_reactor()
+
+  class IdleTask(IReactorTask):
+    def run(self):
+      pass
+
+  task = IdleTask()
+  reactor.add_task(task)
+
+  calls = []
+
+  def quit():
+    calls.append(monotonic())
+    reactor.remove_task(task)
+
+  # loop sleeps in poll, then it's woken up by a timer, and by a call posted
+  # from another thread
+  reactor.call_later(0.1, calls.append, 'timer')
+
+  poster = threading.Timer(0.3, reactor.add_call, args = (quit,))
+  poster.start()
+
+  start = monotonic()
+  reactor.run()
+  poster.join()
+
+  assert calls[0] == 'timer'
+  assert calls[1] - start < 1.0
+  assert reactor._wakeup_pipe is None
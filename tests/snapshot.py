@@ -0,0 +1,222 @@
+import os
+import tempfile
+
+from six.moves import cPickle as pickle
+
+from ducky.errors import InvalidResourceError
+from ducky.mm import PAGE_SIZE, AnonymousMemoryPage, SharedMemoryPage, ZeroMemoryPage
+from ducky.snapshot import VMState, CoreDumpFile, CoreDumpReader, SNAPSHOT_MAGIC, lzma, merge_states
+from ducky.util import SymbolTable
+
+from . import LOGGER, common_run_machine, assert_raises, mock
+from .cpu.control import create_machine
+
+def __capture():
+  M = create_machine()
+
+  M.memory.write_u32(0x1000, 0xDEADBEEF)
+  M.memory.read_u8(0x2000)
+  M.cpus[0].cores[0].registers[3] = 0x79
+
+  return M.capture_state()
+
+def __round_trip(state, compression):
+  fd, filename = tempfile.mkstemp()
+  os.close(fd)
+
+  try:
+    state.save(filename, compression = compression)
+
+    with open(filename, 'rb') as f:
+      assert f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+    return VMState.load_vm_state(LOGGER, filename)
+
+  finally:
+    os.unlink(filename)
+
+def __assert_states(expected, loaded):
+  expected_memory = expected.get_child('machine').get_child('memory')
+  loaded_memory = loaded.get_child('machine').get_child('memory')
+
+  assert loaded_memory.size == expected_memory.size
+
+  expected_pages = dict((pg.index, pg.content) for pg in expected_memory.get_page_states())
+  loaded_pages = dict((pg.index, pg.content) for pg in loaded_memory.get_page_states())
+
+  assert loaded_pages == expected_pages
+  assert loaded_pages[0x2000 // PAGE_SIZE] == bytearray(PAGE_SIZE)
+  assert loaded_pages[0x1000 // PAGE_SIZE][0:4] == bytearray([0xEF, 0xBE, 0xAD, 0xDE])
+
+  core_state = loaded.get_child('machine').get_child('cpu0').get_child('core0')
+  assert core_state.registers[3] == 0x79
+
+def test_round_trip():
+  state = __capture()
+
+  for compression in ['none', 'zlib'] + (['lzma'] if lzma is not None else []):
+    __assert_states(state, __round_trip(state, compression))
+
+  # saving must leave the original tree intact
+  __assert_states(state, state)
+
+def test_legacy_format():
+  state = __capture()
+
+  fd, filename = tempfile.mkstemp()
+  os.close(fd)
+
+  try:
+    state.logger = None
+
+    with open(filename, 'wb') as f:
+      pickle.dump(state, f)
+
+    with CoreDumpFile.open(LOGGER, filename, 'r') as f_in:
+      __assert_states(state, f_in.load())
+
+  finally:
+    os.unlink(filename)
+
+def test_no_capture_on_halt():
+  M = common_run_machine(post_boot = [lambda _M: False])
+  M.halt()
+
+  assert M.last_state is None
+
+def test_incremental():
+  M = create_machine()
+  M.memory.track_dirty_pages()
+
+  M.memory.write_u32(0x1000, 0xDEADBEEF)
+  M.memory.read_u8(0x2000)
+  full = M.capture_state()
+
+  core = M.cpus[0].cores[0]
+  core.MEM_OUT32(0x3000, 0x12345678)
+  M.memory.write_block(0x1010, bytearray([0x79]))
+  delta1 = M.capture_state(incremental = True)
+
+  memory = delta1.get_child('machine').get_child('memory')
+  assert memory.incremental is True
+  assert sorted([pg.index for pg in memory.get_page_states()]) == [0x1000 // PAGE_SIZE, 0x3000 // PAGE_SIZE]
+
+  M.memory.write_u8(0x1000, 0xAA)
+  delta2 = M.capture_state(incremental = True)
+
+  assert [pg.index for pg in delta2.get_child('machine').get_child('memory').get_page_states()] == [0x1000 // PAGE_SIZE]
+
+  expected = M.capture_state()
+  merged = merge_states([full, __round_trip(delta1, 'zlib'), delta2])
+
+  merged_pages = dict((pg.index, pg.content) for pg in merged.get_child('machine').get_child('memory').get_page_states())
+  expected_pages = dict((pg.index, pg.content) for pg in expected.get_child('machine').get_child('memory').get_page_states())
+
+  assert merged_pages == expected_pages
+  assert merged_pages[0x1000 // PAGE_SIZE][0:4] == bytearray([0xAA, 0xBE, 0xAD, 0xDE])
+  assert merged_pages[0x1000 // PAGE_SIZE][0x10] == 0x79
+
+  assert_raises(lambda: merge_states([delta1]), InvalidResourceError)
+
+def test_incremental_untracked():
+  M = create_machine()
+
+  assert_raises(lambda: M.capture_state(incremental = True), InvalidResourceError)
+
+def test_restore_lazy():
+  M = common_run_machine(post_boot = [lambda _M: False])
+
+  M.memory.write_u32(0x1000, 0xDEADBEEF)
+  M.memory.write_u8(0x2000, 0)
+  M.cpus[0].cores[0].registers[3] = 0x79
+
+  state = M.capture_state(suspend = True)
+  M.halt()
+
+  fd, filename = tempfile.mkstemp()
+  os.close(fd)
+
+  try:
+    state.save(filename)
+
+    M = common_run_machine(post_setup = [lambda _M: False])
+    M.resume(VMState.load_vm_state(LOGGER, filename, lazy = True))
+
+    core = M.cpus[0].cores[0]
+    assert core.registers[3] == 0x79
+    assert core.running is True
+
+    pg = M.memory.get_page(0x1000 // PAGE_SIZE)
+    assert isinstance(pg, SharedMemoryPage)
+    assert isinstance(pg.data, memoryview)
+    assert isinstance(M.memory.get_page(0x2000 // PAGE_SIZE), ZeroMemoryPage)
+
+    assert core.MEM_IN32(0x1000) == 0xDEADBEEF
+
+    # first write gives page its private copy
+    core.MEM_OUT8(0x1000, 0x12)
+
+    assert isinstance(M.memory.get_page(0x1000 // PAGE_SIZE), AnonymousMemoryPage)
+    assert M.memory.read_u32(0x1000) == 0xDEADBE12
+
+    M.halt()
+
+  finally:
+    os.unlink(filename)
+
+def test_reader():
+  M = create_machine()
+  M.memory.track_dirty_pages()
+
+  M.memory.write_block(PAGE_SIZE - 2, bytearray([0x01, 0x02, 0x03, 0x04]))
+  full = M.capture_state()
+
+  M.memory.write_u32(0x1000, 0xDEADBEEF)
+  delta = M.capture_state(incremental = True)
+
+  filenames = []
+
+  try:
+    for state in (full, delta):
+      fd, filename = tempfile.mkstemp()
+      os.close(fd)
+      filenames.append(filename)
+
+      state.save(filename)
+
+    reader = CoreDumpReader.open(LOGGER, filenames[0], deltas = filenames[1:])
+
+    # word crossing page boundary
+    assert reader.read_u32(PAGE_SIZE - 2).value == 0x04030201
+    assert reader.read_u16(0x1002).value == 0xDEAD
+    assert reader.read_u8(0x1000).value == 0xEF
+
+    # page missing in snapshot reads as zeros
+    assert reader.read_u32(M.memory.size - 4).value == 0
+
+    assert [index for index, _ in reader.iter_pages()] == [0, 1, 0x1000 // PAGE_SIZE]
+
+    rows = list(reader.iter_rows(0x1000, 40, width = 16))
+    assert [address for address, _ in rows] == [0x1000, 0x1010, 0x1020]
+    assert rows[0][1][0:4] == bytearray([0xEF, 0xBE, 0xAD, 0xDE])
+    assert len(rows[2][1]) == 8
+
+  finally:
+    for filename in filenames:
+      os.unlink(filename)
+
+def test_symbol_table():
+  binary = mock.MagicMock()
+  binary.symbols = {
+    'foo': mock.MagicMock(address = 0x100),
+    'bar': mock.MagicMock(address = 0x180),
+    'baz': mock.MagicMock(address = 0x20000)
+  }
+
+  symbols = SymbolTable(binary)
+
+  assert symbols[0x100] == ('foo', 0)
+  assert symbols[0x17F] == ('foo', 0x7F)
+  assert symbols[0x200] == ('bar', 0x80)
+  assert symbols[0x80] == (None, 0xFFFE)
+  assert symbols[0x1FFFF] == (None, 0xFFFE)
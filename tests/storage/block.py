@@ -105,3 +105,23 @@ class Tests(TestCase):
                 storages = [storage_desc], pokes = [(data_base, msg_block, 4)] + [(data_base + 4 + i, ord(msg[i]), 1) for i in range(0, ducky.devices.storage.BLOCK_SIZE)],
                 mm_asserts = mm_assert, file_assertss = file_assert,
                 r0 = 0x01, r1 = 0x01, r2 = 0x01, r10 = 0x28, z = True)
+
+  def test_reattach(self):
+    BLOCK_SIZE = ducky.devices.storage.BLOCK_SIZE
+
+    f_tmp = prepare_file(BLOCK_SIZE * 4)
+
+    M = common_run_machine(storages = [('ducky.devices.storage.FileBackedStorage', 1, f_tmp.name)], post_boot = [lambda _M: False])
+
+    storage = M.get_storage_by_id(1)
+    storage.reattach()
+
+    storage.write_blocks(1, 1, bytearray([0x61] * BLOCK_SIZE))
+
+    # clone sees its own writes, the file stays intact
+    assert storage.read_blocks(0, 3) == bytearray([0xDE] * BLOCK_SIZE) + bytearray([0x61] * BLOCK_SIZE) + bytearray([0xDE] * BLOCK_SIZE)
+
+    with open(f_tmp.name, 'rb') as f:
+      assert bytearray(f.read()) == bytearray([0xDE] * (BLOCK_SIZE * 4))
+
+    os.unlink(f_tmp.name)
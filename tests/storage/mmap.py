@@ -2,9 +2,11 @@ import os
 import random
 import string
 
-from .. import TestCase, prepare_file, common_run_machine, common_asserts, tests_dir
+from .. import TestCase, prepare_file, common_run_machine, common_asserts, tests_dir, get_tempfile, LOGGER
 from functools import partial
-from ducky.boot import DEFAULT_BOOTLOADER_ADDRESS
+from ducky.boot import DEFAULT_BOOTLOADER_ADDRESS, MMapMemoryPage
+from ducky.mm import PAGE_SIZE, AnonymousMemoryPage
+from ducky.mm.binary import File, SectionFlags, SectionTypes
 
 def common_case(mm_asserts = None, file_asserts = None, **kwargs):
   common_run_machine(post_run = [partial(common_asserts, mm_asserts = mm_asserts, file_asserts = file_asserts, **kwargs)], **kwargs)
@@ -92,3 +94,54 @@ class Tests(TestCase):
                 pokes = [(data_base + msg_length, msg_offset, 4)] + [(data_base + i, ord(msg[i]), 1) for i in range(0, msg_length)],
                 mm_asserts = mm_assert, file_asserts = file_assert,
                 r0 = mmap_offset + msg_offset + msg_length, r1 = data_base + msg_length, r3 = ord(msg[-1]), e = 1, z = 1)
+
+  def test_mmap_sections(self):
+    # read-only section, 2 whole pages and a half, followed by a writable one
+    text = bytearray([random.randint(0, 255) for _ in range(0, 2 * PAGE_SIZE + PAGE_SIZE // 2)])
+    data = bytearray([random.randint(0, 255) for _ in range(0, PAGE_SIZE)])
+
+    tmp = get_tempfile()
+    tmp.close()
+
+    with File.open(LOGGER, tmp.name, 'w') as f_out:
+      for name, base, payload, flags in [('.text', 0x0000, text, SectionFlags.create(readable = True, executable = True, loadable = True)),
+                                         ('.data', 0x1000, data, SectionFlags.create(readable = True, writable = True, loadable = True))]:
+        section = f_out.create_section(name = name)
+        section.header.name = f_out.string_table.put_string(name)
+        section.header.type = SectionTypes.PROGBITS
+        section.header.flags = flags.to_encoding()
+        section.header.base = base
+        section.header.data_size = section.header.file_size = len(payload)
+        section.payload = payload
+
+      f_out.save()
+
+    base = DEFAULT_BOOTLOADER_ADDRESS + 0x10000
+
+    def __test(M):
+      try:
+        M.rom_loader.setup_bootloader(tmp.name, base = base, mmap_sections = True)
+
+        pages = [M.memory.get_page((base >> 8) + i) for i in range(0, 3)]
+
+        assert all(isinstance(pg, MMapMemoryPage) for pg in pages[0:2])
+        assert isinstance(pages[2], AnonymousMemoryPage)
+        assert isinstance(M.memory.get_page((base + 0x1000) >> 8), AnonymousMemoryPage)
+
+        assert M.memory.read_block(base, len(text)) == text
+        assert M.memory.read_block(base + 0x1000, len(data)) == data
+        assert M.memory.read_u32(base + PAGE_SIZE - 2) == text[PAGE_SIZE - 2] | (text[PAGE_SIZE - 1] << 8) | (text[PAGE_SIZE] << 16) | (text[PAGE_SIZE + 1] << 24)
+
+        # mapping is private, file stays untouched
+        M.memory.write_u32(base, 0xDEADBEEF)
+        assert M.memory.read_u32(base) == 0xDEADBEEF
+
+        with open(tmp.name, 'rb') as f_in:
+          assert text[0:4] in f_in.read()
+
+      finally:
+        os.unlink(tmp.name)
+
+      return False
+
+    common_run_machine(post_boot = [__test])